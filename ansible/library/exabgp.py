@@ -37,10 +37,14 @@ EXAMPLES = '''
     state: stopped
 '''
 
+import os
 import sys
+import fcntl
 import jinja2
 from ansible.module_utils.basic import *
 
+SUPERVISOR_LOCK_FILE = "/tmp/exabgp-supervisor.lock"
+
 dump_py = '''\
 #!/usr/bin/env python
 
@@ -62,8 +66,19 @@ while True:
 
 http_api_py = '''\
 from flask import Flask, request
+from werkzeug.serving import WSGIRequestHandler
+import socket
 import sys
 
+class RequestHandler(WSGIRequestHandler):
+    # Keep the connection open between the requests, the routes are announced in chunks
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        # The response header and body are written separately, do not delay the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
 app = Flask(__name__)
 
 # Setup a command route to listen for prefix advertisements
@@ -79,7 +94,7 @@ def run_command():
     return "OK\\n"
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=sys.argv[1])
+    app.run(host='0.0.0.0', port=sys.argv[1], request_handler=RequestHandler)
 '''
 
 exabgp_conf_tmpl = '''\
@@ -133,8 +148,11 @@ def get_exabgp_status(module, name):
     return m.group(2)
 
 def refresh_supervisord(module):
-    exec_command(module, cmd="supervisorctl reread", ignore_error=True)
-    exec_command(module, cmd="supervisorctl update", ignore_error=True)
+    # serialize reread/update of the instances being set up at the same time
+    with open(SUPERVISOR_LOCK_FILE, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        exec_command(module, cmd="supervisorctl reread", ignore_error=True)
+        exec_command(module, cmd="supervisorctl update", ignore_error=True)
 
 def start_exabgp(module, name):
     refresh_supervisord(module)
@@ -205,10 +223,21 @@ def setup_exabgp_processor():
     except OSError:
         pass
 
-    with open("/usr/share/exabgp/dump.py", 'w') as out_file:
-        out_file.write(dump_py)
-    with open("/usr/share/exabgp/http_api.py", 'w') as out_file:
-        out_file.write(http_api_py)
+    write_file_atomic("/usr/share/exabgp/dump.py", dump_py)
+    write_file_atomic("/usr/share/exabgp/http_api.py", http_api_py)
+
+def write_file_atomic(path, data):
+    # other instances may be starting from the file, never leave it half written
+    try:
+        with open(path) as in_file:
+            if in_file.read() == data:
+                return
+    except IOError:
+        pass
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, 'w') as out_file:
+        out_file.write(data)
+    os.rename(tmp_path, path)
 
 def main():
     module = AnsibleModule(
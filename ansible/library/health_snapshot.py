@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# This ansible module collects the health state of a SONiC device in one execution.
+#
+# The sanity checks need the state of the critical services, the supervisor state of their
+# critical processes, the oper status of the interfaces which are admin up in the persistent
+# configuration, the redis client output buffer memory, the CRM resources and the uptime.
+# Getting each of them with a separate ansible command costs one ansible round trip per
+# command, this module gets all of them in a single round trip.
+#
+# Example of module output:
+# {
+#     "ansible_facts": {
+#         "health_snapshot": {
+#             "uptime": 5123.4,
+#             "networking_uptime": 4987.1,
+#             "services": {"swss": true, "syncd": true, ...},
+#             "processes": {
+#                 "swss": {"status": true, "exited_critical_process": [],
+#                          "running_critical_process": ["orchagent", "portsyncd", ...]},
+#                 ...
+#             },
+#             "interfaces": {"Ethernet0": {"link": true, "active": true}, ...},
+#             "down_ports": [],
+#             "dbmemory": {"total_omem": 0, "client_list": [...]},
+#             "crm": [...]
+#         }
+#     }
+# }
+
+import os
+import re
+import json
+import subprocess
+import threading
+
+from ansible.module_utils.basic import *
+
+
+DOCUMENTATION = '''
+---
+module: health_snapshot
+version_added: "2.0"
+short_description: Collect the health state of SONiC device in one execution.
+description:
+    - Collect services, critical process, interface, redis memory, CRM and uptime
+      state of SONiC device, the state will be inserted to the ansible_facts key.
+options:
+    services:
+        description: the services to check
+        required: false
+    processes:
+        description: collect critical process status of the running services
+        required: false
+        default: true
+    interfaces:
+        description: collect oper status of the interfaces admin up in config_db.json
+        required: false
+        default: true
+    dbmemory:
+        description: collect redis client output buffer memory
+        required: false
+        default: true
+    crm:
+        description: collect output of "crm show resources all"
+        required: false
+        default: false
+'''
+
+EXAMPLES = '''
+# Collect health state of the critical services
+- name: Collect health snapshot
+  health_snapshot:
+    services: ["swss", "syncd", "database", "teamd", "bgp", "pmon", "lldp", "snmp"]
+'''
+
+CONFIG_DB_FILE = "/etc/sonic/config_db.json"
+SEPARATOR = "-----SPYTEST-SNAPSHOT-----"
+
+
+def run_cmd(cmd):
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    return proc.returncode, out.decode("utf-8", "ignore") if isinstance(out, bytes) else out
+
+
+def read_file(path, default=None):
+    try:
+        with open(path) as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+def get_services_status(services):
+    """
+    @summary: Check whether the containers of the services are running with one docker inspect
+    """
+    result = dict([(service, False) for service in services])
+    if not services:
+        return result
+    cmd = "docker inspect -f '{{.Name}} {{.State.Running}}' %s" % " ".join(services)
+    _, out = run_cmd(cmd)
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0].lstrip("/") in result:
+            result[fields[0].lstrip("/")] = (fields[1] == "true")
+    return result
+
+
+def get_process_status(service, running):
+    """
+    @summary: Get the supervisor state of the critical processes of the service
+    """
+    result = {'status': True, 'exited_critical_process': [], 'running_critical_process': []}
+    if not running:
+        result['status'] = False
+        return result
+
+    cmd = "docker exec %s bash -c '[ -f /etc/supervisor/critical_processes ] && " \
+          "cat /etc/supervisor/critical_processes; echo %s; supervisorctl status'" % (service, SEPARATOR)
+    _, out = run_cmd(cmd)
+    critical, _, status = out.partition(SEPARATOR)
+    critical_process_list = [name.strip() for name in critical.split()]
+    if len(critical_process_list) == 0:
+        return result
+
+    for line in status.splitlines():
+        fields = re.split(r"\s+", line.strip(), 2)
+        if len(fields) < 2:
+            continue
+        (pname, state) = fields[0:2]
+        if pname not in critical_process_list:
+            continue
+        if state != "RUNNING":
+            result['exited_critical_process'].append(pname)
+            result['status'] = False
+        else:
+            result['running_critical_process'].append(pname)
+    return result
+
+
+def get_processes_status(services_status):
+    """
+    @summary: Get the critical process status of all services in parallel
+    """
+    result = {}
+
+    def worker(service, running):
+        result[service] = get_process_status(service, running)
+
+    threads = [threading.Thread(target=worker, args=item) for item in services_status.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return result
+
+
+def get_admin_up_interfaces():
+    """
+    @summary: Get the admin up ports, port channel and vlan interfaces from persistent configuration
+    """
+    try:
+        with open(CONFIG_DB_FILE) as fp:
+            config = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return []
+    interfaces = [name for name, attrs in config.get("PORT", {}).items() if attrs.get("admin_status") == "up"]
+    for table in ["PORTCHANNEL_INTERFACE", "VLAN_INTERFACE"]:
+        for key in config.get(table, {}):
+            name = key.split("|")[0]
+            if name not in interfaces:
+                interfaces.append(name)
+    return interfaces
+
+
+def get_interfaces_status(interfaces):
+    """
+    @summary: Get the link and active state of the interfaces the same way as interface_facts
+    """
+    result = {}
+    down_ports = []
+    for intf in interfaces:
+        path = os.path.join("/sys/class/net", intf)
+        if not os.path.exists(path):
+            result[intf] = {"link": False, "active": False}
+            down_ports.append(intf)
+            continue
+        active = read_file(os.path.join(path, "operstate")) != "down"
+        link = read_file(os.path.join(path, "carrier")) == "1"
+        result[intf] = {"link": link, "active": active}
+        if not link or not active:
+            down_ports.append(intf)
+    return result, down_ports
+
+
+def get_dbmemory():
+    """
+    @summary: Get the total output buffer memory of the redis clients
+    """
+    _, out = run_cmd("/usr/bin/redis-cli client list")
+    lines = out.splitlines()
+    total_omem = 0
+    for line in lines:
+        match = re.search(r"omem=(\d+)", line)
+        if match:
+            total_omem += int(match.group(1))
+    return {"total_omem": total_omem, "client_list": lines}
+
+
+def get_uptime():
+    """
+    @summary: Get the system uptime and time since the networking service was started in seconds
+    """
+    uptime = float(read_file("/proc/uptime", "0").split()[0])
+    networking_uptime = None
+    _, out = run_cmd("systemctl show networking -p ExecMainStartTimestampMonotonic")
+    match = re.search(r"ExecMainStartTimestampMonotonic=(\d+)", out)
+    if match and int(match.group(1)) > 0:
+        networking_uptime = uptime - int(match.group(1)) / 1000000.0
+    return uptime, networking_uptime
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            services=dict(required=False, type='list', default=[]),
+            processes=dict(required=False, type='bool', default=True),
+            interfaces=dict(required=False, type='bool', default=True),
+            dbmemory=dict(required=False, type='bool', default=True),
+            crm=dict(required=False, type='bool', default=False),
+        ),
+        supports_check_mode=True)
+
+    params = module.params
+    snapshot = {}
+    try:
+        snapshot["uptime"], snapshot["networking_uptime"] = get_uptime()
+        snapshot["services"] = get_services_status(params["services"])
+        if params["processes"]:
+            snapshot["processes"] = get_processes_status(snapshot["services"])
+        if params["interfaces"]:
+            snapshot["interfaces"], snapshot["down_ports"] = get_interfaces_status(get_admin_up_interfaces())
+        if params["dbmemory"]:
+            snapshot["dbmemory"] = get_dbmemory()
+        if params["crm"]:
+            snapshot["crm"] = run_cmd("crm show resources all")[1].splitlines()
+    except Exception as e:
+        module.fail_json(msg="Failed to collect health snapshot, err=%s" % str(e))
+
+    module.exit_json(ansible_facts={'health_snapshot': snapshot})
+
+
+if __name__ == '__main__':
+    main()
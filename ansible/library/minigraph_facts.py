@@ -6,6 +6,9 @@ import socket
 import struct
 import json
 import copy
+import marshal
+import hashlib
+import tempfile
 import ipaddr as ipaddress
 from collections import defaultdict
 from natsort import natsorted
@@ -28,6 +31,16 @@ options:
         description:
             - Set to target snmp server (normally {{inventory_hostname}})
         required: true
+    filename:
+        description:
+            - The minigraph file to parse
+        required: false
+    cache:
+        description:
+            - Reuse the facts parsed from the same minigraph file, the parsed facts are cached
+              in ANSIBLE_USER_MINIGRAPH_PATH keyed by file path, mtime and content hash
+        required: false
+        default: true
 '''
 
 EXAMPLES = '''
@@ -44,6 +57,10 @@ ns3 = "http://www.w3.org/2001/XMLSchema-instance"
 ANSIBLE_USER_MINIGRAPH_PATH = os.path.expanduser('~/.ansible/minigraph')
 ANSIBLE_LOCAL_MINIGRAPH_PATH = '{}.xml'
 ANSIBLE_USER_MINIGRAPH_MAX_AGE = 86400  # 24-hours (in seconds)
+# Bump the version when the parsed facts change, cached facts of other versions are ignored
+MINIGRAPH_FACTS_CACHE_VERSION = 1
+# Top level sections of the minigraph used by the parsers, the others are dropped while parsing
+MINIGRAPH_SECTIONS = ["DpgDec", "CpgDec", "PngDec", "UngDec", "MetadataDeclaration", "Hostname", "HwSku"]
 
 class minigraph_encoder(json.JSONEncoder):
     def default(self, obj):
@@ -387,17 +404,103 @@ def reconcile_mini_graph_locations(filename, hostname):
 
     :param filename: the filename to load (may be None)
     :param hostname: the hostname to load (required)
-    :return: tuple(the absolute filepath of the {cached,loaded} mini-graph, the root node of the loaded graph)
+    :return: tuple(the absolute filepath of the {cached,loaded} mini-graph, the top level sections of the loaded graph)
     """
+    mini_graph_path = get_mini_graph_path(filename)
+    root = load_mini_graph(mini_graph_path)
+    return mini_graph_path, root
+
+
+def get_mini_graph_path(filename):
     if filename is not None:
         # literal filename specified. read directly from the file.
-        mini_graph_path = filename
-    else:
-        # only the hostname was specified, determine the output path
-        mini_graph_path = '/etc/sonic/minigraph.xml'
+        return filename
+    # only the hostname was specified, determine the output path
+    return '/etc/sonic/minigraph.xml'
 
-    root = ET.parse(mini_graph_path).getroot()
-    return mini_graph_path, root
+
+def load_mini_graph(mini_graph_path):
+    """
+    Parse the minigraph in a single pass. Only the top level sections used by the parsers
+    are kept, the other sections are cleared as soon as they are parsed.
+
+    :param mini_graph_path: the minigraph file to load
+    :return: list of the top level sections of the graph
+    """
+    keep = set(str(QName(ns, tag)) for tag in MINIGRAPH_SECTIONS)
+    sections = []
+    depth = 0
+    for event, elem in ET.iterparse(mini_graph_path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag in keep:
+            sections.append(elem)
+        else:
+            elem.clear()
+    return sections
+
+
+def file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def facts_cache_file(mini_graph_path):
+    mini_graph_path = os.path.abspath(mini_graph_path)
+    key = hashlib.sha1(mini_graph_path).hexdigest()[:16]
+    return os.path.join(ANSIBLE_USER_MINIGRAPH_PATH, '{}.{}.facts'.format(os.path.basename(mini_graph_path), key))
+
+
+def load_cached_facts(mini_graph_path):
+    """
+    :param mini_graph_path: the minigraph file
+    :return: tuple(the cached facts or None, sha1 of the minigraph if it was computed)
+    """
+    try:
+        stat = os.stat(mini_graph_path)
+        with open(facts_cache_file(mini_graph_path), 'rb') as fp:
+            entry = marshal.load(fp)
+        if entry['version'] != MINIGRAPH_FACTS_CACHE_VERSION:
+            return None, None
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return None, None
+
+    if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+        return entry['facts'], None
+
+    # the file was touched or copied, reuse the facts if the content is the same
+    sha1 = file_sha1(mini_graph_path)
+    if entry['sha1'] != sha1:
+        return None, sha1
+    save_cached_facts(mini_graph_path, entry['facts'], sha1)
+    return entry['facts'], sha1
+
+
+def save_cached_facts(mini_graph_path, facts, sha1=None):
+    try:
+        stat = os.stat(mini_graph_path)
+        entry = {
+            'version': MINIGRAPH_FACTS_CACHE_VERSION,
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'sha1': sha1 or file_sha1(mini_graph_path),
+            'facts': facts,
+        }
+        cache_file = facts_cache_file(mini_graph_path)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, 'wb') as fp:
+            marshal.dump(entry, fp)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError, ValueError):
+        # caching is an optimization only
+        pass
 
 def port_alias_to_name_map_50G(all_ports, s100G_ports):
     # 50G ports
@@ -634,6 +737,7 @@ def main():
         argument_spec=dict(
             host=dict(required=True),
             filename=dict(),
+            cache=dict(required=False, type='bool', default=True),
         ),
         supports_check_mode=True
     )
@@ -659,8 +763,15 @@ def main():
         filename = None
 
     try:
-        results = parse_xml(filename, m_args['host'])
-        results_clean = json.loads(json.dumps(results, cls=minigraph_encoder))
+        mini_graph_path = get_mini_graph_path(filename)
+        results_clean, sha1 = None, None
+        if m_args['cache']:
+            results_clean, sha1 = load_cached_facts(mini_graph_path)
+        if results_clean is None:
+            results = parse_xml(filename, m_args['host'])
+            results_clean = json.loads(json.dumps(results, cls=minigraph_encoder))
+            if m_args['cache']:
+                save_cached_facts(mini_graph_path, results_clean, sha1)
         module.exit_json(ansible_facts=results_clean)
     except Exception as e:
         # all attempts to find a minigraph failed.
@@ -77,6 +77,17 @@ options:
         description:
             - Encryption key, required if version is authPriv
         required: false
+    max_repetitions:
+        description:
+            - Number of rows requested by each GETBULK request of the table walks,
+              0 walks the tables with GETNEXT requests
+        required: false
+        default: 25
+    parallel:
+        description:
+            - Walk the independent tables concurrently
+        required: false
+        default: true
 '''
 
 EXAMPLES = '''
@@ -93,6 +104,9 @@ EXAMPLES = '''
     username=snmp-user
     authkey=abc12345
     privkey=def6789
+
+# Gather facts with SNMP version 2, walk the tables one after the other with GETNEXT
+- snmp_facts: host={{ inventory_hostname }} version=2c community=public max_repetitions=0 parallel=no
 '''
 
 from ansible.module_utils.basic import *
@@ -106,6 +120,9 @@ try:
 except:
     has_pysnmp = False
 
+# Rows requested by each GETBULK request of the table walks
+DEFAULT_MAX_REPETITIONS = 25
+
 class DefineOid(object):
 
     def __init__(self,dotprefix=False):
@@ -281,6 +298,59 @@ def decode_type(module, current_oid, val):
 
     return pyVal
 
+def walk_tables(snmp_auth, target, tables, max_repetitions=DEFAULT_MAX_REPETITIONS, parallel=True):
+    """
+    Walk the columns of the tables with GETBULK requests, or with GETNEXT requests
+    if max_repetitions is 0. The tables are lists of column OIDs without the dot
+    prefix. The walks are independent, with parallel they are all in flight at
+    once on one SNMP engine, otherwise the tables are walked one after the other.
+
+    Returns a list of (errorIndication, rows) in the order of the tables, rows is
+    a list of (column position, row index, value) in the order of the walk, the
+    row index is the tuple of the OID sub-identifiers following the column OID.
+    """
+    cmdGen = cmdgen.AsynCommandGenerator()
+    walks = []
+
+    def cbFun(sendRequestHandle, errorIndication, errorStatus, errorIndex, varBindTable, walk):
+        if errorIndication:
+            walk['error'] = errorIndication
+            return False
+        if errorStatus:
+            return False
+        columns, active, rows = walk['columns'], walk['active'], walk['rows']
+        for varBinds in varBindTable:
+            for col, (oid, val) in enumerate(varBinds):
+                if not active[col]:
+                    continue
+                # A column is done when the walk leaves its subtree, the other
+                # columns of the table may still have rows
+                if isinstance(val, univ.Null) or not columns[col].isPrefixOf(oid):
+                    active[col] = False
+                    continue
+                rows.append((col, oid.asTuple()[len(columns[col]):], val))
+        return any(active)
+
+    for table in tables:
+        walk = {
+            'columns': [univ.ObjectIdentifier(column) for column in table],
+            'active': [True] * len(table),
+            'rows': [],
+            'error': None,
+        }
+        walks.append(walk)
+        varNames = [cmdgen.MibVariable(column,) for column in table]
+        if max_repetitions > 0:
+            cmdGen.asyncBulkCmd(snmp_auth, target, 0, max_repetitions, varNames, (cbFun, walk))
+        else:
+            cmdGen.asyncNextCmd(snmp_auth, target, varNames, (cbFun, walk))
+        if not parallel:
+            cmdGen.snmpEngine.transportDispatcher.runDispatcher()
+
+    cmdGen.snmpEngine.transportDispatcher.runDispatcher()
+
+    return [(walk['error'], walk['rows']) for walk in walks]
+
 
 def main():
     module = AnsibleModule(
@@ -296,6 +366,8 @@ def main():
             privkey=dict(required=False),
             is_dell=dict(required=False, default=False, type='bool'),
             is_eos=dict(required=False, default=False, type='bool'),
+            max_repetitions=dict(required=False, default=DEFAULT_MAX_REPETITIONS, type='int'),
+            parallel=dict(required=False, default=True, type='bool'),
             removeplaceholder=dict(required=False)),
             required_together = ( ['username','level','integrity','authkey'],['privacy','privkey'],),
         supports_check_mode=False)
@@ -396,199 +468,141 @@ def main():
         elif current_oid == v.sysLocation:
             results['ansible_syslocation'] = current_val
 
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.ifIndex,),
-        cmdgen.MibVariable(p.ifDescr,),
-        cmdgen.MibVariable(p.ifMtu,),
-        cmdgen.MibVariable(p.ifSpeed,),
-        cmdgen.MibVariable(p.ifPhysAddress,),
-        cmdgen.MibVariable(p.ifAdminStatus,),
-        cmdgen.MibVariable(p.ifOperStatus,),
-        cmdgen.MibVariable(p.ipAdEntAddr,),
-        cmdgen.MibVariable(p.ipAdEntIfIndex,),
-        cmdgen.MibVariable(p.ipAdEntNetMask,),
-        cmdgen.MibVariable(p.ifAlias,),
-        lookupMib=False, lexicographicMode=False
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying interface details')
+    def column(table, key, convert=None, position=-1):
+        # Store the column value of the row at results[table][<row index>][key],
+        # the row index is the OID sub-identifier at position
+        def handler(index, current_val):
+            results[table][int(index[position])][key] = convert(current_val) if convert else current_val
+        return handler
 
-    interface_indexes = []
+    def lldp_column(key):
+        def handler(index, current_val):
+            results['snmp_lldp'][key] = current_val
+        return handler
 
     all_ipv4_addresses = []
     ipv4_networks = Tree()
 
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.ifIndex in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifindex'] = current_val
-                interface_indexes.append(ifIndex)
-            if v.ifDescr in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['name'] = current_val
-            if v.ifMtu in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['mtu'] = current_val
-            if v.ifSpeed in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['speed'] = current_val
-            if v.ifPhysAddress in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['mac'] = decode_mac(current_val)
-            if v.ifAdminStatus in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['adminstatus'] = lookup_adminstatus(int(current_val))
-            if v.ifOperStatus in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['operstatus'] = lookup_operstatus(int(current_val))
-            if v.ipAdEntAddr in current_oid:
-                curIPList = current_oid.rsplit('.', 4)[-4:]
-                curIP = ".".join(curIPList)
-                ipv4_networks[curIP]['address'] = current_val
+    def ipv4_column(key):
+        def handler(index, current_val):
+            curIP = ".".join(str(sub_id) for sub_id in index[-4:])
+            ipv4_networks[curIP][key] = current_val
+            if key == 'address':
                 all_ipv4_addresses.append(current_val)
-            if v.ipAdEntIfIndex in current_oid:
-                curIPList = current_oid.rsplit('.', 4)[-4:]
-                curIP = ".".join(curIPList)
-                ipv4_networks[curIP]['interface'] = current_val
-            if v.ipAdEntNetMask in current_oid:
-                curIPList = current_oid.rsplit('.', 4)[-4:]
-                curIP = ".".join(curIPList)
-                ipv4_networks[curIP]['netmask'] = current_val
-            if v.ifAlias in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['description'] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.ifInDiscards,),
-        cmdgen.MibVariable(p.ifOutDiscards,),
-        cmdgen.MibVariable(p.ifInErrors,),
-        cmdgen.MibVariable(p.ifOutErrors,),
-        cmdgen.MibVariable(p.ifHCInOctets,),
-        cmdgen.MibVariable(p.ifHCOutOctets,),
-        cmdgen.MibVariable(p.ifInUcastPkts,),
-        cmdgen.MibVariable(p.ifOutUcastPkts,),
-        lookupMib=False, lexicographicMode=False
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying interface counters')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.ifInDiscards in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifInDiscards'] = current_val
-            if v.ifOutDiscards in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifOutDiscards'] = current_val
-            if v.ifInErrors in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifInErrors'] = current_val
-            if v.ifOutErrors in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifOutErrors'] = current_val
-            if v.ifHCInOctets in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifHCInOctets'] = current_val
-            if v.ifHCOutOctets in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifHCOutOctets'] = current_val
-            if v.ifInUcastPkts in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifInUcastPkts'] = current_val
-            if v.ifOutUcastPkts in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['ifOutUcastPkts'] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.entPhysDescr,),
-        cmdgen.MibVariable(p.entPhysClass,),
-        cmdgen.MibVariable(p.entPhysName,),
-        cmdgen.MibVariable(p.entPhysHwVer,),
-        cmdgen.MibVariable(p.entPhysFwVer,),
-        cmdgen.MibVariable(p.entPhysSwVer,),
-        cmdgen.MibVariable(p.entPhysSerialNum,),
-        cmdgen.MibVariable(p.entPhysMfgName,),
-        cmdgen.MibVariable(p.entPhysModelName,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying physical table')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.entPhysDescr in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysDescr'] = current_val
-            if v.entPhysClass in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysClass'] = int(current_val)
-            if v.entPhysName in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysName'] = current_val
-            if v.entPhysHwVer in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysHwVer'] = current_val
-            if v.entPhysFwVer in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysFwVer'] = current_val
-            if v.entPhysSwVer in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysSwVer'] = current_val
-            if v.entPhysMfgName in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysMfgName'] = current_val
-            if v.entPhysModelName in current_oid:
-                entity_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_physical_entities'][entity_oid]['entPhysModelName'] = current_val 
-
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.entPhySensorType,),
-        cmdgen.MibVariable(p.entPhySensorScale,),
-        cmdgen.MibVariable(p.entPhySensorPrecision,),
-        cmdgen.MibVariable(p.entPhySensorValue,),
-        cmdgen.MibVariable(p.entPhySensorOperStatus,),
-    )
+        return handler
+
+    def priority_column(key):
+        def handler(index, current_val):
+            results['snmp_interfaces'][int(index[-2])][key][int(index[-1])] = current_val
+        return handler
+
+    def queue_column(index, current_val):
+        ifIndex, ifDirection, queueId, counterId = [int(sub_id) for sub_id in index[-4:]]
+        results['snmp_interfaces'][ifIndex]['queues'][ifDirection][queueId][counterId] = current_val
+
+    # Independent tables, each one is walked with its columns in the same requests.
+    # The values are dispatched to the handlers by the position of the column.
+    tables = [
+        (' querying interface details', [
+            (v.ifIndex,         column('snmp_interfaces', 'ifindex')),
+            (v.ifDescr,         column('snmp_interfaces', 'name')),
+            (v.ifMtu,           column('snmp_interfaces', 'mtu')),
+            (v.ifSpeed,         column('snmp_interfaces', 'speed')),
+            (v.ifPhysAddress,   column('snmp_interfaces', 'mac', decode_mac)),
+            (v.ifAdminStatus,   column('snmp_interfaces', 'adminstatus', lambda val: lookup_adminstatus(int(val)))),
+            (v.ifOperStatus,    column('snmp_interfaces', 'operstatus', lambda val: lookup_operstatus(int(val)))),
+        ]),
+        (' querying interface details', [
+            (v.ipAdEntAddr,     ipv4_column('address')),
+            (v.ipAdEntIfIndex,  ipv4_column('interface')),
+            (v.ipAdEntNetMask,  ipv4_column('netmask')),
+        ]),
+        (' querying interface details', [
+            (v.ifAlias,         column('snmp_interfaces', 'description')),
+        ]),
+        (' querying interface counters', [
+            (v.ifInDiscards,    column('snmp_interfaces', 'ifInDiscards')),
+            (v.ifOutDiscards,   column('snmp_interfaces', 'ifOutDiscards')),
+            (v.ifInErrors,      column('snmp_interfaces', 'ifInErrors')),
+            (v.ifOutErrors,     column('snmp_interfaces', 'ifOutErrors')),
+            (v.ifInUcastPkts,   column('snmp_interfaces', 'ifInUcastPkts')),
+            (v.ifOutUcastPkts,  column('snmp_interfaces', 'ifOutUcastPkts')),
+        ]),
+        (' querying interface counters', [
+            (v.ifHCInOctets,    column('snmp_interfaces', 'ifHCInOctets')),
+            (v.ifHCOutOctets,   column('snmp_interfaces', 'ifHCOutOctets')),
+        ]),
+        (' querying physical table', [
+            (v.entPhysDescr,     column('snmp_physical_entities', 'entPhysDescr')),
+            (v.entPhysClass,     column('snmp_physical_entities', 'entPhysClass', int)),
+            (v.entPhysName,      column('snmp_physical_entities', 'entPhysName')),
+            (v.entPhysHwVer,     column('snmp_physical_entities', 'entPhysHwVer')),
+            (v.entPhysFwVer,     column('snmp_physical_entities', 'entPhysFwVer')),
+            (v.entPhysSwVer,     column('snmp_physical_entities', 'entPhysSwVer')),
+            (v.entPhysMfgName,   column('snmp_physical_entities', 'entPhysMfgName')),
+            (v.entPhysModelName, column('snmp_physical_entities', 'entPhysModelName')),
+        ]),
+        (' querying physical table', [
+            (v.entPhySensorType,       column('snmp_sensors', 'entPhySensorType')),
+            (v.entPhySensorScale,      column('snmp_sensors', 'entPhySensorScale', int)),
+            (v.entPhySensorPrecision,  column('snmp_sensors', 'entPhySensorPrecision')),
+            (v.entPhySensorValue,      column('snmp_sensors', 'entPhySensorValue')),
+            (v.entPhySensorOperStatus, column('snmp_sensors', 'entPhySensorOperStatus')),
+        ]),
+        (' querying lldpLocPortTable counters', [
+            (v.lldpLocPortIdSubtype, column('snmp_interfaces', 'lldpLocPortIdSubtype')),
+            (v.lldpLocPortId,        column('snmp_interfaces', 'lldpLocPortId')),
+            (v.lldpLocPortDesc,      column('snmp_interfaces', 'lldpLocPortDesc')),
+        ]),
+        (' querying lldpLocPortTable counters', [
+            (v.lldpLocManAddrLen,       lldp_column('lldpLocManAddrLen')),
+            (v.lldpLocManAddrIfSubtype, lldp_column('lldpLocManAddrIfSubtype')),
+            (v.lldpLocManAddrIfId,      lldp_column('lldpLocManAddrIfId')),
+            (v.lldpLocManAddrOID,       lldp_column('lldpLocManAddrOID')),
+        ]),
+        # The index of lldpRemTable and lldpRemManAddrTable is .time mark + .ifindex + ...
+        (' querying lldpLocPortTable counters', [
+            (v.lldpRemChassisIdSubtype, column('snmp_interfaces', 'lldpRemChassisIdSubtype', position=1)),
+            (v.lldpRemChassisId,        column('snmp_interfaces', 'lldpRemChassisId', position=1)),
+            (v.lldpRemPortIdSubtype,    column('snmp_interfaces', 'lldpRemPortIdSubtype', position=1)),
+            (v.lldpRemPortId,           column('snmp_interfaces', 'lldpRemPortId', position=1)),
+            (v.lldpRemPortDesc,         column('snmp_interfaces', 'lldpRemPortDesc', position=1)),
+            (v.lldpRemSysName,          column('snmp_interfaces', 'lldpRemSysName', position=1)),
+            (v.lldpRemSysDesc,          column('snmp_interfaces', 'lldpRemSysDesc', position=1)),
+            (v.lldpRemSysCapSupported,  column('snmp_interfaces', 'lldpRemSysCapSupported', position=1)),
+            (v.lldpRemSysCapEnabled,    column('snmp_interfaces', 'lldpRemSysCapEnabled', position=1)),
+        ]),
+        (' querying lldpLocPortTable counters', [
+            (v.lldpRemManAddrIfSubtype, column('snmp_interfaces', 'lldpRemManAddrIfSubtype', position=1)),
+            (v.lldpRemManAddrIfId,      column('snmp_interfaces', 'lldpRemManAddrIfId', position=1)),
+            (v.lldpRemManAddrOID,       column('snmp_interfaces', 'lldpRemManAddrOID', position=1)),
+        ]),
+        (' querying PFC counters', [
+            (v.cpfcIfRequests,    column('snmp_interfaces', 'cpfcIfRequests')),
+            (v.cpfcIfIndications, column('snmp_interfaces', 'cpfcIfIndications')),
+        ]),
+        (' querying PFC counters', [
+            (v.requestsPerPriority,    priority_column('requestsPerPriority')),
+            (v.indicationsPerPriority, priority_column('indicationsPerPriority')),
+        ]),
+        (' querying QoS stats', [
+            (v.csqIfQosGroupStats, queue_column),
+        ]),
+        (' querying FRU', [
+            (v.cefcFRUPowerOperStatus, column('snmp_psu', 'operstatus')),
+        ]),
+    ]
+
+    walked = walk_tables(snmp_auth, cmdgen.UdpTransportTarget((m_args['host'], 161)),
+                         [[oid for oid, _ in columns] for _, columns in tables],
+                         max_repetitions=m_args['max_repetitions'], parallel=m_args['parallel'])
+
+    for (query, columns), (errorIndication, rows) in zip(tables, walked):
+        if errorIndication:
+            module.fail_json(msg=str(errorIndication) + query)
 
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying physical table')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.entPhySensorType in current_oid:
-                sensor_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_sensors'][sensor_oid]['entPhySensorType'] = current_val
-            if v.entPhySensorScale in current_oid:
-                sensor_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_sensors'][sensor_oid]['entPhySensorScale'] = int(current_val)
-            if v.entPhySensorPrecision in current_oid:
-                sensor_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_sensors'][sensor_oid]['entPhySensorPrecision'] = current_val
-            if v.entPhySensorValue in current_oid:
-                sensor_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_sensors'][sensor_oid]['entPhySensorValue'] = current_val
-            if v.entPhySensorOperStatus in current_oid:
-                sensor_oid = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_sensors'][sensor_oid]['entPhySensorOperStatus'] = current_val
+        for col, index, val in rows:
+            columns[col][1](index, val.prettyPrint())
 
     interface_to_ipv4 = {}
     for ipv4_network in ipv4_networks:
@@ -649,205 +663,6 @@ def main():
         elif current_oid == v.lldpLocSysDesc:
             results['snmp_lldp']['lldpLocSysDesc'] = current_val
 
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.lldpLocPortIdSubtype,),
-        cmdgen.MibVariable(p.lldpLocPortId,),
-        cmdgen.MibVariable(p.lldpLocPortDesc,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying lldpLocPortTable counters')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.lldpLocPortIdSubtype in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['lldpLocPortIdSubtype'] = current_val
-            if v.lldpLocPortId in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['lldpLocPortId'] = current_val
-            if v.lldpLocPortDesc in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['lldpLocPortDesc'] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.lldpLocManAddrLen,),
-        cmdgen.MibVariable(p.lldpLocManAddrIfSubtype,),
-        cmdgen.MibVariable(p.lldpLocManAddrIfId,),
-        cmdgen.MibVariable(p.lldpLocManAddrOID,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying lldpLocPortTable counters')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.lldpLocManAddrLen in current_oid:
-                address = '.'.join(current_oid.split('.')[13:])
-                results['snmp_lldp']['lldpLocManAddrLen'] = current_val
-            if v.lldpLocManAddrIfSubtype in current_oid:
-                address = '.'.join(current_oid.split('.')[13:])
-                results['snmp_lldp']['lldpLocManAddrIfSubtype'] = current_val
-            if v.lldpLocManAddrIfId in current_oid:
-                address = '.'.join(current_oid.split('.')[13:])
-                results['snmp_lldp']['lldpLocManAddrIfId'] = current_val
-            if v.lldpLocManAddrOID in current_oid:
-                address = '.'.join(current_oid.split('.')[13:])
-                results['snmp_lldp']['lldpLocManAddrOID'] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.lldpRemChassisIdSubtype,),
-        cmdgen.MibVariable(p.lldpRemChassisId,),
-        cmdgen.MibVariable(p.lldpRemPortIdSubtype,),
-        cmdgen.MibVariable(p.lldpRemPortId,),
-        cmdgen.MibVariable(p.lldpRemPortDesc,),
-        cmdgen.MibVariable(p.lldpRemSysName,),
-        cmdgen.MibVariable(p.lldpRemSysDesc,),
-        cmdgen.MibVariable(p.lldpRemSysCapSupported,),
-        cmdgen.MibVariable(p.lldpRemSysCapEnabled,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying lldpLocPortTable counters')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.lldpRemChassisIdSubtype in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemChassisIdSubtype'] = current_val
-            if v.lldpRemChassisId in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemChassisId'] = current_val
-            if v.lldpRemPortIdSubtype in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemPortIdSubtype'] = current_val
-            if v.lldpRemPortId in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemPortId'] = current_val
-            if v.lldpRemPortDesc in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemPortDesc'] = current_val
-            if v.lldpRemSysName in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemSysName'] = current_val
-            if v.lldpRemSysDesc in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemSysDesc'] = current_val
-            if v.lldpRemSysCapSupported in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemSysCapSupported'] = current_val
-            if v.lldpRemSysCapEnabled in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                results['snmp_interfaces'][ifIndex]['lldpRemSysCapEnabled'] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.lldpRemManAddrIfSubtype,),
-        cmdgen.MibVariable(p.lldpRemManAddrIfId,),
-        cmdgen.MibVariable(p.lldpRemManAddrOID,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying lldpLocPortTable counters')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.lldpRemManAddrIfSubtype in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                address = '.'.join(current_oid.split('.')[16:])
-                results['snmp_interfaces'][ifIndex]['lldpRemManAddrIfSubtype'] = current_val
-            if v.lldpRemManAddrIfId in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                address = '.'.join(current_oid.split('.')[16:])
-                results['snmp_interfaces'][ifIndex]['lldpRemManAddrIfId'] = current_val
-            if v.lldpRemManAddrOID in current_oid:
-                ifIndex = int(current_oid.split('.')[12])
-                address = '.'.join(current_oid.split('.')[16:])
-                results['snmp_interfaces'][ifIndex]['lldpRemManAddrOID'] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.cpfcIfRequests,),
-        cmdgen.MibVariable(p.cpfcIfIndications,),
-        cmdgen.MibVariable(p.requestsPerPriority,),
-        cmdgen.MibVariable(p.indicationsPerPriority,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying PFC counters')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.cpfcIfRequests in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['cpfcIfRequests'] = current_val
-            if v.cpfcIfIndications in current_oid:
-                ifIndex = int(current_oid.rsplit('.', 1)[-1])
-                results['snmp_interfaces'][ifIndex]['cpfcIfIndications'] = current_val
-            if v.requestsPerPriority in current_oid:
-                ifIndex = int(current_oid.split('.')[-2])
-                prio = int(current_oid.split('.')[-1])
-                results['snmp_interfaces'][ifIndex]['requestsPerPriority'][prio] = current_val
-            if v.indicationsPerPriority in current_oid:
-                ifIndex = int(current_oid.split('.')[-2])
-                prio = int(current_oid.split('.')[-1])
-                results['snmp_interfaces'][ifIndex]['indicationsPerPriority'][prio] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.csqIfQosGroupStats,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying QoS stats')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.csqIfQosGroupStats in current_oid:
-                ifIndex = int(current_oid.split('.')[-4])
-                ifDirection = int(current_oid.split('.')[-3])
-                queueId = int(current_oid.split('.')[-2])
-                counterId = int(current_oid.split('.')[-1])
-                results['snmp_interfaces'][ifIndex]['queues'][ifDirection][queueId][counterId] = current_val
-
-    errorIndication, errorStatus, errorIndex, varTable = cmdGen.nextCmd(
-        snmp_auth,
-        cmdgen.UdpTransportTarget((m_args['host'], 161)),
-        cmdgen.MibVariable(p.cefcFRUPowerOperStatus,),
-    )
-
-    if errorIndication:
-        module.fail_json(msg=str(errorIndication) + ' querying FRU')
-
-    for varBinds in varTable:
-        for oid, val in varBinds:
-            current_oid = oid.prettyPrint()
-            current_val = val.prettyPrint()
-            if v.cefcFRUPowerOperStatus in current_oid:
-                psuIndex = int(current_oid.split('.')[-1])
-                results['snmp_psu'][psuIndex]['operstatus'] = current_val
-
     if not m_args['is_eos']:
         errorIndication, errorStatus, errorIndex, varBinds = cmdGen.getCmd(
             snmp_auth,
@@ -870,4 +685,5 @@ def main():
 
     module.exit_json(ansible_facts=results)
 
-main()
+if __name__ == "__main__":
+    main()
@@ -16,9 +16,14 @@ Usage:          Examples of how to use log analyzer
 #---------------------------------------------------------------------
 # Global imports
 #---------------------------------------------------------------------
+import os
 import sys
+import time
+import json
 import getopt
 import re
+import sre_parse
+import sre_constants
 import csv
 import pprint
 import logging
@@ -31,6 +36,8 @@ from __builtin__ import True
 tokenizer = ','
 comment_key = '#'
 system_log_file = '/var/log/syslog'
+log_offset_dir = '/tmp'
+end_marker_timeout = 10
 
 #-- List of ERROR codes to be returned by AnsibleLogAnalyzer
 err_duplicate_start_marker = -1
@@ -39,6 +46,101 @@ err_no_end_marker = -3
 err_no_start_marker = -4
 err_invalid_string_format = -5
 err_invalid_input = -6
+err_no_log_offset = -7
+
+#---------------------------------------------------------------------
+# Line matching
+#---------------------------------------------------------------------
+def required_literals(pattern):
+    '''
+    @summary: Find literal strings one of which appears in every string
+              matched by the parsed regular expression.
+
+    @param pattern: sre_parse.SubPattern of the regular expression.
+
+    @return: List of literal strings or None if no literal is required.
+    '''
+    candidates = []
+    run = []
+    for op, av in list(pattern) + [(None, None)]:
+        # non ascii literals are left out to compare the same with str and unicode lines
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av))
+            continue
+        if run:
+            candidates.append([''.join(run)])
+        run = []
+        if op == sre_constants.SUBPATTERN:
+            # av is (group, pattern) or (group, add_flags, del_flags, pattern)
+            if len(av) == 4 and av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+                continue
+            candidates.append(required_literals(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] > 0:
+            candidates.append(required_literals(av[2]))
+        elif op == sre_constants.BRANCH:
+            alternatives = []
+            for branch in av[1]:
+                literals = required_literals(branch)
+                if not literals:
+                    alternatives = None
+                    break
+                alternatives.extend(literals)
+            candidates.append(alternatives)
+    # prefer the literals which are least likely to appear by chance
+    candidates = [literals for literals in candidates if literals]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda literals: min([len(literal) for literal in literals]))
+
+
+class LineMatcher:
+    '''
+    @summary: Regular expression with a literal substring prefilter.
+
+    Lines which contain none of the literals required by the expression
+    can not match it, so the regular expression is run only on lines
+    which pass the substring check.
+    '''
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.literals = None
+        if regex is None or regex.flags & re.IGNORECASE:
+            return
+        try:
+            self.literals = required_literals(sre_parse.parse(regex.pattern, regex.flags))
+        except Exception:
+            self.literals = None
+
+    def search(self, line):
+        if self.regex is None:
+            return False
+        if self.literals is not None and not any(map(line.__contains__, self.literals)):
+            return False
+        return self.regex.search(line) is not None
+
+
+class LogMatcher:
+    '''
+    @summary: Classify log lines against the match, ignore and expect rules
+              in one step. Expected lines are not reported as matches and
+              matching lines which are also ignored are not reported at all.
+    '''
+
+    EXPECTED = 'expect'
+    MATCHED = 'match'
+
+    def __init__(self, match_messages_regex, ignore_messages_regex, expect_messages_regex):
+        self.match = LineMatcher(match_messages_regex)
+        self.ignore = LineMatcher(ignore_messages_regex)
+        self.expect = LineMatcher(expect_messages_regex)
+
+    def classify(self, line):
+        if self.expect.search(line):
+            return self.EXPECTED
+        if self.match.search(line) and not self.ignore.search(line):
+            return self.MATCHED
+        return None
 
 class AnsibleLogAnalyzer:
     '''
@@ -133,6 +235,107 @@ class AnsibleLogAnalyzer:
         syslogger.info(marker)
         syslogger.info('\n')
 
+    def log_offset_file(self):
+        return os.path.join(log_offset_dir, 'loganalyzer.%s.offset' % self.run_id)
+
+    def record_log_offset(self, log_file=system_log_file):
+        '''
+        @summary: Save the inode and the size of the log file before the start
+                  marker is placed, so that extract_new_log() reads only the
+                  bytes written after it.
+        @param log_file: File path of the log file.
+        '''
+        try:
+            stat = os.stat(log_file)
+            state = {'file': log_file, 'inode': stat.st_ino, 'offset': stat.st_size}
+            self.print_diagnostic_message('log offset: %s' % state)
+            with open(self.log_offset_file(), 'w') as fp:
+                json.dump(state, fp)
+        except (IOError, OSError) as e:
+            # extract action reports missing offset and the caller falls back
+            self.print_diagnostic_message('failed to record log offset: %s' % repr(e))
+
+    def find_log_chain(self, log_file, inode):
+        '''
+        @summary: Find the log files written since the file with given inode was
+                  the current log file. Rotated files are named <log_file>.N
+                  where greater N is older. Compressed files are not searched.
+        @param log_file: File path of the current log file.
+        @param inode: Inode of the log file when the offset was recorded.
+        @return: List of (path, inode) from the oldest to the current log file
+                 or None if the file with the inode is not found.
+        '''
+        chain = [(log_file, os.stat(log_file).st_ino)]
+        if chain[0][1] == inode:
+            return chain
+        directory, prefix = os.path.split(log_file)
+        rotated = []
+        for name in os.listdir(directory):
+            suffix = name[len(prefix) + 1:]
+            if name.startswith(prefix + '.') and suffix.isdigit():
+                rotated.append((int(suffix), os.path.join(directory, name)))
+        for _, path in sorted(rotated):
+            chain.insert(0, (path, os.stat(path).st_ino))
+            if chain[0][1] == inode:
+                return chain
+        return None
+
+    def extract_new_log(self, target_file):
+        '''
+        @summary: Copy the log written since the offset recorded by
+                  record_log_offset() into the target file. The copy continues
+                  until the end marker is written or end_marker_timeout.
+        @param target_file: File path to store the extracted log.
+        @return: True if the log is extracted, False if the log was truncated
+                 or the rotated log file could not be found.
+        '''
+        offset_file = self.log_offset_file()
+        if not os.path.exists(offset_file):
+            self.print_diagnostic_message('log offset file %s not found' % offset_file)
+            return False
+        with open(offset_file) as fp:
+            state = json.load(fp)
+
+        end_marker = self.create_end_marker()
+        for _ in range(3):
+            chain = self.find_log_chain(state['file'], state['inode'])
+            if chain is None:
+                self.print_diagnostic_message('log file with inode %d not found' % state['inode'])
+                return False
+            files = [open(path, 'r') for path, _ in chain]
+            try:
+                # retry if the log was rotated after the files were listed
+                if [os.fstat(fp.fileno()).st_ino for fp in files] != [ino for _, ino in chain]:
+                    continue
+                if os.fstat(files[0].fileno()).st_size < state['offset']:
+                    self.print_diagnostic_message('log file %s is truncated' % chain[0][0])
+                    return False
+                files[0].seek(state['offset'])
+                found_end_marker = False
+                with open(target_file, 'w') as out_file:
+                    for fp in files:
+                        for line in fp:
+                            out_file.write(line)
+                            if line.find(end_marker) != -1:
+                                found_end_marker = True
+                    # the end marker goes through the syslog daemon and may not be written yet
+                    end = time.time() + end_marker_timeout
+                    while not found_end_marker and time.time() < end:
+                        line = files[-1].readline()
+                        if not line:
+                            time.sleep(0.1)
+                            continue
+                        out_file.write(line)
+                        if line.find(end_marker) != -1:
+                            found_end_marker = True
+                os.remove(offset_file)
+                return True
+            finally:
+                for fp in files:
+                    fp.close()
+        return False
+    #---------------------------------------------------------------------
+
     def place_marker(self, log_file_list, marker):
         '''
         @summary: Place marker into '/dev/log' and each log file specified.
@@ -292,6 +495,9 @@ class AnsibleLogAnalyzer:
         @summary: Analyze input file content for messages matching input regex
                   expressions. See line_matches() for details on matching criteria.
 
+                  The file is read once from the beginning, only the lines of the
+                  current range between start and end markers are kept.
+
         @param log_file_path: Patch to the log file.
 
         @param match_messages_regex:
@@ -303,22 +509,23 @@ class AnsibleLogAnalyzer:
         @param expect_messages_regex:
             regex class instance containing messages that are expected to appear in logfile.
 
-        @param end_marker_regex - end marker
-
-        @return: List of strings match search criteria.
+        @return: Lists of matching and expected strings in the file order.
         '''
 
-
         self.print_diagnostic_message('analyzing file: %s'% log_file_path)
 
-        #-- indicates whether log analyzer currently is in the log range between start
-        #-- and end marker. see analyze_file method.
-        in_analysis_range = False
         stdin_as_input = self.is_filename_stdin(log_file_path)
+        matcher = LogMatcher(match_messages_regex, ignore_messages_regex, expect_messages_regex)
         matching_lines = []
         expected_lines = []
+
+        #-- the analysis range starts at the last start marker and ends at
+        #-- the end marker following it
+        in_analysis_range = stdin_as_input
         found_start_marker = False
         found_end_marker = False
+        duplicate_end_marker = False
+
         if stdin_as_input:
             log_file = sys.stdin
         else:
@@ -327,39 +534,36 @@ class AnsibleLogAnalyzer:
         start_marker = self.create_start_marker()
         end_marker = self.create_end_marker()
 
-        for rev_line in reversed(log_file.readlines()):
-            if stdin_as_input:
-                in_analysis_range = True
-            else:
-                if rev_line.find(end_marker) != -1:
+        for line in log_file:
+            if not stdin_as_input:
+                if line.find(end_marker) != -1:
                     self.print_diagnostic_message('found end marker: %s' % end_marker)
-                    if (found_end_marker):
-                        print 'ERROR: duplicate end marker found'
-                        sys.exit(err_duplicate_end_marker)
+                    if found_end_marker:
+                        duplicate_end_marker = True
                     found_end_marker = True
-                    in_analysis_range = True
+                    in_analysis_range = False
                     continue
 
-            if not stdin_as_input:
-                if rev_line.find(start_marker) != -1 and 'nsible' not in rev_line:
+                if line.find(start_marker) != -1 and 'nsible' not in line:
                     self.print_diagnostic_message('found start marker: %s' % start_marker)
-                    if (found_start_marker):
-                        print 'ERROR: duplicate start marker found'
-                        sys.exit(err_duplicate_start_marker)
                     found_start_marker = True
+                    found_end_marker = False
+                    duplicate_end_marker = False
+                    in_analysis_range = True
+                    matching_lines = []
+                    expected_lines = []
+                    continue
 
-                    if(not in_analysis_range):
-                        print 'ERROR: found start marker:%s without corresponding end marker' % rev_line
-                        sys.exit(err_no_end_marker)
-                    in_analysis_range = False
-                    break
-
-            if in_analysis_range :
-                if self.line_is_expected(rev_line, expect_messages_regex):
-                    expected_lines.append(rev_line)
+            if in_analysis_range:
+                result = matcher.classify(line)
+                if result == LogMatcher.EXPECTED:
+                    expected_lines.append(line)
+                elif result == LogMatcher.MATCHED:
+                    self.print_diagnostic_message('matching line: %s' % line)
+                    matching_lines.append(line)
 
-                elif self.line_matches(rev_line, match_messages_regex, ignore_messages_regex):
-                    matching_lines.append(rev_line)
+        if not stdin_as_input:
+            log_file.close()
 
         # care about the markers only if input is not stdin
         if not stdin_as_input:
@@ -368,9 +572,13 @@ class AnsibleLogAnalyzer:
                 sys.exit(err_no_start_marker)
 
             if (not found_end_marker):
-                print 'ERROR: end marker was not found'
+                print 'ERROR: found start marker:%s without corresponding end marker' % start_marker
                 sys.exit(err_no_end_marker)
 
+            if duplicate_end_marker:
+                print 'ERROR: duplicate end marker found'
+                sys.exit(err_duplicate_end_marker)
+
         return matching_lines, expected_lines
     #---------------------------------------------------------------------
 
@@ -399,8 +607,6 @@ class AnsibleLogAnalyzer:
                 continue
             match_strings, expect_strings = self.analyze_file(log_file, match_messages_regex, ignore_messages_regex, expect_messages_regex)
 
-            match_strings.reverse()
-            expect_strings.reverse()
             res[log_file] = [ match_strings, expect_strings ]
 
         return res
@@ -415,6 +621,7 @@ def usage():
     print '                                 to all log files specified in --logs parameter.'
     print '                                 analyze - perform log analysis of files specified in --logs parameter.'
     print '                                 add_end_marker - add end marker to all log files specified in --logs parameter.'
+    print '                                 extract - copy system log written since init to --target_file.'
     print '--out_dir path                   Directory path where to place output files, '
     print '                                 must be present when --action == analyze'
     print '--logs path{,path}               List of full paths to log files to be analyzed.'
@@ -429,6 +636,7 @@ def usage():
     print '                                 A string from log file matching any string from these'
     print '                                 files will be ignored during analysis. Must be present'
     print '                                 when action == analyze.'
+    print '--target_file path               File path to store the system log extracted by extract action.'
     print '--expect_files_in path{,path}    List of path to files containing string. '
     print '                                 All the strings from these files will be expected to present'
     print '                                 in one of specified log files during the analysis. Must be present'
@@ -436,7 +644,7 @@ def usage():
 
 #---------------------------------------------------------------------
 
-def check_action(action, log_files_in, out_dir, match_files_in, ignore_files_in, expect_files_in):
+def check_action(action, log_files_in, out_dir, match_files_in, ignore_files_in, expect_files_in, target_file=None):
     '''
     @summary: This function validates command line parameter 'action' and
         other related parameters.
@@ -450,6 +658,10 @@ def check_action(action, log_files_in, out_dir, match_files_in, ignore_files_in,
         ret_code = True
     elif (action == 'add_end_marker'):
         ret_code = True
+    elif (action == 'extract'):
+        if target_file is None or len(target_file) == 0:
+            print 'ERROR: missing required target_file for extract action'
+            ret_code = False
     elif (action == 'analyze'):
         if out_dir is None or len(out_dir) == 0:
             print 'ERROR: missing required out_dir for analyze action'
@@ -586,10 +798,11 @@ def main(argv):
     match_files_in = None
     ignore_files_in = None
     expect_files_in = None
+    target_file = None
     verbose = False
 
     try:
-        opts, args = getopt.getopt(argv, "a:r:s:l:o:m:i:e:vh", ["action=", "run_id=", "start_marker=", "logs=", "out_dir=", "match_files_in=", "ignore_files_in=", "expect_files_in=", "verbose", "help"])
+        opts, args = getopt.getopt(argv, "a:r:s:l:o:m:i:e:t:vh", ["action=", "run_id=", "start_marker=", "logs=", "out_dir=", "match_files_in=", "ignore_files_in=", "expect_files_in=", "target_file=", "verbose", "help"])
 
     except getopt.GetoptError:
         print "Invalid option specified"
@@ -625,10 +838,13 @@ def main(argv):
         elif (opt in ("-e", "--expect_files_in")):
             expect_files_in = arg
 
+        elif (opt in ("-t", "--target_file")):
+            target_file = arg
+
         elif (opt in ("-v", "--verbose")):
             verbose = True
 
-    if not (check_action(action, log_files_in, out_dir, match_files_in, ignore_files_in, expect_files_in) and check_run_id(run_id)):
+    if not (check_action(action, log_files_in, out_dir, match_files_in, ignore_files_in, expect_files_in, target_file) and check_run_id(run_id)):
         usage()
         sys.exit(err_invalid_input)
 
@@ -638,8 +854,13 @@ def main(argv):
 
     result = {}
     if (action == "init"):
+        analyzer.record_log_offset()
         analyzer.place_marker(log_file_list, analyzer.create_start_marker())
         return 0
+    elif (action == "extract"):
+        if not analyzer.extract_new_log(target_file):
+            sys.exit(err_no_log_offset)
+        return 0
     elif (action == "analyze"):
         match_file_list = match_files_in.split(tokenizer)
         ignore_file_list = ignore_files_in.split(tokenizer)
@@ -5,10 +5,14 @@ import re
 import os
 import os.path
 import re
+import json
+import tempfile
+import threading
 import docker
 from ansible.module_utils.basic import *
 import traceback
 from pprint import pprint
+from multiprocessing.pool import ThreadPool
 
 DOCUMENTATION = '''
 ---
@@ -58,6 +62,8 @@ Parameters:
     - dut_fp_ports: dut ports
     - dut_mgmt_port: dut mgmt port
     - fp_mtu: MTU for FP ports
+    - ovs_batch: bind/unbind the ovs ports of all bridges with one ovs-vsctl transaction and
+                 program the flows of the bridges in parallel with 'ovs-ofctl replace-flows'
 '''
 
 EXAMPLES = '''
@@ -105,15 +111,18 @@ PTF_BP_IF_TEMPLATE = 'ptf-%s-b'
 ROOT_BACK_BR_TEMPLATE = 'br-b-%s'
 PTF_FP_IFACE_TEMPLATE = 'eth%d'
 RETRIES = 3
+OVS_FLOW_WORKERS = 16
 
 cmd_debug_fname = None
+cmd_debug_lock = threading.Lock()
 
 class VMTopology(object):
 
-    def __init__(self, vm_names, fp_mtu, max_fp_num):
+    def __init__(self, vm_names, fp_mtu, max_fp_num, ovs_batch=True):
         self.vm_names = vm_names
         self.fp_mtu = fp_mtu
         self.max_fp_num = max_fp_num
+        self.ovs_batch = ovs_batch
 
         self.host_ifaces = VMTopology.ifconfig('ifconfig -a')
 
@@ -358,20 +367,34 @@ class VMTopology(object):
         return
 
     def bind_fp_ports(self, disconnect_vm=False):
+        bindings = []
         for attr in self.VMs.itervalues():
             for vlan_num, vlan in enumerate(attr['vlans']):
                 injected_iface = INJECTED_INTERFACES_TEMPLATE % (self.vm_set_name, vlan)
                 br_name = OVS_FP_BRIDGE_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
                 vm_iface = OVS_FP_TAP_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
-                self.bind_ovs_ports(br_name, self.dut_fp_ports[vlan], injected_iface, vm_iface, disconnect_vm)
+                bindings.append((br_name, self.dut_fp_ports[vlan], injected_iface, vm_iface))
+
+        if self.ovs_batch:
+            self.bind_ovs_ports_batch(bindings, disconnect_vm)
+        else:
+            for br_name, dut_iface, injected_iface, vm_iface in bindings:
+                self.bind_ovs_ports(br_name, dut_iface, injected_iface, vm_iface, disconnect_vm)
 
         return
 
     def unbind_fp_ports(self):
+        bindings = []
         for attr in self.VMs.itervalues():
             for vlan_num, vlan in enumerate(attr['vlans']):
                 br_name = OVS_FP_BRIDGE_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
                 vm_iface = OVS_FP_TAP_TEMPLATE % (self.vm_names[self.vm_base_index + attr['vm_offset']], vlan_num)
+                bindings.append((br_name, vm_iface))
+
+        if self.ovs_batch:
+            self.unbind_ovs_ports_batch(bindings)
+        else:
+            for br_name, vm_iface in bindings:
                 self.unbind_ovs_ports(br_name, vm_iface)
 
         return
@@ -429,22 +452,53 @@ class VMTopology(object):
         # clear old bindings
         VMTopology.cmd('ovs-ofctl del-flows %s' % br_name)
 
-        if disconnect_vm:
-            # Drop packets from VM
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=drop" % (br_name, vm_iface_id))
-        else:
-            # Add flow from a VM to an external iface
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s" % (br_name, vm_iface_id, dut_iface_id))
+        for flow in VMTopology.get_fp_flows(dut_iface_id, injected_iface_id, vm_iface_id, disconnect_vm):
+            VMTopology.cmd("ovs-ofctl add-flow %s %s" % (br_name, flow))
 
-        if disconnect_vm:
-            # Add flow from external iface to ptf container
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s" % (br_name, dut_iface_id, injected_iface_id))
-        else:
-            # Add flow from external iface to a VM and a ptf container
-            VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s,%s" % (br_name, dut_iface_id, vm_iface_id, injected_iface_id))
+        return
 
-        # Add flow from a ptf container to an external iface
-        VMTopology.cmd("ovs-ofctl add-flow %s table=0,in_port=%s,action=output:%s" % (br_name, injected_iface_id, dut_iface_id))
+    def bind_ovs_ports_batch(self, bindings, disconnect_vm=False):
+        """bind dut/injected/vm ports of all the bridges with one ovs-vsctl transaction,
+           then replace the flows of the bridges in parallel"""
+        port_to_br = {}
+        for br, ports in VMTopology.get_ovs_bridges().items():
+            for port in ports:
+                port_to_br[port] = br
+
+        commands = []
+        for br_name, dut_iface, injected_iface, vm_iface in bindings:
+            for iface in (injected_iface, dut_iface):
+                br = port_to_br.get(iface)
+                if br is not None and br != br_name:
+                    commands.append('del-port %s %s' % (br, iface))
+                if br != br_name:
+                    commands.append('add-port %s %s' % (br_name, iface))
+        VMTopology.ovs_vsctl(commands)
+
+        ifaces = set()
+        for _, dut_iface, injected_iface, vm_iface in bindings:
+            ifaces.update([dut_iface, injected_iface, vm_iface])
+        ofports = VMTopology.get_ovs_ofports(ifaces)
+
+        def replace_flows(binding):
+            br_name, dut_iface, injected_iface, vm_iface = binding
+            flows = VMTopology.get_fp_flows(ofports[dut_iface], ofports[injected_iface], ofports[vm_iface], disconnect_vm)
+            VMTopology.ovs_replace_flows(br_name, flows)
+
+        VMTopology.run_parallel(replace_flows, bindings)
+
+        return
+
+    def unbind_ovs_ports_batch(self, bindings):
+        """unbind all ports except the vm port from the ovs bridges with one ovs-vsctl transaction"""
+        br_ports = VMTopology.get_ovs_bridges()
+
+        commands = []
+        for br_name, vm_port in bindings:
+            for port in sorted(br_ports.get(br_name, [])):
+                if port != vm_port:
+                    commands.append('del-port %s %s' % (br_name, port))
+        VMTopology.ovs_vsctl(commands)
 
         return
 
@@ -505,8 +559,9 @@ class VMTopology(object):
 
     @staticmethod
     def cmd(cmdline):
-        with open(cmd_debug_fname, 'a') as fp:
-            pprint("CMD: %s" % cmdline, fp)
+        with cmd_debug_lock:
+            with open(cmd_debug_fname, 'a') as fp:
+                pprint("CMD: %s" % cmdline, fp)
         cmd = cmdline.split(' ')
         process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = process.communicate()
@@ -515,10 +570,99 @@ class VMTopology(object):
         if ret_code != 0:
             raise Exception("ret_code=%d, error message=%s. cmd=%s" % (ret_code, stderr, cmdline))
 
-        with open(cmd_debug_fname, 'a') as fp:
-            pprint("OUTPUT: %s" % stdout, fp)
+        with cmd_debug_lock:
+            with open(cmd_debug_fname, 'a') as fp:
+                pprint("OUTPUT: %s" % stdout, fp)
         return stdout
 
+    @staticmethod
+    def run_parallel(func, items):
+        if len(items) <= 1:
+            return map(func, items)
+        pool = ThreadPool(min(len(items), OVS_FLOW_WORKERS))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def get_fp_flows(dut_iface_id, injected_iface_id, vm_iface_id, disconnect_vm=False):
+        flows = []
+        if disconnect_vm:
+            # Drop packets from VM
+            flows.append("table=0,in_port=%s,action=drop" % vm_iface_id)
+        else:
+            # Add flow from a VM to an external iface
+            flows.append("table=0,in_port=%s,action=output:%s" % (vm_iface_id, dut_iface_id))
+
+        if disconnect_vm:
+            # Add flow from external iface to ptf container
+            flows.append("table=0,in_port=%s,action=output:%s" % (dut_iface_id, injected_iface_id))
+        else:
+            # Add flow from external iface to a VM and a ptf container
+            flows.append("table=0,in_port=%s,action=output:%s,%s" % (dut_iface_id, vm_iface_id, injected_iface_id))
+
+        # Add flow from a ptf container to an external iface
+        flows.append("table=0,in_port=%s,action=output:%s" % (injected_iface_id, dut_iface_id))
+
+        return flows
+
+    @staticmethod
+    def ovs_vsctl(commands):
+        """run the ovs-vsctl commands in one transaction"""
+        if commands:
+            VMTopology.cmd('ovs-vsctl ' + ' '.join('-- ' + command for command in commands))
+
+    @staticmethod
+    def ovs_replace_flows(bridge, flows):
+        """replace all the flows of the bridge with the flows, the same as del-flows and add-flow for each flow"""
+        with tempfile.NamedTemporaryFile(prefix='vmtopology.flows.', delete=False) as fp:
+            fp.write('\n'.join(flows) + '\n')
+        try:
+            VMTopology.cmd('ovs-ofctl replace-flows %s %s' % (bridge, fp.name))
+        finally:
+            os.remove(fp.name)
+
+    @staticmethod
+    def ovs_list(table, columns):
+        out = VMTopology.cmd('ovs-vsctl --format=json --columns=%s list %s' % (','.join(columns), table))
+        return json.loads(out)['data']
+
+    @staticmethod
+    def ovs_set(value):
+        # ovsdb json encodes a set with one element as the element itself
+        if isinstance(value, list) and len(value) == 2 and value[0] == 'set':
+            return value[1]
+        return [value]
+
+    @staticmethod
+    def get_ovs_bridges():
+        """get ports of all ovs bridges as {bridge: set(ports)}"""
+        port_names = {}
+        for uuid, name in VMTopology.ovs_list('Port', ['_uuid', 'name']):
+            port_names[uuid[1]] = name
+
+        result = {}
+        for name, ports in VMTopology.ovs_list('Bridge', ['name', 'ports']):
+            result[name] = set(port_names[port[1]] for port in VMTopology.ovs_set(ports) if port[1] in port_names)
+        return result
+
+    @staticmethod
+    def get_ovs_ofports(ifaces):
+        # Vlan interface addition may take few secs to reflect in OVS Command,
+        # Let`s retry few times in that case.
+        for retries in range(RETRIES):
+            result = {}
+            for name, ofport in VMTopology.ovs_list('Interface', ['name', 'ofport']):
+                if isinstance(ofport, int) and ofport > 0:
+                    result[name] = ofport
+            missing = [iface for iface in ifaces if iface not in result]
+            if not missing:
+                return result
+            time.sleep(2*retries+1)
+        raise Exception("Can't find ofport of interfaces %s" % ', '.join(sorted(missing)))
+
     @staticmethod
     def get_ovs_br_ports(bridge):
         out = VMTopology.cmd('ovs-vsctl list-ports %s' % bridge)
@@ -680,6 +824,7 @@ def main():
             dut_mgmt_port=dict(required=False, type='str'),
             fp_mtu=dict(required=False, type='int', default=DEFAULT_MTU),
             max_fp_num=dict(required=False, type='int', default=NUM_FP_VLANS_PER_FP),
+            ovs_batch=dict(required=False, type='bool', default=True),
         ),
         supports_check_mode=False)
 
@@ -699,7 +844,7 @@ def main():
         if os.path.exists(cmd_debug_fname) and os.path.isfile(cmd_debug_fname):
             os.remove(cmd_debug_fname)
 
-        net = VMTopology(vm_names, fp_mtu, max_fp_num)
+        net = VMTopology(vm_names, fp_mtu, max_fp_num, module.params['ovs_batch'])
 
         if cmd == 'create':
             net.create_bridges()
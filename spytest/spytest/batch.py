@@ -2,9 +2,11 @@ import os
 import sys
 import csv
 import shutil
+import threading
 from operator import itemgetter
 from spytest.dicts import SpyTestDict
 from spytest.testbed import Testbed
+from spytest.history import DurationHistory
 import spytest.spydist as dist
 import utilities.common as utils
 
@@ -16,6 +18,17 @@ wa.custom_scheduling = False
 wa.debug_level = 0
 wa.logs_path = ""
 wa.executed = SpyTestDict()
+wa.report_cases = dict()
+wa.report_lock = threading.Lock()
+wa.report_save_lock = threading.Lock()
+wa.report_event = threading.Event()
+wa.report_thread = None
+wa.report_stop = threading.Event()
+wa.report_interval = int(os.getenv("SPYTEST_BATCH_REPORT_INTERVAL", "5"))
+wa.journal_fd = None
+wa.journal = None
+wa.history = None
+wa.dry_run = bool(os.getenv("SPYTEST_BATCH_DRY_RUN", "0") != "0")
 wa.trace_file = None
 wa.logger = None
 
@@ -46,69 +59,125 @@ def trace(*args, **kwargs):
     wa.print_func("\n{}\n".format(msg))
     ftrace(msg)
 
-def save_report():
-
-    # show running
-    (header, rows) = (['#', "Module", "Function", "TestCase", "Node", "Status"], [])
-    for index, nodeid in enumerate(wa.executed):
-        [node_name, status] = wa.executed[nodeid]
-        if not node_name: continue
+def _report_cases(nodeid):
+    if nodeid not in wa.report_cases:
         parts = nodeid.split("::", 1)
         (module, func) = (parts[0], parts[1])
-        if "tclist" not in wa.tcmap:
-            rows.append([len(rows)+1, module, func, func, node_name, status])
-        elif func not in wa.tcmap.tclist:
-            rows.append([len(rows)+1, module, func, func, node_name, status])
+        if "tclist" not in wa.tcmap or func not in wa.tcmap.tclist:
+            wa.report_cases[nodeid] = [[module, func, func]]
         else:
-            for tcid in wa.tcmap.tclist[func]:
-                rows.append([len(rows)+1, module, func, tcid, node_name, status])
+            wa.report_cases[nodeid] = [[module, func, tcid] for tcid in wa.tcmap.tclist[func]]
+    return wa.report_cases[nodeid]
 
-    filepath = os.path.join(wa.logs_path, "batch_progress.csv")
-    utils.write_csv_file(header, rows, filepath)
-    filepath = os.path.splitext(filepath)[0]+'.html'
-    utils.write_html_table(header, rows, filepath)
-
-    # show pending
-    (header, rows) = (['#', "Module", "Function", "TestCase", "Status"], [])
-    for index, nodeid in enumerate(wa.executed):
-        [node_name, status] = wa.executed[nodeid]
-        if node_name: continue
-        parts = nodeid.split("::", 1)
-        (module, func) = (parts[0], parts[1])
-        if "tclist" not in wa.tcmap:
-            rows.append([len(rows)+1, module, func, func, status])
-        elif func not in wa.tcmap.tclist:
-            rows.append([len(rows)+1, module, func, func, status])
-        else:
-            for tcid in wa.tcmap.tclist[func]:
-                rows.append([len(rows)+1, module, func, tcid, status])
+def save_report():
 
-    filepath = os.path.join(wa.logs_path, "batch_pending.csv")
-    utils.write_csv_file(header, rows, filepath)
+    # materialize the reports from a snapshot of the in-memory index
+    with wa.report_lock:
+        executed = list(wa.executed.items())
+
+    with wa.report_save_lock:
+        # show running
+        (header, rows) = (['#', "Module", "Function", "TestCase", "Node", "Status"], [])
+        for nodeid, [node_name, status] in executed:
+            if not node_name: continue
+            for case in _report_cases(nodeid):
+                rows.append([len(rows)+1] + case + [node_name, status])
+
+        _write_report(header, rows, "batch_progress.csv")
+
+        # show pending
+        (header, rows) = (['#', "Module", "Function", "TestCase", "Status"], [])
+        for nodeid, [node_name, status] in executed:
+            if node_name: continue
+            for case in _report_cases(nodeid):
+                rows.append([len(rows)+1] + case + [status])
+
+        _write_report(header, rows, "batch_pending.csv")
+
+def _write_report(header, rows, filename):
+    # write through temporary files so that the readers never see partial reports
+    filepath = os.path.join(wa.logs_path, filename)
+    utils.write_csv_file(header, rows, filepath + ".tmp")
+    os.rename(filepath + ".tmp", filepath)
     filepath = os.path.splitext(filepath)[0]+'.html'
-    utils.write_html_table(header, rows, filepath)
+    utils.write_html_table(header, rows, filepath + ".tmp")
+    os.rename(filepath + ".tmp", filepath)
+
+def _journal(op, nodeid, node_name, status):
+    if not wa.journal_fd:
+        filepath = os.path.join(wa.logs_path, "batch_journal.csv")
+        if sys.version_info.major < 3:
+            wa.journal_fd = open(filepath, "wb")
+        else:
+            wa.journal_fd = open(filepath, "w", newline='')
+        wa.journal = csv.writer(wa.journal_fd, dialect="excel")
+        wa.journal.writerow(["Time", "Event", "NodeId", "Node", "Status"])
+    wa.journal.writerow([utils.get_current_datetime(), op, nodeid, node_name, status])
+    wa.journal_fd.flush()
+
+def _report_thread():
+    while not wa.report_stop.is_set():
+        wa.report_event.wait()
+        wa.report_event.clear()
+        if wa.report_stop.is_set():
+            break
+        try:
+            save_report()
+        except Exception as exp:
+            print(exp)
+        # coalesce the events received while saving into the next save
+        wa.report_stop.wait(wa.report_interval)
+
+def _report_changed():
+    if not wa.report_thread:
+        wa.report_thread = threading.Thread(target=_report_thread)
+        wa.report_thread.daemon = True
+        wa.report_thread.start()
+    wa.report_event.set()
 
 def report(op, nodeid, node_name):
-    if op == "load":
-        wa.executed[nodeid] = ["", "Pending"]
+    if op == "save":
+        _report_changed()
         return
-    elif op == "add":
-        wa.executed[nodeid] = [node_name, "Queued"]
-        return
-    elif op == "remove":
-        if nodeid in wa.executed:
+    with wa.report_lock:
+        if op == "load":
+            wa.executed[nodeid] = ["", "Pending"]
+        elif op == "add":
+            wa.executed[nodeid] = [node_name, "Queued"]
+        elif op == "remove":
+            if nodeid not in wa.executed:
+                return
             del wa.executed[nodeid]
-        return
-    elif op == "finish":
-        if nodeid in wa.executed:
+        elif op == "finish":
+            if nodeid not in wa.executed:
+                return
             wa.executed[nodeid] = [node_name, "Completed"]
+        status = wa.executed[nodeid][1] if nodeid in wa.executed else ""
+    try:
+        _journal(op, nodeid, node_name, status)
+    except Exception as exp:
+        print(exp)
+    if op == "finish":
+        _report_changed()
+
+def _report_flush():
+    if not wa.report_thread:
+        return
+    # wait for the background save in progress before the final save
+    wa.report_stop.set()
+    wa.report_event.set()
+    wa.report_thread.join()
+    wa.report_thread = None
     try:
         save_report()
     except Exception as exp:
         print(exp)
+    if wa.journal_fd:
+        wa.journal_fd.close()
+        wa.journal_fd = None
 
 def shutdown():
-    pass
+    _report_flush()
 
 class SpyTestScheduling(object):
     def __init__(self, config, wa, log=None):
@@ -129,6 +198,7 @@ class SpyTestScheduling(object):
         self.default_topo = ""
         self.max_order = self.default_order
         self._load_buckets()
+        self._load_history()
 
     def _load_buckets(self):
         root = os.path.join(os.path.dirname(__file__), '..', "reporting")
@@ -158,6 +228,15 @@ class SpyTestScheduling(object):
             else:
                 self.base_names[basename] = name
 
+    def _load_history(self):
+        # keep the history out of the source tree, point the environment
+        # variable to a persistent file to use it across the runs
+        default_file = os.path.join(wa.logs_path, "batch_durations.json")
+        history_file = os.getenv("SPYTEST_BATCH_HISTORY_FILE", default_file)
+        wa.history = DurationHistory(os.path.abspath(history_file))
+        msg = "Duration history: {} modules {} tests from {}"
+        trace(msg.format(len(wa.history.modules), len(wa.history.tests), wa.history.filepath))
+
     def add_node(self, node):
         self.node_modules[node] = []
 
@@ -203,6 +282,7 @@ class SpyTestScheduling(object):
             module = self.all_modules[mname]
             module.node_indexes = []
             module.nodes = []
+            module.duration = wa.history.module_time(nodeid.split("::", 1)[0])
             if mname in self.topo:
                 module.topo = self.topo[mname]
             else:
@@ -217,7 +297,8 @@ class SpyTestScheduling(object):
                 module.bucket = self.default_bucket
                 if init:
                     trace("Module {} is not found in modules.csv".format(mname))
-        self.all_modules[mname].node_indexes.append(self.collection.index(nodeid))
+        self.all_modules[mname].node_indexes.append(self.collection_index[nodeid])
+        self.all_modules[mname].duration += wa.history.test_time(nodeid)
 
     def add_node_collection(self, node, collection):
         self.count = self.count - 1
@@ -228,6 +309,7 @@ class SpyTestScheduling(object):
         # generate module list
         self.collection_is_completed = True
         self.collection = collection
+        self.collection_index = dict((nodeid, index) for index, nodeid in enumerate(collection))
         for nodeid in collection:
             self.add_nodeid(nodeid, True)
         report("save", "", "")
@@ -265,16 +347,18 @@ class SpyTestScheduling(object):
                     minfo.nodes.append("gw0")
         self._show_module_info()
         _show_testbed_info()
+        self.predict()
 
     def _show_module_info(self, show=True):
-        header = ["Module", "Bucket", "Tests", "Topology", "Nodes"]
+        header = ["Module", "Bucket", "Tests", "Duration", "Topology", "Nodes"]
         (mcount, tcount, rows) = (0, 0, [])
         for mname, minfo in self.all_modules.items():
             count = len(minfo.node_indexes)
             mcount = mcount + 1
             tcount = tcount + count
             nodes = ",".join(minfo.nodes)
-            rows.append([mname, minfo.bucket, count, minfo.topo, nodes])
+            duration = utils.time_format(minfo.duration)
+            rows.append([mname, minfo.bucket, count, duration, minfo.topo, nodes])
         rows = sorted(rows, key=itemgetter(1), reverse=True)
         retval = utils.sprint_vtable(header, rows)
         if show:
@@ -293,22 +377,56 @@ class SpyTestScheduling(object):
         self._schedule_node(node)
         debug("NewList", node, self.node_modules[node])
 
+    def _pick_module(self, name, modules):
+        # longest processing time first among the modules of the lowest order
+        (selected, selected_key) = (None, None)
+        for mname, minfo in modules.items():
+            if name not in minfo.nodes: continue
+            order = minfo.order if self.order_support else 0
+            key = (order, -minfo.duration)
+            if selected_key is None or key < selected_key:
+                (selected, selected_key) = (mname, key)
+        return selected
+
     def _assign_test(self, node, name):
         slave = self.wa.slaves[name]
-        for order in range(0, self.max_order + 1):
-            for mname,minfo in self.all_modules.items():
-                if name not in minfo.nodes: continue
-                if minfo.order != order and self.order_support:
-                    continue
-                del self.all_modules[mname]
-                self.node_modules[node].extend(minfo.node_indexes)
-                slave.executed = slave.executed + len(minfo.node_indexes)
-                debug("ASSIGNED", name, minfo.order, mname, minfo.node_indexes)
-                for item_index in minfo.node_indexes:
-                    report("add", self.collection[item_index], node.gateway.id)
-                report("save", "", "")
-                return True
-        return False
+        mname = self._pick_module(name, self.all_modules)
+        if not mname:
+            return False
+        minfo = self.all_modules.pop(mname)
+        self.node_modules[node].extend(minfo.node_indexes)
+        slave.executed = slave.executed + len(minfo.node_indexes)
+        debug("ASSIGNED", name, minfo.order, mname, minfo.duration, minfo.node_indexes)
+        for item_index in minfo.node_indexes:
+            report("add", self.collection[item_index], node.gateway.id)
+        report("save", "", "")
+        return True
+
+    def predict(self, show=True):
+        # simulate the scheduling: the node which gets free first picks the next module
+        modules = SpyTestDict(self.all_modules)
+        loads = SpyTestDict([(name, [0, 0]) for name in wa.slaves])
+        while modules:
+            for name in sorted(loads, key=lambda name: loads[name][0]):
+                mname = self._pick_module(name, modules)
+                if mname: break
+            else:
+                break
+            minfo = modules.pop(mname)
+            loads[name][0] = loads[name][0] + minfo.duration
+            loads[name][1] = loads[name][1] + 1
+
+        (header, rows) = (["Node", "Bucket", "Modules", "Duration"], [])
+        for name, [duration, count] in loads.items():
+            rows.append([name, wa.slaves[name].bucket, count, utils.time_format(duration)])
+        durations = [minfo.duration for minfo in self.all_modules.values()]
+        makespan = max([load[0] for load in loads.values()] + [0])
+        lower_bound = max(durations + [sum(durations) // max(len(loads), 1)])
+        if show:
+            trace(utils.sprint_vtable(header, rows))
+            msg = "Predicted makespan: {} lower bound: {}"
+            trace(msg.format(utils.time_format(makespan), utils.time_format(lower_bound)))
+        return makespan
 
     def _schedule_node(self, node):
         name = node.gateway.id
@@ -316,6 +434,10 @@ class SpyTestScheduling(object):
         if self.wa.slaves[name].completed: return
         if not self.wa.slaves[name].started: return
         if node.shutting_down: return
+        if wa.dry_run:
+            debug("================ dry-run shutdown =========== {}".format(node))
+            node.shutdown()
+            return
         prev_count = len(self.node_modules[node])
         if prev_count >= 2: return
         debug("================ load =========== {} {}".format(node, prev_count))
@@ -443,13 +565,29 @@ def set_logger(logger):
 
 def set_tcmap(tcmap):
     wa.tcmap = tcmap
+    wa.report_cases.clear()
 
 def unconfigure(config):
     debug("============== batch unconfigure =====================")
     return is_master()
 
+def _update_history():
+    if not wa.custom_scheduling or wa.dry_run or not wa.history:
+        return
+    try:
+        (modules, tests) = wa.history.update(wa.logs_path)
+        wa.history.save()
+        msg = "Duration history: updated {} modules {} tests in {}"
+        trace(msg.format(modules, tests, wa.history.filepath))
+    except Exception as exp:
+        trace("failed to update duration history: {}".format(exp))
+
 def finish():
-    return is_master()
+    if is_master():
+        _report_flush()
+        _update_history()
+        return True
+    return False
 
 def make_scheduler(config, log):
     debug("============== batch make_scheduler =====================")
@@ -7,12 +7,12 @@ import copy
 import glob
 from inspect import currentframe
 from collections import OrderedDict
-from operator import itemgetter
 import traceback
 import textwrap
 import logging
 import socket
 import signal
+import threading
 import pytest
 
 from apis.common.init import apis_register
@@ -24,6 +24,7 @@ import utilities.parallel as putil
 from spytest.net import Net
 from spytest.logger import Logger
 from spytest.result import Result
+from spytest.result import ResultMerger
 from spytest.testbed import Testbed
 from spytest.rps import RPS
 from spytest.dicts import SpyTestDict
@@ -31,11 +32,14 @@ from spytest.tgen import tg as tgapi
 from spytest.version import get_git_ver
 from spytest.datamap import DataMap
 from spytest import batch
+from spytest import profile
 from spytest.st_time import get_timenow
 from spytest.st_time import get_elapsed
 from spytest.st_time import get_timestamp
 
 bg_results = putil.ExecuteBackgroud()
+merged_results = SpyTestDict()
+merged_results_lock = threading.Lock()
 min_time = 0
 tcmap = SpyTestDict()
 missing_test_names_msg = ""
@@ -129,6 +133,7 @@ class Context(object):
     def __init__(self, wa, cfg):
         self.stats_txt = None
         self.stats_csv = None
+        self.trace_json = None
         self.wa = wa
         self.cfg = cfg
         self.tc_results = dict()
@@ -247,6 +252,8 @@ class Context(object):
         self.stats_csv = get_file_path("stats", "csv", self.logs_path, False)
         Result.write_report_csv(self.stats_csv, [], 3, is_batch=False)
         utils.delete_file(self.stats_txt)
+        self.trace_json = get_file_path("trace", "json", self.logs_path, False)
+        utils.delete_file(self.trace_json)
 
     def _cleanup_gracefully(self):
         if not self.shutting_down:
@@ -1918,8 +1925,8 @@ class WorkArea(object):
         if stats.canbe_parallel:
             msg = "yet to be parallized: {}".format(nodeid)
             utils.banner(msg, func=ftrace)
-            for [start_time, msg, dut1, dut2] in stats.canbe_parallel:
-                ftrace(start_time, msg, dut1, dut2)
+            for [start_time, msg, duts, count, saving] in stats.canbe_parallel:
+                ftrace(start_time, msg, ",".join(duts), count, saving)
             utils.banner(None, func=ftrace)
 
         #Construct the final result log message to print in all log files.
@@ -1949,6 +1956,9 @@ class WorkArea(object):
             ofh.write("\nTOTAL INFRA Time = {}".format(stats.infra_cmd_time))
             ofh.write("\nTOTAL TG Time = {}".format(stats.tg_cmd_time))
             ofh.write("\nTOTAL PROMPT NFOUND = {}".format(stats.pnfound))
+            if stats.xfer_time:
+                rate = int(stats.xfer_bytes * 1000 / stats.xfer_time)
+                ofh.write("\nTOTAL XFER Time = {} ({} bytes/sec)".format(stats.xfer_time, rate))
             for [start_time, thid, ctype, dut, cmd, ctime] in stats.cmds:
                 start_msg = "\n{} {}".format(get_timestamp(this=start_time), thid)
                 if ctype == "CMD":
@@ -1961,9 +1971,14 @@ class WorkArea(object):
                     ofh.write("{}WAIT TIME: {} = {}".format(start_msg, ctime, cmd))
                 elif ctype == "TGWAIT":
                     ofh.write("{}TGWAIT TIME: {} = {}".format(start_msg, ctime, cmd))
+                elif ctype == "XFER":
+                    ofh.write("{}XFER TIME: {} {} = {}".format(start_msg, ctime, dut, cmd))
                 elif ctype == "PROMPT_NFOUND":
                     ofh.write("{}PROMPT NFOUND: {}".format(start_msg, cmd))
+            ofh.write("\n{}".format(profile.format_stats(stats)))
             ofh.write("\n=========================================================\n")
+        if self._context.trace_json:
+            profile.write_trace(self._context.trace_json, nodeid, stats)
         self.stats_count = self.stats_count + 1
         row = [self.stats_count, nodeid, res, time_taken, stats.infra_cmd_time,
                stats.tc_cmd_time, stats.tg_cmd_time, stats.tc_total_wait,
@@ -3349,40 +3364,6 @@ def get_rate(val, total):
         return '{:.2%}'.format(val*1.0/total)
     return "0.00%"
 
-def read_all_results(logs_path, suffix, offset):
-
-    def csv_base_file(val):
-        val = os.path.basename(val)
-        return val
-
-    # get all the result file paths
-    csv_files = glob.glob("{}/gw*/*_{}.csv".format(logs_path, suffix))
-    csv_files.sort(key=csv_base_file)
-
-    # prepare the map for module result and result file
-    module_result = OrderedDict()
-    rows_dict = dict()
-    for csv_file in csv_files:
-        rows = Result.read_report_csv(csv_file)
-        rows_dict[csv_file] = rows
-        for row in rows:
-            module_result[row[offset]] = csv_file
-
-    # Results
-    [results, links] = ([], [])
-    for csv_file in csv_files:
-        rows = rows_dict[csv_file]
-        gw_name = os.path.basename(os.path.dirname(csv_file))
-        for row in rows:
-            if module_result[row[offset]] == csv_file:
-                gw_logs = find_log_path(row[offset], csv_file, gw_name)
-                new_row = [gw_name]
-                new_row.extend(row)
-                results.append(new_row)
-                links.append(gw_logs)
-
-    return [results, links]
-
 def consolidate_results(progress=None, thread=False, count=None):
 
     # generate email report
@@ -3402,53 +3383,55 @@ def consolidate_results(progress=None, thread=False, count=None):
     if progress is not None and progress <= 0:
         return
 
+    with merged_results_lock:
+        _consolidate_results(logs_path)
+
+def _get_result_mergers(logs_path):
+    if merged_results.get("logs_path") != logs_path:
+        merged_results.logs_path = logs_path
+        merged_results.result = ResultMerger("result", 0, 0, 5, find_log_path)
+        merged_results.tcresult = ResultMerger("tcresult", 7, 1, 5, find_log_path)
+        merged_results.syslog = ResultMerger("syslog", 1, 2, 5, find_log_path)
+        merged_results.stats = ResultMerger("stats", 0, 3)
+    return merged_results
+
+def _consolidate_results(logs_path):
+
+    # read only the rows added to the node result files since the last time
+    mergers = _get_result_mergers(logs_path)
+
     # Func Results
-    [results, links] = read_all_results(logs_path, "result", 0)
-    if links:
-        for i,row in enumerate(results): row.append(links[i])
-    consolidated = sorted(results, key=itemgetter(5))
-    if links:
-        for i,row in enumerate(consolidated): links[i] = row.pop()
+    mergers.result.read(logs_path)
+    [results, links] = mergers.result.get()
     results_csv = get_results_csv(logs_path, True)
-    Result.write_report_csv(results_csv, consolidated, 0)
-    generate_module_report(results_csv, 1, links)
     html_file = os.path.splitext(results_csv)[0]+'.html'
-    Result.write_report_html(html_file, consolidated, 0, True, 4)
+    changed = mergers.result.write(results_csv, html_file, 4)
     wa = get_work_area()
     if wa and wa._context:
-        wa._context.run_progress_report(len(consolidated))
+        wa._context.run_progress_report(len(results))
 
     # TC Results
-    [results, links] = read_all_results(logs_path, "tcresult", 7)
-    if links:
-        for i,row in enumerate(results): row.append(links[i])
-    consolidated = sorted(results, key=itemgetter(5))
-    if links:
-        for i,row in enumerate(consolidated): links[i] = row.pop()
+    mergers.tcresult.read(logs_path)
+    tc_results = mergers.tcresult.get()[0]
     tcresults_csv = get_tc_results_csv(logs_path, True)
-    Result.write_report_csv(tcresults_csv, consolidated, 1)
-    generate_component_report(results_csv, tcresults_csv, 1)
     html_file = os.path.splitext(tcresults_csv)[0]+'.html'
-    Result.write_report_html(html_file, consolidated, 1, True, 4)
+    if mergers.tcresult.write(tcresults_csv, html_file, 4):
+        changed = True
+    if changed:
+        generate_module_report(results_csv, 1, links, results)
+        generate_component_report(results_csv, tcresults_csv, 1, results, tc_results)
 
     # syslog Results
-    [results, links] = read_all_results(logs_path, "syslog", 1)
-    if links:
-        for i,row in enumerate(results): row.append(links[i])
-    consolidated = sorted(results, key=itemgetter(5))
-    if links:
-        for i,row in enumerate(consolidated): links[i] = row.pop()
+    mergers.syslog.read(logs_path)
     syslog_csv = get_syslog_csv(logs_path, True)
-    Result.write_report_csv(syslog_csv, consolidated, 2)
     html_file = os.path.splitext(syslog_csv)[0]+'.html'
-    Result.write_report_html(html_file, consolidated, 2, True)
+    mergers.syslog.write(syslog_csv, html_file)
 
     # Stats
-    [consolidated, links] = read_all_results(logs_path, "stats", 0)
+    mergers.stats.read(logs_path)
     csv_file = get_file_path("stats", "csv", logs_path, True)
-    Result.write_report_csv(csv_file, consolidated, 3)
     html_file = os.path.splitext(csv_file)[0]+'.html'
-    Result.write_report_html(html_file, consolidated, 3, True)
+    mergers.stats.write(csv_file, html_file)
 
 def generate_email_report_files(files, nodes, report_html):
 
@@ -3605,9 +3588,10 @@ def find_log_path(name, csv_file, node):
     suffix = suffix.replace("_result.csv", replace)
     return suffix if not node else "{}/{}".format(node, suffix)
 
-def generate_module_report(csv_file, offset=0, links=None):
+def generate_module_report(csv_file, offset=0, links=None, rows=None):
     html_file = os.path.splitext(csv_file)[0]+'_modules.html'
-    rows = Result.read_report_csv(csv_file)
+    if rows is None:
+        rows = Result.read_report_csv(csv_file)
     module_logs = OrderedDict()
     modules = OrderedDict()
 
@@ -3700,13 +3684,15 @@ def generate_module_report(csv_file, offset=0, links=None):
     csv_file = os.path.splitext(html_file)[0]+'.csv'
     utils.write_csv_file(cols, rows, csv_file)
 
-def generate_component_report(results_csv, tcresults_csv, offset=0):
+def generate_component_report(results_csv, tcresults_csv, offset=0, func_rows=None, tc_rows=None):
     modules = OrderedDict()
     func_time = dict()
     func_syslogs = dict()
     tcmodmap = dict()
-    tc_rows = Result.read_report_csv(tcresults_csv)
-    func_rows = Result.read_report_csv(results_csv)
+    if tc_rows is None:
+        tc_rows = Result.read_report_csv(tcresults_csv)
+    if func_rows is None:
+        func_rows = Result.read_report_csv(results_csv)
     for row in func_rows:
         name = row[offset]
         func = row[offset+1]
@@ -0,0 +1,109 @@
+import os
+import csv
+import glob
+import json
+
+import utilities.common as utils
+
+class DurationHistory(object):
+    """
+    Keeps the execution time (seconds) of the test functions and the module
+    configuration seen in the earlier runs, keyed by the pytest nodeid and the
+    module path, so that the batch scheduler can estimate the module durations.
+    """
+
+    def __init__(self, filepath, default_test_time=60, weight=0.5):
+        self.filepath = filepath
+        self.default_test_time = default_test_time
+        self.weight = weight
+        self.modules = dict()
+        self.tests = dict()
+        self.mean_test_time = None
+        self.load()
+
+    def load(self):
+        if not self.filepath or not os.path.exists(self.filepath):
+            return False
+        try:
+            with open(self.filepath) as fd:
+                data = json.load(fd)
+            self.modules = data.get("modules", {})
+            self.tests = data.get("tests", {})
+            return True
+        except Exception as exp:
+            print("failed to load {}: {}".format(self.filepath, exp))
+            return False
+
+    def save(self):
+        # concurrent runs may share the file, replace it in one step
+        data = {"modules": self.modules, "tests": self.tests}
+        utils.ensure_parent(self.filepath)
+        tmp_file = "{}.{}".format(self.filepath, os.getpid())
+        with open(tmp_file, "w") as fd:
+            json.dump(data, fd, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.filepath)
+
+    def test_time(self, nodeid):
+        if nodeid in self.tests:
+            return self.tests[nodeid]
+        if self.mean_test_time is None:
+            if self.tests:
+                self.mean_test_time = sum(self.tests.values()) // len(self.tests)
+            else:
+                self.mean_test_time = self.default_test_time
+        return self.mean_test_time
+
+    def module_time(self, module):
+        return self.modules.get(module, 0)
+
+    def _merge(self, store, key, value):
+        if key in store:
+            value = self.weight * value + (1 - self.weight) * store[key]
+        store[key] = int(round(value))
+
+    @staticmethod
+    def _parse_time(value):
+        if ":" in value:
+            return utils.time_parse(value)
+        return utils.integer_parse(value, 0)
+
+    @staticmethod
+    def _read_csv(filepath):
+        try:
+            with utils.open_file(filepath) as fd:
+                return list(csv.DictReader(fd))
+        except Exception:
+            return []
+
+    def update(self, logs_path):
+        """
+        Merge the durations from the result and stats files of all the
+        gateway workers under the given logs path into the history.
+        """
+        (modules, tests) = (dict(), dict())
+
+        # TimeTaken of each test function
+        for filepath in glob.glob(os.path.join(logs_path, "gw*", "*_result.csv")):
+            for row in self._read_csv(filepath):
+                if not row.get("TestFunction"): continue
+                nodeid = "{}::{}".format(row["Module"], row["TestFunction"])
+                tests[nodeid] = self._parse_time(row.get("TimeTaken", ""))
+
+        # Test Time of each test function and the module configuration
+        for filepath in glob.glob(os.path.join(logs_path, "gw*", "*_stats.csv")):
+            for row in self._read_csv(filepath):
+                nodeid = row.get("Module", "")
+                secs = self._parse_time(row.get("Test Time", ""))
+                if not nodeid: continue
+                if row.get("Description") == "Module Configuration":
+                    module = nodeid.split("::", 1)[0]
+                    modules[module] = modules.get(module, 0) + secs
+                elif "::" in nodeid:
+                    tests[nodeid] = secs
+
+        for module, secs in modules.items():
+            self._merge(self.modules, module, secs)
+        for nodeid, secs in tests.items():
+            self._merge(self.tests, nodeid, secs)
+        self.mean_test_time = None
+        return len(modules), len(tests)
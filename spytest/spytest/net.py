@@ -2,6 +2,7 @@ from __future__ import unicode_literals, print_function
 import os
 import sys
 import json
+import base64
 import re
 import tempfile
 import logging
@@ -66,6 +67,9 @@ class Net(object):
         self.is_vsonic_cache = dict()
         self.memory_checks = dict()
         self.skip_trans_helper = dict()
+        self.cas_dir = os.getenv("SPYTEST_DUT_CAS_DIR", "/etc/spytest/cas")
+        self.cas_max_age = int(os.getenv("SPYTEST_DUT_CAS_MAX_AGE_DAYS", "7"))
+        self.cas_manifest = dict()
         self.image_install_status = OrderedDict()
         self.devices_used_in_tc = OrderedDict()
         self.devices_used_collection = False
@@ -95,6 +99,12 @@ class Net(object):
         #time.sleep = self.wait
         self.force_console_transfer = False
         self.max_cmds_once = 100
+        self.console_transfer_chunk = int(os.getenv("SPYTEST_CONSOLE_TRANSFER_CHUNK", "4096"))
+        self.console_transfer_compress = os.getenv("SPYTEST_CONSOLE_TRANSFER_COMPRESS", "gzip")
+        self.console_transfer_retries = 3
+        self.batch_min_cmds = int(os.getenv("SPYTEST_BATCH_CLI_MIN_CMDS", "10"))
+        self.batch_vtysh = bool(os.getenv("SPYTEST_BATCH_CLI_VTYSH", "0") != "0")
+        self.config_diff_apply = bool(os.getenv("SPYTEST_CONFIG_DIFF_APPLY", "0") != "0")
         self.kdump_supported = bool(os.getenv("SPYTEST_KDUMP_ENABLE", "1") == "1")
         self.pending_downloads = dict()
         self.log_dutid_fmt = os.getenv("SPYTEST_LOG_DUTID_FMT", "LABEL")
@@ -150,6 +160,8 @@ class Net(object):
         if index is None:
             index = self._get_handle_index(devname)
         self._set_param(devname, "handle", handle, index)
+        # the store may have changed while the device was not connected
+        self.cas_manifest.pop(devname, None)
 
     def _get_handle_index(self, devname):
         access = self._get_dev_access(devname)
@@ -1874,7 +1886,7 @@ class Net(object):
         try:
             parsed = self.tmpl[devname].apply(output, cmd)
             self.logger.debug(parsed)
-            return parsed
+            return utils.ParsedTable(parsed)
         except Exception as e:
             self.logger.exception(e)
             return output
@@ -2048,9 +2060,14 @@ class Net(object):
 
         applied = False
         for retry in range(3):
-            # transfer the file
+            # transfer the file unless the same content is already on the device
             access = self._get_dev_access(devname)
-            dst_file = self._upload_file(access, src_file)
+            try:
+                dst_file = self._cas_upload(devname, access, src_file)
+            except Exception as e:
+                self.dut_log(devname, str(e), lvl=logging.WARNING)
+                self.cas_manifest.pop(devname, None)
+                continue
 
             # issue config load
             if access["filemode"]:
@@ -2064,13 +2081,14 @@ class Net(object):
             output = self.config_new(devname, check_file_cmd, skip_error_check=True)
 
             # execute the command.
-            config_cmd = "config load -y {}".format(dst_file)
+            config_cmd = self._config_load_cmd(devname, access, dst_file)
             output = self.config_new(devname, config_cmd, skip_error_check=True)
             if 'Path "{}" does not exist.'.format(dst_file) not in output:
                 applied = True
                 break
             msg = "Failed to find the transfered destination file retry again in 3 sec"
             self.dut_log(devname, msg, lvl=logging.WARNING)
+            self.cas_manifest.pop(devname, None)
             time.sleep(3)
 
         # remove temp file
@@ -2082,6 +2100,13 @@ class Net(object):
             self.dut_log(devname, msg, lvl=logging.WARNING)
             self.apply_json2(devname, data)
 
+    def _config_load_cmd(self, devname, access, dst_file):
+        if not self.config_diff_apply:
+            return "config load -y {}".format(dst_file)
+        helper = os.path.join(os.path.dirname(__file__), "remote", "spytest-helper.py")
+        helper = self._upload_file2(devname, access, os.path.abspath(helper), md5check=True)
+        return "sudo python {} --config-load {} --use-config-diff".format(helper, dst_file)
+
     def apply_json2(self, devname, data):
         access = self._get_dev_access(devname)
         if not access["filemode"]:
@@ -2229,6 +2254,7 @@ class Net(object):
 
         # we need to download the helper files again
         self.skip_trans_helper[devname] = dict()
+        self.cas_manifest.pop(devname, None)
 
         # Issue reboot command and look for ONIE rescue mode.
         if not self.reboot(devname, onie=True):
@@ -2326,6 +2352,7 @@ class Net(object):
 
         # we need to download the helper files again
         self.skip_trans_helper[devname] = dict()
+        self.cas_manifest.pop(devname, None)
 
         # Issue reboot command.
         reboot_flag = False
@@ -2599,26 +2626,55 @@ class Net(object):
         return False
 
     def _transfer_base64(self, access, src_file, dst_file):
+        """
+        transfer the file over the console: the compressed file is sent in
+        base64 heredoc chunks, each chunk is verified with cksum and sent
+        again on mismatch, the file is verified with md5sum at the end
+        """
         devname = access["devname"]
         prompt = self._get_param(devname, "normal-user-cli-prompt")
-        script_cmd = "rm -f {}.tmp {}".format(dst_file, dst_file)
+        start_time = time.time()
+        with open(src_file, "rb") as fh:
+            data = fh.read()
+        (payload, decompress) = utils.compress_data(data, self.console_transfer_compress)
+        parts = "{}.part".format(dst_file)
+        script_cmd = "rm -f {0} {1}.*".format(dst_file, parts)
         self._exec(devname, script_cmd, prompt)
-        redir = ">"
-        lines = utils.b64encode(src_file)
-        (count, split) = (len(lines), self.max_cmds_once)
-        for i in range(0, count, split):
-            script_cmds = []
-            for j in range(i, i+split):
-                if j >= count:
+
+        chunk = self.console_transfer_chunk
+        count = max(1, (len(payload) + chunk - 1) // chunk)
+        for index in range(count):
+            part = payload[index * chunk:(index + 1) * chunk]
+            part_file = "{}.{:05d}".format(parts, index)
+            encoded = base64.b64encode(part).decode("ascii")
+            lines = [encoded[i:i + 76] for i in range(0, len(encoded), 76)]
+            script_cmd = "base64 -d > {0} <<'SPYTEST_EOF'\n{1}\nSPYTEST_EOF\ncksum < {0}"
+            script_cmd = script_cmd.format(part_file, "\n".join(lines))
+            expected = (str(utils.cksum(part)), str(len(part)))
+            for retry in range(self.console_transfer_retries + 1):
+                output = self._send_command(access, script_cmd, prompt, True)
+                if expected in re.findall(r"^\s*(\d+)\s+(\d+)\s*$", output, re.M):
                     break
-                script_cmds.append(lines[j])
-            if script_cmds:
-                line = "".join(script_cmds)
-                script_cmd = "echo {} {} {}.tmp".format(line, redir, dst_file)
-                self._send_command(access, script_cmd, prompt, True)
-                redir = ">>"
-        script_cmd = "base64 -d {}.tmp > {}".format(dst_file, dst_file)
-        self._exec(devname, script_cmd, prompt)
+                msg = "Transfer: chunk {}/{} of {} failed CRC check - retry {}"
+                self.dut_log(devname, msg.format(index + 1, count, dst_file, retry + 1),
+                             False, logging.WARNING)
+            else:
+                msg = "Console transfer of {} failed at chunk {}/{}"
+                raise ValueError(msg.format(src_file, index + 1, count))
+
+        script_cmd = "cat {0}.* | {1} > {2} && rm -f {0}.* && md5sum {2}"
+        script_cmd = script_cmd.format(parts, decompress, dst_file)
+        output = self._send_command(access, script_cmd, prompt, True)
+        if utils.md5(src_file) not in output:
+            msg = "Console transfer of {} failed md5 check".format(src_file)
+            raise ValueError(msg)
+
+        elapsed = time.time() - start_time
+        rate = int(len(data) / elapsed) if elapsed else len(data)
+        msg = "Transfer: {} bytes ({} sent in {} chunks) in {:.1f} sec {} bytes/sec"
+        self.dut_log(devname, msg.format(len(data), len(payload), count, elapsed, rate))
+        profile.transfer(access["dut_name"], dst_file, len(data), len(payload),
+                         int(elapsed * 1000))
 
     def _transfer_base64_small(self, access, src_file, dst_file):
         script_cmds = []
@@ -2681,10 +2737,21 @@ class Net(object):
         devname = access["devname"]
         msg = "Creating: DST: {}".format(dst_file)
         self.dut_log(devname, msg)
+        if len(str_list) > l_split and not access["filemode"]:
+            # needs more than one printf - send as compressed chunks instead
+            (fd, local_file) = tempfile.mkstemp()
+            with os.fdopen(fd, "wb") as ofh:
+                ofh.write("\n".join(str_list).encode("utf-8") + b"\n")
+            try:
+                self._transfer_base64(access, local_file, dst_file)
+            finally:
+                os.remove(local_file)
+            return dst_file
         redir = ">"
         for clist in utils.split_list(str_list, l_split):
-            content = "\n".join(clist)
-            script_cmd = "printf '{}\n' {} {}\n".format(content, redir, dst_file)
+            # each line is one argument of printf, written without interpretation
+            content = " ".join([utils.shell_quote(line) for line in clist])
+            script_cmd = "printf '%s\\n' {} {} {}\n".format(content, redir, dst_file)
             cli_prompt = self._get_param(devname, "normal-user-cli-prompt")
             self._exec(devname, script_cmd, cli_prompt, ufcli=False, trace_dut_log=1)
             redir = ">>"
@@ -2715,6 +2782,66 @@ class Net(object):
             self._transfer_base64(access, src_file, dst_file)
         return dst_file
 
+    def _cas_hashes(self, devname, access):
+        """
+        returns the set of file hashes present in the content addressed
+        store on the device, read once per connection as _set_handle
+        drops it whenever the device is connected again
+        """
+        if devname not in self.cas_manifest:
+            prompt = self._get_param(devname, "normal-user-cli-prompt")
+            script_cmd = "sudo mkdir -p {0} && sudo find {0} -type f -mtime +{1} -delete; sudo ls {0}"
+            script_cmd = script_cmd.format(self.cas_dir, self.cas_max_age)
+            output = self._send_command(access, script_cmd, prompt, True)
+            self.cas_manifest[devname] = set(re.findall(r"\b[0-9a-f]{64}\b", output))
+        return self.cas_manifest[devname]
+
+    def _cas_upload(self, devname, access, src_file, remote_file=None):
+        """
+        upload the file into the content addressed store on the device
+        unless a file with the same sha256 is already present there and
+        copy it to the remote file when given
+        returns the remote file or the path of the file in the store
+        """
+        if access["filemode"]:
+            return self._upload_file(access, src_file, remote_file)
+        digest = utils.sha256(src_file)
+        cas_file = "{}/{}".format(self.cas_dir, digest)
+        hashes = self._cas_hashes(devname, access)
+        prompt = self._get_param(devname, "normal-user-cli-prompt")
+        for retry in range(2):
+            script_cmds = []
+            present = bool(digest in hashes)
+            if present:
+                msg = "Transfer: SRC: {} present in {}".format(src_file, cas_file)
+                self.dut_log(devname, msg)
+                # refresh the age so that the prune keeps the files in use
+                script_cmds.append("sudo touch -c {0} && test -f {0}".format(cas_file))
+            else:
+                dst_file = self._upload_file(access, src_file)
+                script_cmds.append("echo '{}  {}' | sha256sum -c --quiet".format(digest, dst_file))
+                script_cmds.append("sudo mkdir -p {}".format(self.cas_dir))
+                script_cmds.append("sudo cp -f {} {}.tmp".format(dst_file, cas_file))
+                script_cmds.append("sudo mv -f {0}.tmp {0}".format(cas_file))
+            if remote_file:
+                script_cmds.append("sudo mkdir -p {}".format(os.path.dirname(remote_file)))
+                script_cmds.append("sudo cp -f {} {}".format(cas_file, remote_file))
+            script_cmd = " && ".join(script_cmds) + " && printf 'SPYTEST-%s\\n' CAS-OK"
+            output = self._send_command(access, script_cmd, prompt, True, 6)
+            if "SPYTEST-CAS-OK" in output:
+                hashes.add(digest)
+                break
+            hashes.discard(digest)
+            if present:
+                # stale manifest entry, upload again
+                msg = "Transfer: {} missing in {} - uploading".format(cas_file, self.cas_dir)
+                self.dut_log(devname, msg, lvl=logging.WARNING)
+                continue
+            msg = "Failed to store {} in {}".format(src_file, cas_file)
+            self.dut_log(devname, msg, False, logging.ERROR)
+            raise ValueError(msg)
+        return remote_file or cas_file
+
     def _upload_file2(self, devname, access, src_file, md5check=False):
         remote_dir = "/etc/spytest"
 
@@ -2737,10 +2864,7 @@ class Net(object):
                 except:
                     pass
             if not skip_transfer:
-                dst_file = self._upload_file(access, src_file)
-                script_cmd = "sudo mkdir -p {} && sudo cp -f {} {}".format(
-                    os.path.dirname(remote_file), dst_file, remote_file)
-                output = self._send_command(access, script_cmd, prompt, False, 6)
+                self._cas_upload(devname, access, src_file, remote_file)
             self.skip_trans_helper[devname][src_file] = remote_file
 
         return self.skip_trans_helper[devname][src_file]
@@ -3009,6 +3133,7 @@ class Net(object):
         if self.cfg.community_build and "--community-build" not in args_str:
             args_str = args_str + " --community-build"
         if self.cfg.load_config_method == "replace": args_str = args_str + " --use-config-replace"
+        if self.config_diff_apply: args_str = args_str + " --use-config-diff"
         script_cmd = "sudo python {} --{} {}  ".format(helper, option_type, args_str)
         #self.dut_log(devname, "Using command: {}".format(script_cmd))
 
@@ -4075,6 +4200,11 @@ class Net(object):
             self.dut_log(devname, msg, lvl=logging.ERROR)
             raise ValueError(msg)
 
+        if self._use_batch(cmd_list, opts):
+            output = self._run_batch(devname, access, cmd_list, opts)
+            if output is not None:
+                return output
+
         if len(cmd_list) > 10 and opts.ctype == "click":
             self._enter_linux_exit_vtysh(devname)
             # execute the command.
@@ -4141,6 +4271,97 @@ class Net(object):
                 op_lines.append(op)
         return "\n".join(op_lines)
 
+    def _use_batch(self, cmd_list, opts):
+        if not self.batch_min_cmds or len(cmd_list) <= self.batch_min_cmds:
+            return False
+        if opts.confirm or opts.expect_reboot:
+            return False
+        if opts.ctype == "click":
+            return True
+        return bool(opts.ctype == "vtysh" and opts.conf and self.batch_vtysh)
+
+    def _parse_batch_output(self, output):
+        frames, index, lines = dict(), None, []
+        for line in output.split("\n"):
+            line = line.rstrip("\r")
+            match = re.match(r"^SPYTEST-BATCH-BEGIN (\d+)\s*$", line)
+            if match:
+                index, lines = int(match.group(1)), []
+                continue
+            match = re.match(r"^SPYTEST-BATCH-END (\d+) (-?\d+)\s*$", line)
+            if match and index is not None:
+                frames[index] = ("\n".join(lines), int(match.group(2)))
+                index = None
+                continue
+            if index is not None:
+                lines.append(line)
+        return frames
+
+    def _run_batch(self, devname, access, cmd_list, opts):
+        """
+        execute the commands with one round trip using the helper on the
+        DUT and run the error checks on the framed output of each command
+        returns None when the batch could not be executed
+        """
+        if access["filemode"]:
+            for cmd in cmd_list:
+                self.dut_log(devname, "BCMD: {}".format(cmd))
+            return ""
+
+        # ensure we are in sonic mode
+        self._enter_linux_exit_vtysh(devname)
+
+        helper = os.path.join(os.path.dirname(__file__), "remote", "spytest-helper.py")
+        helper = self._upload_file2(devname, access, os.path.abspath(helper), md5check=True)
+
+        # transfer the commands
+        (fd, local_file) = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as ofh:
+            ofh.write(json.dumps(cmd_list))
+        try:
+            batch_file = self._upload_file(access, local_file, "/tmp/spytest_batch.json")
+        finally:
+            os.remove(local_file)
+
+        # execute the commands
+        self.dut_log(devname, "Executing {} {} commands in batch".format(len(cmd_list), opts.ctype))
+        script_cmd = "sudo python {} --run-batch {} --batch-type {}".format(helper, batch_file, opts.ctype)
+        delay_factor = utils.max(opts.cmds_delay_factor, int(math.ceil(len(cmd_list) / 50.0)))
+        cli_prompt = self._get_param(devname, "normal-user-cli-prompt")
+        output = self._send_command(access, script_cmd, cli_prompt, True,
+                                    delay_factor, trace_dut_log=1)
+        frames = self._parse_batch_output(output)
+        if not frames:
+            self.dut_log(devname, output, lvl=logging.WARNING)
+            self.dut_log(devname, "Batch execution failed - sending the commands individually",
+                         lvl=logging.WARNING)
+            return None
+
+        # check the errors per command
+        op_lines = []
+        for index, cmd in enumerate(cmd_list):
+            (op, retcode) = frames.get(index, ("", None))
+            self.dut_log(devname, "BCMD: {}".format(cmd))
+            if op: self.dut_log(devname, op)
+            if retcode is None:
+                msg = "Batch command '{}' is not executed".format(cmd)
+                self.dut_log(devname, msg, lvl=logging.WARNING)
+            elif retcode != 0:
+                msg = "Batch command '{}' exited with {}".format(cmd, retcode)
+                self.dut_log(devname, msg, lvl=logging.WARNING)
+            op_lines.append(self._check_error(access, cmd, op, opts.skip_error_check))
+
+        # output which the helper could not tie to a command
+        (op, retcode) = frames.get(len(cmd_list), ("", None))
+        if op:
+            self.dut_log(devname, op)
+            if retcode:
+                msg = "Batch of {} commands exited with {}".format(len(cmd_list), retcode)
+                self.dut_log(devname, msg, lvl=logging.WARNING)
+            batch_cmd = "\n".join(cmd_list)
+            op_lines.append(self._check_error(access, batch_cmd, op, opts.skip_error_check))
+        return "\n".join(op_lines)
+
     def exec_ssh_remote_dut(self, devname, ipaddress, username, password, command=None, timeout=30):
         devname = self._check_devname(devname)
         access = self._get_dev_access(devname)
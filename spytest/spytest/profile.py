@@ -1,24 +1,111 @@
+import os
+import re
+import json
+import calendar
+import threading
+from collections import deque
 
 from spytest.st_time import get_timenow
 from spytest.dicts import SpyTestDict
 import spytest.logger as logger
+import utilities.common as utils
+
+max_events = int(os.getenv("SPYTEST_PROFILE_MAX_EVENTS", "10000"))
+max_templates = int(os.getenv("SPYTEST_PROFILE_MAX_TEMPLATES", "500"))
+
+template_patterns = [
+    (re.compile(r"([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}"), "<mac>"),
+    (re.compile(r"\d+\.\d+\.\d+\.\d+(/\d+)?"), "<ip>"),
+    (re.compile(r"\b[0-9a-fA-F]{0,4}(:[0-9a-fA-F]{0,4}){2,7}(/\d+)?"), "<ip>"),
+    (re.compile(r"\d+"), "<n>"),
+]
+
+def get_template(msg, width=120):
+    """
+    Normalize the command by replacing the values which change between
+    the invocations (addresses, numbers) so that the similar commands
+    are aggregated together.
+    """
+    for pattern, repl in template_patterns:
+        msg = pattern.sub(repl, msg)
+    return msg[:width]
+
+class Histogram(object):
+    """
+    Log-linear (HDR style) histogram of the values in milliseconds.
+    The memory is bounded by the number of buckets and the relative
+    error of the percentiles is bounded by 1/16.
+    """
+    sub_bits = 4
+
+    def __init__(self):
+        self.buckets = dict()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        if value < (1 << cls.sub_bits):
+            return value
+        shift = value.bit_length() - cls.sub_bits - 1
+        return (shift << cls.sub_bits) + (value >> shift)
+
+    @classmethod
+    def _value(cls, index):
+        if index < (2 << cls.sub_bits):
+            return index
+        shift = (index >> cls.sub_bits) - 1
+        mantissa = (index & ((1 << cls.sub_bits) - 1)) + (1 << cls.sub_bits)
+        # middle of the bucket range
+        return (mantissa << shift) + (1 << shift) // 2
+
+    def record(self, value):
+        value = max(int(value), 0)
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = max(int(self.count * percent / 100.0 + 0.5), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen = seen + self.buckets[index]
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
 
 class Profile(object):
 
     def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = get_timenow()
         self.pnfound = 0
         self.tg_total_wait = 0
         self.tc_total_wait = 0
-        self.tg_total_wait = 0
         self.tc_cmd_time = 0
-        self.tc_cmds = []
+        self.tc_cmds = deque(maxlen=max_events)
         self.tg_cmd_time = 0
-        self.tg_cmds = []
+        self.tg_cmds = deque(maxlen=max_events)
         self.infra_cmd_time = 0
-        self.infra_cmds = []
-        self.cmds = []
+        self.infra_cmds = deque(maxlen=max_events)
+        self.xfer_bytes = 0
+        self.xfer_time = 0
+        self.cmds = deque(maxlen=max_events)
+        self.dropped = 0
         self.profile_ids = dict()
+        self.next_id = 0
+        self.templates = dict()
+        self.duts = dict()
+        self.threads = dict()
+        self.serial_run = None
         self.canbe_parallel = []
+        self.serial_runs = dict()
 
     def init(self):
         self.__init__()
@@ -26,65 +113,231 @@ class Profile(object):
     def start(self, msg, dut=None, data=None):
         msg = msg.replace("\r", "")
         msg = msg.replace("\n", "\\n")
-        count = len(self.profile_ids)
-        self.profile_ids[count] = [get_timenow(), dut, msg, data]
-        return count
+        with self.lock:
+            pid = self.next_id
+            self.next_id = pid + 1
+            self.profile_ids[pid] = [get_timenow(), dut, msg, data]
+        return pid
 
     def stop(self, pid):
-        [start_time, dut, msg, data] = self.profile_ids[pid]
+        with self.lock:
+            [start_time, dut, msg, data] = self.profile_ids.pop(pid)
         delta = get_timenow() - start_time
         cmd_time = int(delta.total_seconds() * 1000)
         thid = logger.get_thread_name()
-        if dut:
-            if pid > 0 and thid == "T0000: ":
-                [pstart_time, pdut, pmsg, pdata] = self.profile_ids[pid-1]
-                if pmsg == msg and dut != pdut:
-                    self.canbe_parallel.append([start_time, msg, dut, pdut])
+        with self.lock:
+            if not dut:
+                self.tg_cmds.append([start_time, thid, dut, msg, cmd_time])
+                self.tg_cmd_time = self.tg_cmd_time + cmd_time
+                self._add_cmd(start_time, thid, "TG", dut, msg, cmd_time)
+                return data
             if "spytest-helper.py" in msg:
                 self.infra_cmds.append([start_time, thid, dut, msg, cmd_time])
                 self.infra_cmd_time = self.infra_cmd_time + cmd_time
-                self.cmds.append([start_time, thid, "INFRA", dut, msg, cmd_time])
+                template = self._add_cmd(start_time, thid, "INFRA", dut, msg, cmd_time)
             else:
                 self.tc_cmds.append([start_time, thid, dut, msg, cmd_time])
                 self.tc_cmd_time = self.tc_cmd_time + cmd_time
-                self.cmds.append([start_time, thid, "CMD", dut, msg, cmd_time])
-        else:
-            self.tg_cmds.append([start_time, thid, dut, msg, cmd_time])
-            self.tg_cmd_time = self.tg_cmd_time + cmd_time
-            self.cmds.append([start_time, thid, "TG", dut, msg, cmd_time])
+                template = self._add_cmd(start_time, thid, "CMD", dut, msg, cmd_time)
+            if thid == "T0000: ":
+                self._check_serial(start_time, dut, msg, template, cmd_time)
         return data
 
+    def _histogram(self, table, key):
+        if key not in table:
+            table[key] = Histogram()
+        return table[key]
+
+    def _add_cmd(self, start_time, thid, ctype, dut, msg, cmd_time):
+        if len(self.cmds) == self.cmds.maxlen:
+            self.dropped = self.dropped + 1
+        self.cmds.append([start_time, thid, ctype, dut, msg, cmd_time])
+        template = get_template(msg)
+        if (ctype, template) not in self.templates and len(self.templates) >= max_templates:
+            template = "<other>"
+        self._histogram(self.templates, (ctype, template)).record(cmd_time)
+        self._histogram(self.duts, (ctype, dut)).record(cmd_time)
+        self._histogram(self.threads, (ctype, thid.strip(": "))).record(cmd_time)
+        return template
+
+    def _check_serial(self, start_time, dut, msg, template, cmd_time):
+        # same command executed on different DUTs one after the other
+        run = self.serial_run
+        if run and run.template == template and dut not in run.duts:
+            run.duts.append(dut)
+            run.times.append(cmd_time)
+            return
+        self._flush_serial()
+        self.serial_run = SpyTestDict(template=template, msg=msg, start_time=start_time,
+                                      duts=[dut], times=[cmd_time])
+
+    def _flush_serial(self):
+        run = self.serial_run
+        self.serial_run = None
+        if not run or len(run.duts) < 2:
+            return
+        # time that can be saved by executing on all DUTs in parallel
+        saving = sum(run.times) - max(run.times)
+        entry = self.serial_runs.get(run.template)
+        if entry is None:
+            if len(self.serial_runs) >= max_templates:
+                return
+            entry = [run.start_time, run.msg, run.duts, 0, 0]
+            self.serial_runs[run.template] = entry
+            self.canbe_parallel.append(entry)
+        if len(run.duts) > len(entry[2]):
+            entry[2] = run.duts
+        entry[3] = entry[3] + 1
+        entry[4] = entry[4] + saving
+
     def wait(self, val, is_tg=False):
         start_time = get_timenow()
         thid = logger.get_thread_name()
-        if is_tg:
-            self.tg_total_wait = self.tg_total_wait + val
-            self.cmds.append([start_time, thid, "TGWAIT", None, "TG sleep", val])
-        else:
-            self.tc_total_wait = self.tc_total_wait + val
-            self.cmds.append([start_time, thid, "WAIT", None, "static delay", val])
+        with self.lock:
+            if len(self.cmds) == self.cmds.maxlen:
+                self.dropped = self.dropped + 1
+            if is_tg:
+                self.tg_total_wait = self.tg_total_wait + val
+                self.cmds.append([start_time, thid, "TGWAIT", None, "TG sleep", val])
+            else:
+                self.tc_total_wait = self.tc_total_wait + val
+                self.cmds.append([start_time, thid, "WAIT", None, "static delay", val])
+
+    def transfer(self, dut, dst_file, size, sent, xfer_time):
+        start_time = get_timenow()
+        thid = logger.get_thread_name()
+        rate = int(size * 1000 / xfer_time) if xfer_time else size
+        msg = "{} {} bytes {} sent {} bytes/sec".format(dst_file, size, sent, rate)
+        with self.lock:
+            self.xfer_bytes = self.xfer_bytes + size
+            self.xfer_time = self.xfer_time + xfer_time
+            if len(self.cmds) == self.cmds.maxlen:
+                self.dropped = self.dropped + 1
+            self.cmds.append([start_time, thid, "XFER", dut, msg, xfer_time])
+            self._histogram(self.duts, ("XFER", dut)).record(xfer_time)
 
     def prompt_nfound(self, cmd):
         start_time = get_timenow()
         thid = logger.get_thread_name()
-        self.pnfound = self.pnfound + 1
-        self.cmds.append([start_time, thid, "PROMPT_NFOUND", None, cmd, ""])
+        with self.lock:
+            self.pnfound = self.pnfound + 1
+            if len(self.cmds) == self.cmds.maxlen:
+                self.dropped = self.dropped + 1
+            self.cmds.append([start_time, thid, "PROMPT_NFOUND", None, cmd, ""])
 
     def get_stats(self):
-        stats = SpyTestDict()
-        stats.tg_total_wait = self.tg_total_wait
-        stats.tc_total_wait = self.tc_total_wait
-        stats.tc_cmd_time = self.tc_cmd_time
-        stats.tc_cmds = self.tc_cmds
-        stats.tg_cmd_time = self.tg_cmd_time
-        stats.tg_cmds = self.tg_cmds
-        stats.infra_cmd_time = self.infra_cmd_time
-        stats.infra_cmds = self.infra_cmds
-        stats.cmds = self.cmds
-        stats.canbe_parallel = self.canbe_parallel
-        stats.pnfound = self.pnfound
+        with self.lock:
+            self._flush_serial()
+            stats = SpyTestDict()
+            stats.start_time = self.start_time
+            stats.tg_total_wait = self.tg_total_wait
+            stats.tc_total_wait = self.tc_total_wait
+            stats.tc_cmd_time = self.tc_cmd_time
+            stats.tc_cmds = list(self.tc_cmds)
+            stats.tg_cmd_time = self.tg_cmd_time
+            stats.tg_cmds = list(self.tg_cmds)
+            stats.infra_cmd_time = self.infra_cmd_time
+            stats.infra_cmds = list(self.infra_cmds)
+            stats.xfer_bytes = self.xfer_bytes
+            stats.xfer_time = self.xfer_time
+            stats.cmds = list(self.cmds)
+            stats.dropped = self.dropped
+            stats.templates = dict(self.templates)
+            stats.duts = dict(self.duts)
+            stats.threads = dict(self.threads)
+            stats.canbe_parallel = sorted(self.canbe_parallel, key=lambda e: e[4], reverse=True)
+            stats.pnfound = self.pnfound
         return stats
 
+def _histogram_rows(table, top=None):
+    rows = []
+    items = sorted(table.items(), key=lambda item: item[1].total, reverse=True)
+    for (ctype, name), hist in items[:top]:
+        rows.append([ctype, name, hist.count, hist.total, hist.percentile(50),
+                     hist.percentile(95), hist.percentile(99), hist.max])
+    return rows
+
+def format_stats(stats, top=20):
+    """
+    Build the latency report (milliseconds) of the commands profiled in the test.
+    """
+    header = ["Type", "Command", "Count", "Total", "P50", "P95", "P99", "Max"]
+    lines = []
+    if stats.dropped:
+        lines.append("{} oldest events are not listed".format(stats.dropped))
+    if stats.templates:
+        lines.append("Top {} commands by time:".format(top))
+        lines.append(utils.sprint_vtable(header, _histogram_rows(stats.templates, top)))
+    if stats.duts:
+        header[1] = "DUT"
+        lines.append(utils.sprint_vtable(header, _histogram_rows(stats.duts)))
+    if stats.threads:
+        header[1] = "Thread"
+        lines.append(utils.sprint_vtable(header, _histogram_rows(stats.threads)))
+    if stats.canbe_parallel:
+        header = ["Command", "DUTs", "Count", "Saving (ms)"]
+        rows = []
+        for [start_time, msg, duts, count, saving] in stats.canbe_parallel[:top]:
+            rows.append([msg[:80], ",".join(duts), count, saving])
+        lines.append("Serial commands on different DUTs that can use exec_foreach:")
+        lines.append(utils.sprint_vtable(header, rows))
+    return "\n".join(lines)
+
+def _timestamp_us(value):
+    return calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+
+def _trace_tid(thid):
+    try:
+        return int(thid.strip(": ").replace("T", ""))
+    except Exception:
+        return abs(hash(thid)) % 100000
+
+def get_trace_events(name, stats, pid=1):
+    """
+    Build Chrome trace events (viewable in chrome://tracing, perfetto or
+    speedscope) for the commands profiled in the test.
+    """
+    end_time = get_timenow()
+    start_us = _timestamp_us(stats.start_time)
+    events = [{"name": name, "cat": "TEST", "ph": "X", "pid": pid, "tid": 0,
+               "ts": start_us, "dur": _timestamp_us(end_time) - start_us}]
+    threads = dict()
+    for [start_time, thid, ctype, dut, cmd, ctime] in stats.cmds:
+        tid = _trace_tid(thid)
+        threads[tid] = thid.strip(": ")
+        event = {"name": cmd[:80], "cat": ctype, "pid": pid, "tid": tid,
+                 "ts": _timestamp_us(start_time), "args": {"dut": dut, "cmd": cmd}}
+        if ctype == "PROMPT_NFOUND":
+            event["ph"] = "i"
+            event["s"] = "t"
+        elif ctype in ["WAIT", "TGWAIT"]:
+            event["ph"] = "X"
+            event["dur"] = int(ctime * 1000000)
+        else:
+            event["ph"] = "X"
+            event["dur"] = int(ctime) * 1000
+        events.append(event)
+    for tid, thname in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                       "args": {"name": thname}})
+    return events
+
+def write_trace(filepath, name, stats):
+    """
+    Append the trace events of the test to the file keeping it a valid JSON array.
+    """
+    events = get_trace_events(name, stats)
+    data = ",\n".join([json.dumps(event) for event in events])
+    footer = "\n]\n"
+    if not os.path.exists(filepath) or os.path.getsize(filepath) < len(footer) + 1:
+        with open(filepath, "w") as fd:
+            fd.write("[\n" + data + footer)
+        return
+    with open(filepath, "r+") as fd:
+        fd.seek(0, os.SEEK_END)
+        fd.seek(fd.tell() - len(footer))
+        fd.write(",\n" + data + footer)
+
 obj = Profile()
 def init():
     return obj.init()
@@ -101,6 +354,8 @@ def wait(val, is_tg=False):
 def get_stats():
     return obj.get_stats()
 
+def transfer(dut, dst_file, size, sent, xfer_time):
+    return obj.transfer(dut, dst_file, size, sent, xfer_time)
+
 def prompt_nfound(cmd):
     return obj.prompt_nfound(cmd)
-
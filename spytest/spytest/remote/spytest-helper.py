@@ -16,6 +16,7 @@ import argparse
 import subprocess
 
 g_use_config_replace = False
+g_use_config_diff = False
 g_community_build = False
 g_breakout_native = False
 g_breakout_file = None
@@ -50,6 +51,20 @@ tech_support_timestamp = spytest_dir + "/tech_support_timestamp.txt"
 
 port_config_file = "/usr/share/sonic/device"
 
+# changes in these tables need the services to be restarted
+config_diff_reload_tables = ["DEVICE_METADATA", "PORT", "BREAKOUT_CFG", "MGMT_PORT",
+                             "MGMT_INTERFACE", "MGMT_VRF_CONFIG", "FEATURE"]
+config_diff_max_ops = int(os.getenv("SPYTEST_CONFIG_DIFF_MAX_OPS", "20000"))
+# tables whose keys refer to the keys of another table, tables named
+# <PARENT>_<SUFFIX> are taken as children of <PARENT> when not listed
+config_diff_table_parents = {"VLAN_MEMBER": "VLAN", "VLAN_INTERFACE": "VLAN",
+                             "PORTCHANNEL_MEMBER": "PORTCHANNEL",
+                             "PORTCHANNEL_INTERFACE": "PORTCHANNEL",
+                             "INTERFACE": "VRF", "LOOPBACK_INTERFACE": "VRF",
+                             "ACL_RULE": "ACL_TABLE", "BGP_NEIGHBOR": "VRF",
+                             "STATIC_ROUTE": "VRF"}
+config_diff_batch = 1000
+
 cores_tar_file_name = "/tmp/allcorefiles.tar.gz"
 kdump_tar_file_name = "/tmp/allkdumpfiles.tar.gz"
 
@@ -199,6 +214,132 @@ def get_file_diff(file1, file2, show_diff=False):
 
     return False
 
+def config_db_client():
+    try:
+        from swsssdk import ConfigDBConnector
+        config_db = ConfigDBConnector()
+        config_db.db_connect(config_db.CONFIG_DB)
+        return config_db.get_redis_client(config_db.CONFIG_DB)
+    except Exception as exp:
+        print("Failed to connect to CONFIG_DB: {}".format(exp))
+        return None
+
+def config_db_raw(entry):
+    # same encoding as ConfigDBConnector.typed_to_raw
+    if not entry:
+        return {"NULL": "NULL"}
+    raw = dict()
+    for field, value in entry.items():
+        if isinstance(value, list):
+            raw[field + "@"] = ",".join(value)
+        else:
+            raw[field] = str(value)
+    return raw
+
+def config_db_read(client, data):
+    # read the current fields of the keys in data in one pipeline
+    keys = []
+    for table, entries in data.items():
+        for key in entries:
+            keys.append("{}|{}".format(table, key))
+    current = dict()
+    for start in range(0, len(keys), config_diff_batch):
+        batch = keys[start:start + config_diff_batch]
+        pipe = client.pipeline(transaction=False)
+        for key in batch:
+            pipe.hgetall(key)
+        for key, fields in zip(batch, pipe.execute()):
+            if fields:
+                current[key] = fields
+    return current
+
+def config_db_delta(current, target):
+    """
+    key level delta to merge the target tables into CONFIG_DB
+    the same way config load does - keys and fields not present
+    in target are left as they are
+    current: raw fields keyed by redis key
+    target: config_db.json like dictionary
+    returns list of (redis key, fields to set)
+    """
+    ops = []
+    for table, entries in target.items():
+        for key, entry in entries.items():
+            redis_key = "{}|{}".format(table, key)
+            raw = config_db_raw(entry)
+            cur = current.get(redis_key, {})
+            changed = dict((f, v) for f, v in raw.items() if cur.get(f) != v)
+            if changed:
+                ops.append((redis_key, changed))
+    return ops
+
+def config_db_table_depth(table, tables, seen=None):
+    parent = config_diff_table_parents.get(table)
+    if not parent:
+        for name in tables:
+            if table.startswith(name + "_") and (not parent or len(name) > len(parent)):
+                parent = name
+    seen = seen or set([table])
+    if not parent or parent in seen:
+        return 0
+    seen.add(parent)
+    return 1 + config_db_table_depth(parent, tables, seen)
+
+def config_db_order_delta(ops):
+    """
+    order the delta so that the parent keys (vlan/portchannel/vrf) are
+    written before their members and interfaces; keys with more "|"
+    separated parts (ip address of an interface) are taken as children
+    of the shorter
+    """
+    tables = set([redis_key.split("|")[0] for redis_key, _ in ops])
+    depth = dict([(table, config_db_table_depth(table, tables)) for table in tables])
+    def rank(op):
+        parts = op[0].split("|")
+        return (depth[parts[0]], len(parts))
+    return sorted(ops, key=rank)
+
+def config_db_apply_delta(client, ops):
+    for start in range(0, len(ops), config_diff_batch):
+        pipe = client.pipeline(transaction=False)
+        for redis_key, changed in ops[start:start + config_diff_batch]:
+            pipe.hmset(redis_key, changed)
+        pipe.execute()
+
+def config_db_apply_diff(filepath):
+    """
+    write only the changed keys and fields of the file into CONFIG_DB
+    giving the same result as config load
+    returns False when the changes need a config load instead
+    """
+    if not g_use_config_diff or not os.path.exists(filepath):
+        return False
+    target = read_json(filepath)
+    client = config_db_client()
+    if client is None:
+        return False
+    try:
+        current = config_db_read(client, target)
+        ops = config_db_delta(current, target)
+        tables = set([redis_key.split("|")[0] for redis_key, _ in ops])
+        reload_tables = tables.intersection(config_diff_reload_tables)
+        if reload_tables:
+            print("Config diff has changes in {} - using full load".format(sorted(reload_tables)))
+            return False
+        if len(ops) > config_diff_max_ops:
+            print("Config diff has {} changes - using full load".format(len(ops)))
+            return False
+        config_db_apply_delta(client, config_db_order_delta(ops))
+    except Exception as exp:
+        print("Failed to apply config diff: {} - using full load".format(exp))
+        return False
+    print("Config diff applied {} changes in {} tables".format(len(ops), len(tables)))
+    return True
+
+def config_load(filepath):
+    if not config_db_apply_diff(filepath):
+        execute_check_cmd("config load -y {}".format(filepath))
+
 def json_fix(filepath):
     data = open(filepath, 'rU').read()
     try:
@@ -247,7 +388,8 @@ def apply_file(filepath, method):
         if method == "full":
             commands_to_execute.append("cp {} {}".format(filepath, init_config_file))
         else:
-            commands_to_execute.append("config load -y {}".format(filepath))
+            if not config_db_apply_diff(filepath):
+                commands_to_execute.append("config load -y {}".format(filepath))
             commands_to_execute.append("config save -y")
     elif filepath.endswith('.copp'):
         filepath = json_fix(filepath)
@@ -734,6 +876,63 @@ def run_test(script_fullpath, proc_args):
         return
     print("Script '{}' not exists".format(script_fullpath))
 
+def to_text(data):
+    if isinstance(data, bytes):
+        return data.decode("utf-8", "ignore")
+    return data
+
+def print_batch_frame(index, output, retcode):
+    print("SPYTEST-BATCH-BEGIN {}".format(index))
+    if output.strip() != "":
+        print(output.rstrip())
+    print("SPYTEST-BATCH-END {} {}".format(index, retcode))
+
+def run_batch_click(cmds):
+    for index, cmd in enumerate(cmds):
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, shell=True)
+            out, _ = proc.communicate()
+            print_batch_frame(index, to_text(out), proc.returncode)
+        except Exception as exp:
+            print_batch_frame(index, "Exception: {}".format(exp), -1)
+
+def run_batch_vtysh(cmds):
+    # vtysh reports the failures with the line number of the input file
+    lines = []
+    for cmd in cmds:
+        if cmd.strip() in ["configure terminal", "end"]:
+            cmd = ""
+        lines.append(cmd)
+    batch_file = "/tmp/spytest_batch_vtysh.conf"
+    with open(batch_file, "w") as outfile:
+        outfile.write("\n".join(lines) + "\n")
+    proc = subprocess.Popen("vtysh -f {}".format(batch_file), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, shell=True)
+    out, _ = proc.communicate()
+    (outputs, others) = ([[] for _ in cmds], [])
+    for line in to_text(out).split("\n"):
+        match = re.match(r"^line (\d+):", line)
+        if match and 0 < int(match.group(1)) <= len(cmds):
+            outputs[int(match.group(1)) - 1].append(line)
+        elif line.strip():
+            others.append(line)
+    for index, output in enumerate(outputs):
+        failed = [line for line in output if line.startswith("line ")]
+        print_batch_frame(index, "\n".join(output), 1 if failed else 0)
+    # the output without line number can not be tied to a command
+    # report it in an extra frame against the whole batch
+    if others:
+        print_batch_frame(len(cmds), "\n".join(others), proc.returncode)
+
+def run_batch(file_path, batch_type):
+    with open(file_path, "r") as infile:
+        cmds = json.load(infile)
+    if batch_type == "vtysh":
+        run_batch_vtysh(cmds)
+    else:
+        run_batch_click(cmds)
+
 def enable_disable_debug(flag):
     if not os.path.exists(syslog_file):
         print("==============================================================================")
@@ -942,6 +1141,10 @@ if __name__ == "__main__":
             choices=['clear', 'read', 'none', 'clean'], help="read sairedis messages.")
     parser.add_argument("--execute-from-file", action="store", default=None,
             help="execute commands from file.")
+    parser.add_argument("--run-batch", action="store", default=None,
+            help="execute the commands from json file and frame the output of each.")
+    parser.add_argument("--batch-type", action="store", default="click",
+            choices=['click', 'vtysh'], help="type of the batch commands.")
     parser.add_argument("--set-mgmt-ip", action="store", default=None,
             choices=['dhcp', 'static', None], help="Management(eth0) address type.")
     parser.add_argument("--ip-addr-mask", action="store", default=None,
@@ -980,6 +1183,10 @@ if __name__ == "__main__":
             help="Use port breakout options from file.")
     parser.add_argument("--use-config-replace", action="store_true", default=False,
             help="use config replace where ever config reload is needed.")
+    parser.add_argument("--use-config-diff", action="store_true", default=False,
+            help="apply only the changed CONFIG_DB keys where ever possible.")
+    parser.add_argument("--config-load", action="store", default=None,
+            help="load the json file into CONFIG_DB.")
     parser.add_argument("--debug", action="store_true", default=False)
 
     args, unknown = parser.parse_known_args()
@@ -992,6 +1199,7 @@ if __name__ == "__main__":
     g_breakout_native = args.breakout_native
     g_breakout_file = args.breakout_file
     g_use_config_replace = args.use_config_replace
+    g_use_config_diff = args.use_config_diff
 
     for name, value in args.env:
         os.environ[name] = value
@@ -1012,6 +1220,8 @@ if __name__ == "__main__":
         apply_ta_config(args.apply_base_config, args.port_init_wait, args.poll_for_ports, False)
     elif args.apply_module_config:
         apply_ta_config(args.apply_module_config, args.port_init_wait, args.poll_for_ports, True)
+    elif args.config_load:
+        config_load(args.config_load)
     elif args.json_diff:
         retval = get_file_diff(args.json_diff[0], args.json_diff[1], True)
         print(retval)
@@ -1025,6 +1235,8 @@ if __name__ == "__main__":
         do_sairedis(args.sairedis)
     elif args.execute_from_file:
         execute_from_file(args.execute_from_file)
+    elif args.run_batch:
+        run_batch(args.run_batch, args.batch_type)
     elif args.set_mgmt_ip:
         mgmt_ip_setting(args.set_mgmt_ip, args.ip_addr_mask, args.gw_addr)
     elif args.fetch_core_files:
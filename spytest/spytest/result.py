@@ -1,11 +1,14 @@
 import sys
 import csv
 import os
+import glob
+import heapq
 
 import utilities.common as utils
 
 from spytest.st_time import get_timestamp
 from spytest.datamap import DataMap
+from spytest.dicts import SpyTestDict
 
 from .mail import send as email
 
@@ -316,3 +319,148 @@ class Result(object):
             png_file = os.path.splitext(filepath)[0]+'.png'
             Result.write_report_png(png_file, l_rows, index)
 
+
+class ResultMerger(object):
+    """
+    Merges the result files of all the batch nodes incrementally.
+    Only the rows appended to the node files since the previous call are
+    parsed and the consolidated files are appended when the new merged
+    rows follow the ones already written, which is the common case
+    while the batch is progressing.
+    """
+
+    def __init__(self, suffix, offset, rtype, sort_index=None, link_func=None):
+        self.suffix = suffix
+        self.offset = offset
+        self.rtype = rtype
+        self.sort_index = sort_index
+        self.link_func = link_func
+        self.csv_files = []
+        self.files = dict()
+        self.entries = []
+        self.written = None
+        self.html_offset = None
+
+    def _read_file(self, csv_file, gw_name):
+        state = self.files.get(csv_file)
+        try:
+            size = os.path.getsize(csv_file)
+        except OSError:
+            size = 0
+        if state is None or size < state.pos:
+            # new or rewritten file
+            state = SpyTestDict(pos=0, entries=[], names=set(), ordered=True)
+            self.files[csv_file] = state
+        if size <= state.pos:
+            return
+        with open(csv_file, "rb") as fd:
+            fd.seek(state.pos)
+            data = fd.read(size - state.pos)
+
+        # parse only complete lines and not in the middle of quoted value
+        end = data.rfind(b"\n") + 1
+        if end <= 0 or data.count(b'"', 0, end) % 2:
+            return
+        state.pos = state.pos + end
+        # split only on newline, splitlines also breaks on \x0c etc. which
+        # the csv writer does not quote
+        lines = [line + b"\n" for line in data[:end-1].split(b"\n")]
+        if sys.version_info.major >= 3:
+            lines = [line.decode("utf-8", "replace") for line in lines]
+
+        new_entries = []
+        for row in csv.reader(lines):
+            if len(row) <= self.offset + 1 or row[0] == '#':
+                continue
+            row.pop(0)
+            key = row[self.offset]
+            link = self.link_func(key, csv_file, gw_name) if self.link_func else None
+            row.insert(0, gw_name)
+            if self.sort_index is None:
+                sort_key = None
+            else:
+                sort_key = (row + [link])[self.sort_index]
+            state.names.add(key)
+            new_entries.append((sort_key, key, row, link))
+        if self.sort_index is not None:
+            last = state.entries[-1][0] if state.entries else None
+            for entry in new_entries:
+                if last is not None and entry[0] < last:
+                    state.ordered = False
+                    break
+                last = entry[0]
+        state.entries.extend(new_entries)
+
+    def read(self, logs_path):
+        pattern = os.path.join(logs_path, "gw*", "*_{}.csv".format(self.suffix))
+        csv_files = glob.glob(pattern)
+        csv_files.sort(key=os.path.basename)
+        for csv_file in csv_files:
+            gw_name = os.path.basename(os.path.dirname(csv_file))
+            self._read_file(csv_file, gw_name)
+        self.csv_files = csv_files
+        self.entries = self._merge()
+        return self.entries
+
+    def _merge(self):
+        # the rows of a module are taken from the last file having it
+        owner = dict()
+        for index, csv_file in enumerate(self.csv_files):
+            for key in self.files[csv_file].names:
+                owner[key] = index
+
+        file_entries = []
+        for index, csv_file in enumerate(self.csv_files):
+            state = self.files[csv_file]
+            if not state.ordered:
+                state.entries.sort(key=lambda entry: entry[0])
+                state.ordered = True
+            file_entries.append([entry for entry in state.entries if owner[entry[1]] == index])
+
+        if self.sort_index is None:
+            return [entry for entries in file_entries for entry in entries]
+
+        # stable merge of the sorted files, equal keys are kept in the file order
+        iterables = []
+        for index, entries in enumerate(file_entries):
+            iterables.append([(entry[0], index, seq, entry) for seq, entry in enumerate(entries)])
+        return [item[3] for item in heapq.merge(*iterables)]
+
+    def get(self):
+        rows = [entry[2] for entry in self.entries]
+        links = [entry[3] for entry in self.entries]
+        return [rows, links]
+
+    def write(self, csv_file, html_file=None, index=3):
+        """
+        Write the merged rows into consolidated csv and html files
+        :return: True if the files are changed
+        """
+        count = len(self.written or [])
+        appended = self.written is not None and count <= len(self.entries)
+        appended = appended and os.path.exists(csv_file)
+        if appended and html_file:
+            appended = os.path.exists(html_file) and self.html_offset is not None
+        if appended:
+            for old, new in zip(self.written, self.entries):
+                if old is not new:
+                    appended = False
+                    break
+        if appended and count == len(self.entries):
+            return False
+        start = count if appended else 0
+
+        new_rows = []
+        for i, entry in enumerate(self.entries[start:]):
+            new_rows.append([start + i + 1] + entry[2])
+        utils.write_csv_file(merge_cols[self.rtype], new_rows, csv_file, appended)
+        if html_file:
+            offset = self.html_offset if appended else None
+            self.html_offset = utils.write_html_table3(merge_cols[self.rtype],
+                                                       new_rows, html_file, offset)
+            if self.rtype in [0, 1]:
+                png_file = os.path.splitext(html_file)[0]+'.png'
+                l_rows = Result.prepend_row_index(self.get()[0])
+                Result.write_report_png(png_file, l_rows, index)
+        self.written = list(self.entries)
+        return True
@@ -1,5 +1,9 @@
 import sys
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 
 import textfsm
 try:
@@ -7,6 +11,38 @@ try:
 except:
     import textfsm.clitable as clitable
 
+# compiled templates shared by all Template objects, keyed by file path
+compiled_templates = dict()
+compiled_lock = threading.Lock()
+
+# index lookup results keyed by (root, command, platform)
+index_cache = dict()
+
+# parsed results keyed by (templates, output digest)
+parse_cache = OrderedDict()
+parse_cache_lock = threading.Lock()
+parse_cache_size = int(os.getenv("SPYTEST_TEMPLATE_CACHE_SIZE", "128"))
+
+def get_compiled(tmpl_path):
+    entry = compiled_templates.get(tmpl_path, None)
+    if entry is None:
+        with compiled_lock:
+            entry = compiled_templates.get(tmpl_path, None)
+            if entry is None:
+                with open(tmpl_path, "r") as tmpl_fp:
+                    fsm = textfsm.TextFSM(tmpl_fp)
+                entry = (fsm, threading.Lock())
+                compiled_templates[tmpl_path] = entry
+    return entry
+
+def copy_rows(rows):
+    retval = []
+    for row in rows:
+        new_row = {}
+        for name, value in row.items():
+            new_row[name] = list(value) if isinstance(value, list) else value
+        retval.append(new_row)
+    return retval
 
 class Template(object):
     """
@@ -36,20 +72,28 @@ class Template(object):
         except:
             return ""
 
-    def apply(self, output, cmd):
+    def lookup(self, cmd):
         """
-        todo: Update Documentation
-        :param output:
-        :type output:
-        :param cmd:
-        :type cmd:
-        :return:
-        :rtype:
+        returns the template names from the index for the command or None
         """
-        attrs = dict(Command=cmd)
-        if self.platform: attrs["Platform"] = self.platform
-        try:
-            self.cli_table.ParseCmd(output, attrs)
+        key = (self.root, cmd, self.platform)
+        if key not in index_cache:
+            attrs = dict(Command=cmd)
+            if self.platform: attrs["Platform"] = self.platform
+            row_idx = self.cli_table.index.GetRowMatch(attrs)
+            if row_idx:
+                index_cache[key] = self.cli_table.index.index[row_idx]['Template']
+            else:
+                index_cache[key] = None
+        return index_cache[key]
+
+    def parse(self, templates, output):
+        """
+        parse the output with the compiled template, multiple templates
+        separated by ':' are merged by CliTable
+        """
+        if ":" in templates:
+            self.cli_table.ParseCmd(output, templates=templates)
             objs = []
             for row in self.cli_table:
                 temp_dict = {}
@@ -59,6 +103,48 @@ class Template(object):
                     temp_dict[self.cli_table.header[index].lower()] = element
                 objs.append(temp_dict)
             return objs
+
+        (fsm, lock) = get_compiled(os.path.join(self.root, templates))
+        with lock:
+            fsm.Reset()
+            header = [name.lower() for name in fsm.header]
+            return [dict(zip(header, record)) for record in fsm.ParseText(output)]
+
+    def parse_cached(self, templates, output):
+        if parse_cache_size <= 0:
+            return self.parse(templates, output)
+        data = output.encode("utf-8") if not isinstance(output, bytes) else output
+        key = (self.root, templates, hashlib.md5(data).hexdigest())
+        with parse_cache_lock:
+            rows = parse_cache.pop(key, None)
+            if rows is not None:
+                parse_cache[key] = rows
+                return copy_rows(rows)
+        rows = self.parse(templates, output)
+        with parse_cache_lock:
+            parse_cache[key] = copy_rows(rows)
+            while len(parse_cache) > parse_cache_size:
+                parse_cache.popitem(last=False)
+        return rows
+
+    def apply(self, output, cmd):
+        """
+        todo: Update Documentation
+        :param output:
+        :type output:
+        :param cmd:
+        :type cmd:
+        :return:
+        :rtype:
+        """
+        templates = self.lookup(cmd)
+        if not templates:
+            attrs = dict(Command=cmd)
+            if self.platform: attrs["Platform"] = self.platform
+            msg = 'No template found for attributes: "%s"' % attrs
+            raise Exception('Unable to parse command "%s" - %s' % (cmd, msg))
+        try:
+            return self.parse_cached(templates, output)
         except clitable.CliTableError as e:
             raise Exception('Unable to parse command "%s" - %s' % (cmd, str(e)))
 
@@ -73,18 +159,59 @@ class Template(object):
         :rtype:
         """
         tmpl_file2 = os.path.join(self.root, tmpl_file)
-        tmpl_fp = open(tmpl_file2, "r")
-        out = textfsm.TextFSM(tmpl_fp).ParseText(data)
-        tmpl_fp.close()
-        return out
+        (fsm, lock) = get_compiled(tmpl_file2)
+        with lock:
+            fsm.Reset()
+            return [list(record) for record in fsm.ParseText(data)]
+
+    def benchmark(self, count=10):
+        """
+        compare the parsing time of the sample files without and with
+        the compiled template registry and the parsed output cache
+        """
+        samples = []
+        for row in self.cli_table.index.index[1:]:
+            template = row['Template']
+            if ":" in template:
+                continue
+            sample = os.path.join(self.samples, os.path.splitext(template)[0]+'.txt')
+            if os.path.exists(sample) and template not in [t for t, _ in samples]:
+                with open(sample, "r") as fh:
+                    samples.append([template, fh.read()])
+        if not samples:
+            print("no sample files found in {}".format(self.samples))
+            return None
+
+        def measure(func):
+            start = time.time()
+            for _ in range(count):
+                for template, data in samples:
+                    func(template, data)
+            return time.time() - start
+
+        # the index is built once as the old apply did with self.cli_table
+        cli_table = clitable.CliTable('index', self.root)
+        def uncached(template, data):
+            cli_table.ParseCmd(data, templates=template)
+            [dict(zip(cli_table.header, row)) for row in cli_table]
+
+        results = OrderedDict()
+        results["uncached"] = measure(uncached)
+        results["compiled"] = measure(self.parse)
+        results["memoized"] = measure(self.parse_cached)
+        for name, value in results.items():
+            print("{:10s}: {:8.3f} sec {:6.1f}x for {} samples x {}".format(name,
+                  value, results["uncached"] / value if value else 0, len(samples), count))
+        return results
 
 if __name__ == "__main__":
     template = Template()
-    if len(sys.argv) > 2:
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        rv = template.benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+    elif len(sys.argv) > 2:
         f = open(sys.argv[2], "r")
         rv = template.apply(f.read(), sys.argv[1])
     else:
         f = open(sys.argv[1], "r")
         rv = template.apply_textfsm("unix_ifcfg.tmpl", f.read())
     print (rv)
-
@@ -7,7 +7,6 @@ import shutil
 import logging
 import tempfile
 import yaml
-from itertools import permutations
 from collections import OrderedDict
 
 from spytest.ordyaml import OrderedYaml
@@ -71,6 +70,8 @@ class Testbed(object):
         self.devices_state = SpyTestDict()
         self.devices_port_state = SpyTestDict()
         self.pertest_topo_checking = False
+        self.link_counts = dict()
+        self.topology_cache = dict()
         self.valid = False
         self.logger = logger or logging.getLogger()
         self._load_and_check(filename)
@@ -479,6 +480,8 @@ class Testbed(object):
         #utils.print_yaml(self.reserved_links, "self.reserved_links")
 
         self.links = SpyTestDict()
+        self.link_counts.clear()
+        self.topology_cache.clear()
         for dut, link, linfo in connected_links:
             ent = SpyTestDict({
                 "from_port": link, "from_dut": self.devices[dut].__name__,
@@ -1017,8 +1020,7 @@ class Testbed(object):
         if int(res.group(3)) != 0 and not to_dev:
             errs.append("no_dut")
             return [False, from_dev, to_dev]
-        links = self.get_links(from_dev, to_dev)
-        if len(links) < int(res.group(3)):
+        if self.get_link_count(from_dev, to_dev) < int(res.group(3)):
             errs.append("no_link")
             return [False, from_dev, to_dev]
 
@@ -1029,7 +1031,7 @@ class Testbed(object):
             if to_type == 'D' and not self.devices_state[to_dev]:
                 errs.append("dut_down")
                 return [False, from_dev, to_dev]
-            for local, partner, remote in links:
+            for local, partner, remote in self.get_links(from_dev, to_dev):
                 if not self.devices_port_state["{}:{}".format(from_dev, local)]:
                     errs.append("link_down")
                     return [False, from_dev, to_dev]
@@ -1131,6 +1133,17 @@ class Testbed(object):
         return errs
 
     def ensure_min_topology(self, *args):
+        # the result depends on the device/link states only when they are checked per test
+        if self.pertest_topo_checking:
+            return self._ensure_min_topology(*args)
+        key = (tuple(self._split_args(*args)), self.flex_dut, tuple(self.derived.devices or []))
+        if key not in self.topology_cache:
+            [errs, properties] = self._ensure_min_topology(*args)
+            self.topology_cache[key] = [errs, properties, self.derived.devices]
+        [errs, properties, self.derived.devices] = self.topology_cache[key]
+        return [list(errs), copy.deepcopy(properties)]
+
+    def _ensure_min_topology(self, *args):
         [requests, properties, errs] = self.parse_topology(*args)
         if errs: return [errs, properties]
 
@@ -1396,6 +1409,91 @@ class Testbed(object):
             return val
         return list(val.keys())
 
+    def get_link_count(self, dut, peer=None, dtype=None):
+        key = (dut, peer, dtype)
+        if key not in self.link_counts:
+            self.link_counts[key] = len(self.get_links(dut, peer, dtype))
+        return self.link_counts[key]
+
+    @staticmethod
+    def match_topology(log, tb, dut_list, num_duts, requests, properties):
+        """
+        Find the first ordering of DUTs (in the same order as permutations of
+        dut_list would produce) which satisfies the requests. The per position
+        checks are evaluated once per DUT and the link requirements between the
+        positions are checked while the ordering is built, so that the branches
+        which can not match are pruned early.
+        """
+        (checks, tg_links, dut_links, found) = (dict(), dict(), dict(), False)
+        for from_dev, to_dev, res, arg in requests:
+            count = int(res.group(3))
+            if from_dev == 'D' and to_dev == 'T':
+                pos1 = int(res.group(1)) - 1
+                if pos1 < 0 or pos1 >= num_duts:
+                    Testbed.trace2(log, "no match tg dut position", arg, count)
+                    return []
+                checks.setdefault(pos1, set()).update([Testbed.check_dut_name,
+                    Testbed.check_model, Testbed.check_chip])
+                tg_links[pos1] = max(tg_links.get(pos1, 0), count)
+                found = True
+            elif from_dev == 'D' and to_dev == 'D':
+                (pos1, pos2) = (int(res.group(1)) - 1, int(res.group(2)) - 1)
+                if min(pos1, pos2) < 0 or max(pos1, pos2) >= num_duts:
+                    Testbed.trace2(log, "no match dut links position", arg, count)
+                    return []
+                for pos in [pos1, pos2]:
+                    checks.setdefault(pos, set()).update([Testbed.check_model, Testbed.check_chip])
+                key = (pos1, pos2) if pos1 < pos2 else (pos2, pos1)
+                dut_links[key] = max(dut_links.get(key, 0), count)
+                found = True
+            else:
+                print("UNKNOWN", arg)
+        if not found:
+            return []
+
+        # DUTs which satisfy the name/model/chip/tg link requirements of each position
+        candidates = []
+        for pos in range(num_duts):
+            dut_req = "D{}".format(pos+1)
+            pos_list = []
+            for dut in dut_list:
+                if not all([check(log, tb, dut_req, dut, properties) for check in checks.get(pos, [])]):
+                    continue
+                if tb.get_link_count(dut, None, "TG") < tg_links.get(pos, 0):
+                    continue
+                pos_list.append(dut)
+            if not pos_list:
+                Testbed.trace2(log, "no matching dut", dut_req, properties)
+                return []
+            candidates.append(pos_list)
+
+        # link requirements to be checked when the position is assigned
+        pos_links = [[] for pos in range(num_duts)]
+        for (pos1, pos2), count in dut_links.items():
+            pos_links[pos2].append([pos1, count])
+
+        perm_list = []
+        def assign(pos):
+            if pos >= num_duts:
+                return Testbed.check_dut_names(log, tb, perm_list, properties)
+            for dut in candidates[pos]:
+                if dut in perm_list:
+                    continue
+                for pos1, count in pos_links[pos]:
+                    if tb.get_link_count(perm_list[pos1], dut, "DUT") < count:
+                        break
+                else:
+                    perm_list.append(dut)
+                    if assign(pos+1):
+                        return True
+                    perm_list.pop()
+            return False
+
+        if not assign(0):
+            Testbed.trace2(log, "no match dut links", requests, properties)
+            return []
+        return perm_list
+
     @staticmethod
     def identify_topology(log, tb, rdict, num, *args):
 
@@ -1432,91 +1530,10 @@ class Testbed(object):
           dut_list2 = Testbed.check_dut_names_any(log, dut_list2, properties)
           if len(dut_list2) < len(req_duts):
             continue
-          found_match = []
-          perm_iterator = permutations(dut_list2, len(req_duts))
-          for perm in perm_iterator:
-            perm_list = list(perm)
-            perm_dict = {"D{}".format(i+1) : item for i, item in enumerate(perm_list)}
-            Testbed.trace2(log, perm, perm_list, perm_dict)
-            # check if names is enforced
-            if not Testbed.check_dut_names(log, tb, perm_list, properties):
-                Testbed.trace2(log, "no matching dut names", requests)
-                found_match = []
-                continue
-            for from_dev, to_dev, res, arg in requests:
-                count = int(res.group(3))
-                if from_dev == 'D' and to_dev == 'T':
-                    dut1_req = "D{}".format(res.group(1))
-                    Testbed.trace2(log, "checking-tg", arg, perm_list, dut1_req)
-                    if dut1_req not in perm_dict:
-                        Testbed.trace2(log, "no match tg dut position", arg, count, dut1_req)
-                        found_match = []
-                        break
-                    dut1 = perm_dict[dut1_req]
-                    # check if name is enforced
-                    if not Testbed.check_dut_name(log, tb, dut1_req, dut1, properties):
-                        Testbed.trace2(log, "no matching dut name", arg, count, dut1_req)
-                        found_match = []
-                        break
-                    # check if model is enforced
-                    if not Testbed.check_model(log, tb, dut1_req, dut1, properties):
-                        Testbed.trace2(log, "no matching dut model", arg, count, dut1_req)
-                        found_match = []
-                        break
-                    # check if chip is enforced
-                    if not Testbed.check_chip(log, tb, dut1_req, dut1, properties):
-                        Testbed.trace2(log, "no matching dut chip", arg, count, dut1_req, properties)
-                        found_match = []
-                        break
-                    # check if tg links are suffient
-                    entries = tb.get_links(dut1, None, "TG")
-                    if len(entries) < count:
-                        Testbed.trace2(log, "no match tg links", arg, len(entries), count, dut1_req, dut1)
-                        found_match = []
-                        break
-                    found_match = perm_list
-                elif from_dev == 'D' and to_dev == 'D':
-                    dut1_req = "D{}".format(res.group(1))
-                    dut2_req = "D{}".format(res.group(2))
-                    Testbed.trace2(log, "checking-dut", arg, perm_list, dut1_req, dut2_req, "links_req", count)
-                    if dut1_req not in perm_dict:
-                        Testbed.trace2(log, "no match dut links - 1", arg, count, perm_list, dut1_req, dut2_req)
-                        found_match = []
-                        break
-                    if dut2_req not in perm_dict:
-                        Testbed.trace2(log, "no match dut links - 2", arg, count, perm_list, dut1_req, dut2_req)
-                        found_match = []
-                        break
-                    dut1 = perm_dict[dut1_req]
-                    if not Testbed.check_model(log, tb, dut1_req, dut1, properties):
-                        Testbed.trace2(log, "no matching dut-1 model", arg, count, dut1_req, dut1)
-                        found_match = []
-                        break
-                    if not Testbed.check_chip(log, tb, dut1_req, dut1, properties):
-                        Testbed.trace2(log, "no matching dut-1 chip", arg, count, dut1_req, dut1)
-                        found_match = []
-                        break
-                    dut2 = perm_dict[dut2_req]
-                    if not Testbed.check_model(log, tb, dut2_req, dut2, properties):
-                        Testbed.trace2(log, "no matching dut-2 model", arg, count, dut2_req, dut2)
-                        found_match = []
-                        break
-                    if not Testbed.check_chip(log, tb, dut2_req, dut2, properties):
-                        Testbed.trace2(log, "no matching dut-2 chip", arg, count, dut2_req, dut2)
-                        found_match = []
-                        break
-                    entries = tb.get_links(dut1, dut2, "DUT")
-                    if len(entries) < count:
-                        Testbed.trace2(log, "no match dut links", arg, len(entries), count, perm_list, dut1, dut2)
-                        found_match = []
-                        break
-                    found_match = perm_list
-                else:
-                    print("UNKNOWN", arg)
-            if found_match:
-              Testbed.trace2(log, "found match", found_match, "req_duts", req_duts, properties)
-              found_setups.append(found_match)
-              break
+          found_match = Testbed.match_topology(log, tb, dut_list2, len(req_duts), requests, properties)
+          if found_match:
+            Testbed.trace2(log, "found match", found_match, "req_duts", req_duts, properties)
+            found_setups.append(found_match)
 
         #import pdb;pdb.set_trace()
         if not found_setups:
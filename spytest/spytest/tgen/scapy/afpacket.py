@@ -1,13 +1,23 @@
 """
-AF_PACKET receive support
+AF_PACKET receive and bulk transmit support
 
 When VLAN offload is enabled on the NIC Linux will not deliver the VLAN tag
 in the data returned by recv. Instead, it delivers the VLAN TCI in a control
 message. Python 2.x doesn't have built-in support for recvmsg, so we have to
 use ctypes to call it. The recv function exported by this module reconstructs
 the VLAN tag if it was offloaded.
+
+The TxRing and MultiSender classes transmit a batch of frames per system
+call, either through a memory mapped PACKET_TX_RING (TPACKET_V2) or with
+sendmmsg, so the caller does not pay one syscall per frame. The RxRing
+class receives through a memory mapped TPACKET_V3 PACKET_RX_RING and
+returns all the frames of the retired blocks at once.
 """
 
+import mmap
+import time
+import select
+import socket
 import struct
 from ctypes import sizeof
 from ctypes import get_errno
@@ -24,11 +34,27 @@ from ctypes import c_ushort
 from ctypes import c_uint
 from ctypes import Structure
 from ctypes import c_uint32
+from ctypes import c_char_p
 
 ETH_P_8021Q = 0x8100
 SOL_PACKET = 263
 PACKET_AUXDATA = 8
 TP_STATUS_VLAN_VALID = 1 << 4
+PACKET_VERSION = 10
+PACKET_RX_RING = 5
+PACKET_TX_RING = 13
+PACKET_LOSS = 14
+TPACKET_V2 = 1
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_SENDING = 2
+TP_STATUS_WRONG_FORMAT = 4
+TPACKET_ALIGNMENT = 16
+MSG_DONTWAIT = 0x40
+ETH_HLEN = 14
 
 class struct_iovec(Structure):
     _fields_ = [
@@ -54,6 +80,45 @@ class struct_cmsghdr(Structure):
         ("cmsg_type", c_int),
     ]
 
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ("msg_hdr", struct_msghdr),
+        ("msg_len", c_uint),
+    ]
+
+class struct_tpacket_req(Structure):
+    _fields_ = [
+        ("tp_block_size", c_uint),
+        ("tp_block_nr", c_uint),
+        ("tp_frame_size", c_uint),
+        ("tp_frame_nr", c_uint),
+    ]
+
+class struct_tpacket2_hdr(Structure):
+    _fields_ = [
+        ("tp_status", c_uint32),
+        ("tp_len", c_uint32),
+        ("tp_snaplen", c_uint32),
+        ("tp_mac", c_ushort),
+        ("tp_net", c_ushort),
+        ("tp_sec", c_uint32),
+        ("tp_nsec", c_uint32),
+        ("tp_vlan_tci", c_ushort),
+        ("tp_vlan_tpid", c_ushort),
+        ("tp_padding", c_uint32),
+    ]
+
+class struct_tpacket_req3(Structure):
+    _fields_ = [
+        ("tp_block_size", c_uint),
+        ("tp_block_nr", c_uint),
+        ("tp_frame_size", c_uint),
+        ("tp_frame_nr", c_uint),
+        ("tp_retire_blk_tov", c_uint),
+        ("tp_sizeof_priv", c_uint),
+        ("tp_feature_req_word", c_uint),
+    ]
+
 class struct_tpacket_auxdata(Structure):
     _fields_ = [
         ("tp_status", c_uint),
@@ -70,6 +135,19 @@ recvmsg = libc.recvmsg
 recvmsg.argtypes = [c_int, POINTER(struct_msghdr), c_int]
 recvmsg.retype = c_int
 
+try:
+    sendmmsg = libc.sendmmsg
+    sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int]
+    sendmmsg.restype = c_int
+except AttributeError:
+    sendmmsg = None
+
+def tpacket_align(x):
+    return (x + TPACKET_ALIGNMENT - 1) & ~(TPACKET_ALIGNMENT - 1)
+
+# offset of the frame data within a TX ring slot
+TPACKET2_DATA_OFFSET = tpacket_align(sizeof(struct_tpacket2_hdr))
+
 def enable_auxdata(sk):
     """
     Ask the kernel to return the VLAN tag in a control message
@@ -124,3 +202,236 @@ def recv(sk, bufsize):
         return buf.raw[:12] + tag + buf.raw[12:rv]
     else:
         return buf.raw[:rv]
+
+def tx_open(iface):
+    sk = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    sk.bind((iface, 0))
+    return sk
+
+class MultiSender(object):
+    """
+    Transmit a list of frames with one sendmmsg call per batch
+    @iface Interface name
+    @batch Maximum frames per system call
+    """
+    def __init__(self, iface, batch=256):
+        if not sendmmsg:
+            raise RuntimeError("sendmmsg is not available")
+        self.sk = tx_open(iface)
+        self.batch = batch
+        self.iovs = (struct_iovec * batch)()
+        self.msgs = (struct_mmsghdr * batch)()
+        for i in range(batch):
+            self.msgs[i].msg_hdr.msg_iov = pointer(self.iovs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def send(self, frames):
+        sent = 0
+        while sent < len(frames):
+            chunk = frames[sent:sent+self.batch]
+            refs = []
+            for i, frame in enumerate(chunk):
+                ref = c_char_p(bytes(frame))
+                refs.append(ref)
+                self.iovs[i].iov_base = cast(ref, c_void_p)
+                self.iovs[i].iov_len = len(frame)
+            rv = sendmmsg(self.sk.fileno(), self.msgs, len(chunk), 0)
+            if rv <= 0:
+                msg = "sendmmsg failed: rv={} errno={}".format(rv, get_errno())
+                raise RuntimeError(msg)
+            sent = sent + rv
+        return sent
+
+    def close(self):
+        self.sk.close()
+
+class TxRing(object):
+    """
+    Transmit frames through a memory mapped TPACKET_V2 TX ring
+    @iface Interface name
+    @frame_size Ring slot size, larger frames are sent with send()
+    @frame_nr Number of slots in the ring
+    """
+    def __init__(self, iface, frame_size=2048, frame_nr=512):
+        self.sk = tx_open(iface)
+        self.sk.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+        # without this the kernel stops at a malformed frame for ever
+        self.sk.setsockopt(SOL_PACKET, PACKET_LOSS, 1)
+        self.frame_size = frame_size
+        self.frame_nr = frame_nr
+        self.max_len = frame_size - TPACKET2_DATA_OFFSET
+        block_size = max(mmap.PAGESIZE, frame_size)
+        req = struct_tpacket_req()
+        req.tp_block_size = block_size
+        req.tp_frame_size = frame_size
+        req.tp_block_nr = (frame_size * frame_nr) // block_size
+        req.tp_frame_nr = frame_nr
+        self.sk.setsockopt(SOL_PACKET, PACKET_TX_RING, bytes(bytearray(req)))
+        self.ring = mmap.mmap(self.sk.fileno(), block_size * req.tp_block_nr,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.head = 0
+
+    def slot_status(self, offset):
+        return struct.unpack_from("I", self.ring, offset)[0]
+
+    def flush(self, flags=MSG_DONTWAIT):
+        try:
+            self.sk.send(b"", flags)
+        except socket.error:
+            pass
+
+    def complete(self, offsets, timeout=1.0):
+        """
+        Wait for the kernel to process the given slots and release them
+        Returns the number of frames rejected by the kernel
+        """
+        # a blocking send returns after the queued frames are transmitted
+        self.flush(0)
+        (rejected, deadline) = (0, time.time() + timeout)
+        for offset in offsets:
+            status = self.slot_status(offset)
+            while status in [TP_STATUS_SEND_REQUEST, TP_STATUS_SENDING]:
+                if time.time() > deadline:
+                    raise RuntimeError("TX ring slots are not released by the kernel")
+                time.sleep(0.001)
+                self.flush()
+                status = self.slot_status(offset)
+            if status & TP_STATUS_WRONG_FORMAT:
+                # the frame is not sent, give the slot back
+                struct.pack_into("I", self.ring, offset, TP_STATUS_AVAILABLE)
+                rejected = rejected + 1
+        return rejected
+
+    def send(self, frames):
+        """
+        Queue the frames and wait till they are transmitted, batches larger
+        than the ring are sent in multiple rounds
+        Returns the number of frames accepted by the kernel
+        """
+        (offsets, sent) = ([], 0)
+        for frame in frames:
+            if len(frame) < ETH_HLEN:
+                # the kernel drops it, do not count as sent
+                continue
+            if len(frame) > self.max_len:
+                # does not fit into the slot, keep the frame order
+                if offsets:
+                    sent = sent + len(offsets) - self.complete(offsets)
+                    offsets = []
+                self.sk.send(frame)
+                sent = sent + 1
+                continue
+            offset = self.head * self.frame_size
+            if self.slot_status(offset) != TP_STATUS_AVAILABLE:
+                # left over from a failed send
+                self.complete([offset])
+            start = offset + TPACKET2_DATA_OFFSET
+            self.ring[start:start+len(frame)] = bytes(frame)
+            struct.pack_into("II", self.ring, offset + 4, len(frame), len(frame))
+            struct.pack_into("I", self.ring, offset, TP_STATUS_SEND_REQUEST)
+            self.head = (self.head + 1) % self.frame_nr
+            offsets.append(offset)
+            if len(offsets) == self.frame_nr:
+                # all the slots are in use
+                sent = sent + len(offsets) - self.complete(offsets)
+                offsets = []
+        if offsets:
+            sent = sent + len(offsets) - self.complete(offsets)
+        return sent
+
+    def close(self):
+        try: self.ring.close()
+        except: pass
+        self.sk.close()
+
+def tx_batch_open(iface, backend="ring", frame_size=2048):
+    """
+    Open the preferred bulk transmit backend, falling back to sendmmsg
+    Returns None when neither is available so that the caller can keep
+    sending one frame at a time
+    """
+    if backend == "ring":
+        try:
+            return TxRing(iface, frame_size=frame_size)
+        except Exception:
+            backend = "mmsg"
+    if backend == "mmsg":
+        try:
+            return MultiSender(iface)
+        except Exception:
+            pass
+    return None
+
+# struct tpacket_block_desc: block_status, num_pkts, offset_to_first_pkt
+TPACKET3_BLOCK_HDR = struct.Struct("III")
+TPACKET3_BLOCK_HDR_OFFSET = 8
+
+# struct tpacket3_hdr: next_offset, sec, nsec, snaplen, len, status, mac, net,
+# rxhash, vlan_tci
+TPACKET3_HDR = struct.Struct("IIIIIIHHII")
+
+class RxRing(object):
+    """
+    Receive frames through a memory mapped TPACKET_V3 RX ring
+    @sk Bound AF_PACKET socket
+    @block_size Size of each ring block
+    @block_nr Number of blocks in the ring
+    @timeout_ms Time after which the kernel retires a partially filled block
+    """
+    def __init__(self, sk, block_size=1 << 20, block_nr=16, frame_size=2048, timeout_ms=10):
+        self.sk = sk
+        self.sk.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        req = struct_tpacket_req3()
+        req.tp_block_size = block_size
+        req.tp_block_nr = block_nr
+        req.tp_frame_size = frame_size
+        req.tp_frame_nr = (block_size * block_nr) // frame_size
+        req.tp_retire_blk_tov = timeout_ms
+        req.tp_sizeof_priv = 0
+        req.tp_feature_req_word = 0
+        self.sk.setsockopt(SOL_PACKET, PACKET_RX_RING, bytes(bytearray(req)))
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.ring = mmap.mmap(self.sk.fileno(), block_size * block_nr,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.poller = select.poll()
+        self.poller.register(self.sk.fileno(), select.POLLIN | select.POLLERR)
+        self.block = 0
+
+    def recv(self, timeout_ms=1000):
+        """
+        Wait for at least one retired block and return the list of
+        (frame, timestamp) tuples from all the available blocks
+        """
+        offset = self.block * self.block_size
+        status = struct.unpack_from("I", self.ring, offset + TPACKET3_BLOCK_HDR_OFFSET)[0]
+        if not status & TP_STATUS_USER:
+            self.poller.poll(timeout_ms)
+        retval = []
+        for _ in range(self.block_nr):
+            offset = self.block * self.block_size
+            (status, num_pkts, first) = TPACKET3_BLOCK_HDR.unpack_from(self.ring,
+                                                  offset + TPACKET3_BLOCK_HDR_OFFSET)
+            if not status & TP_STATUS_USER:
+                break
+            pkt = offset + first
+            for _ in range(num_pkts):
+                (next_offset, sec, nsec, snaplen, _, status, mac, _, _,
+                 vlan_tci) = TPACKET3_HDR.unpack_from(self.ring, pkt)
+                start = pkt + mac
+                if vlan_tci != 0 or status & TP_STATUS_VLAN_VALID:
+                    # Insert VLAN tag
+                    tag = struct.pack("!HH", ETH_P_8021Q, vlan_tci & 0xFFFF)
+                    data = self.ring[start:start+12] + tag + self.ring[start+12:start+snaplen]
+                else:
+                    data = self.ring[start:start+snaplen]
+                retval.append((data, sec + nsec / 1000000000.0))
+                pkt = pkt + next_offset
+            # hand the block back to the kernel
+            struct.pack_into("I", self.ring, offset + TPACKET3_BLOCK_HDR_OFFSET, TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.block_nr
+        return retval
+
+    def close(self):
+        try: self.ring.close()
+        except: pass
@@ -0,0 +1,294 @@
+"""
+Precompiled packet templates
+
+A stream is built once with scapy into a raw frame and a list of field
+patch operations. Generating the next frame only rewrites the modified
+fields in a preallocated bytearray and fixes the affected checksums
+incrementally (RFC 1624), so the TX loop never touches scapy layers.
+"""
+
+import zlib
+import socket
+import struct
+import binascii
+
+from scapy.packet import Padding
+from scapy.layers.l2 import Dot1Q, ARP
+from scapy.layers.inet import IP, UDP, TCP
+from scapy.layers.inet6 import IPv6
+
+from signature import SIG_LEN, sig_pack_into
+
+# cycles up to this length are precomputed at compile time
+MAX_PRECOMPUTED_CYCLE = 65536
+
+incr_modes = ["increment", "incr"]
+decr_modes = ["decrement", "decr"]
+
+def int2bytes(value, width):
+    return bytearray(binascii.unhexlify("%0*x" % (width * 2, value)))
+
+def bytes2int(data):
+    return int(binascii.hexlify(bytes(data)), 16) if data else 0
+
+def mac2int(mac):
+    return int(mac.replace(":", "").replace(".", ""), 16)
+
+def ipv4_2int(ip):
+    return bytes2int(bytearray(socket.inet_aton(str(ip))))
+
+def csum16(data):
+    """ones complement sum of the 16-bit words in data"""
+    total = 0
+    for i in range(0, len(data) - 1, 2):
+        total += (data[i] << 8) | data[i + 1]
+    if len(data) % 2:
+        total += data[-1] << 8
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return total
+
+class CompileError(Exception):
+    pass
+
+class FieldOp(object):
+    """
+    rewrite a field of width bytes at offset for every packet
+    the value sequence is either a list or base +/- step with optional
+    wrap after count packets (count=0 runs until the field overflows)
+    """
+    def __init__(self, name, offset, width, base=0, step=0, count=0,
+                 values=None, mask=None, csums=None):
+        self.name = name
+        self.offset = offset
+        self.width = width
+        self.bits = width * 8
+        self.mask = mask
+        self.base = base
+        self.step = step
+        self.count = count
+        self.values = values
+        self.csums = csums or []
+        self.cycle = None
+        if values:
+            self.cycle = [self.encode(v) for v in values]
+        elif 0 < count <= MAX_PRECOMPUTED_CYCLE:
+            self.cycle = [self.encode(self.value_at(i)) for i in range(count)]
+
+    def value_at(self, index):
+        if self.values:
+            return self.values[index % len(self.values)]
+        if self.count > 0:
+            index = index % self.count
+        limit = (1 << self.bits) if self.mask is None else (self.mask + 1)
+        return (self.base + self.step * index) % limit
+
+    def encode(self, value):
+        return (int2bytes(value, self.width), csum16(int2bytes(value, self.width)))
+
+    def get(self, index):
+        if self.cycle is not None:
+            return self.cycle[index % len(self.cycle)]
+        return self.encode(self.value_at(index))
+
+class CompiledStream(object):
+    """
+    raw frame template plus field patch operations for one stream
+    the buffer holds the frame followed by the 4 byte software FCS
+    the stream signature is written at sig_offset when it is not zero
+    """
+    def __init__(self, data, ops=None, sig_offset=0, sig_id=0):
+        self.length = len(data)
+        self.buf = bytearray(data) + bytearray(4)
+        self.ops = ops or []
+        self.sig_offset = sig_offset
+        self.sig_id = sig_id
+        self.view = memoryview(self.buf)
+        self.index = 0
+        self.current = [None] * len(self.ops)
+        for i, op in enumerate(self.ops):
+            current = bytearray(self.buf[op.offset:op.offset+op.width])
+            if op.mask is not None:
+                current[0] = current[0] & (op.mask >> (op.bits - 8))
+            self.current[i] = csum16(current)
+        self.reset()
+
+    def reset(self):
+        self.index = 0
+        self.apply(0)
+
+    def advance(self):
+        self.index = self.index + 1
+        self.apply(self.index)
+
+    def apply(self, index):
+        buf = self.buf
+        for i, op in enumerate(self.ops):
+            data, new_sum = op.get(index)
+            off = op.offset
+            if op.mask is not None:
+                # keep the bits outside the mask (PCP/DEI of VLAN TCI)
+                keep = buf[off] & ~(op.mask >> (op.bits - 8)) & 0xFF
+                buf[off] = keep | data[0]
+                buf[off+1:off+op.width] = data[1:]
+            else:
+                buf[off:off+op.width] = data
+            old_sum = self.current[i]
+            self.current[i] = new_sum
+            if old_sum == new_sum:
+                continue
+            for coff, zero_ok in op.csums:
+                hc = (buf[coff] << 8) | buf[coff + 1]
+                if hc == 0 and zero_ok:
+                    # UDP over IPv4 without checksum
+                    continue
+                total = (~hc & 0xFFFF) + (~old_sum & 0xFFFF) + new_sum
+                while total >> 16:
+                    total = (total & 0xFFFF) + (total >> 16)
+                hc = ~total & 0xFFFF
+                if hc == 0 and zero_ok:
+                    hc = 0xFFFF
+                buf[coff] = hc >> 8
+                buf[coff + 1] = hc & 0xFF
+
+    def frame(self, seq=0):
+        """
+        stamps the signature (with the current time) and the FCS,
+        the frame should be sent soon after this call
+        """
+        buf = self.buf
+        if self.sig_offset:
+            sig_pack_into(buf, self.sig_offset, self.sig_id, seq)
+        crc = zlib.crc32(self.view[:self.length]) & 0xFFFFFFFF
+        struct.pack_into("<I", buf, self.length, crc)
+        return buf
+
+    def frame_len(self):
+        return self.length + 4
+
+def layer_offset(pkt, data, layer):
+    if layer not in pkt:
+        return -1
+    return len(data) - len(bytes(pkt[layer]))
+
+class StreamCompiler(object):
+    """
+    translates the stream keyword arguments into field patch operations
+    raises CompileError for options that need the scapy build path
+    """
+    def __init__(self, utils):
+        self.utils = utils
+
+    def get_mode(self, kws, name):
+        mode = str(kws.get(name, "fixed")).strip()
+        if mode not in ["fixed", "list"] + incr_modes + decr_modes:
+            raise CompileError("unsupported {} = {}".format(name, mode))
+        return mode
+
+    def step_op(self, kws, name, prefix, offset, width, base, step_default,
+                parse, mask=None, csums=None, list_key=None):
+        mode = self.get_mode(kws, "{}_mode".format(prefix))
+        if mode == "fixed":
+            return None
+        if mode == "list":
+            if not list_key:
+                raise CompileError("unsupported {}_mode = list".format(prefix))
+            values = [parse(v) for v in kws.get(list_key, [])]
+            if len(values) < 2:
+                return None
+            return FieldOp(name, offset, width, values=values, mask=mask, csums=csums)
+        step = parse(kws.get("{}_step".format(prefix), step_default))
+        count = self.utils.intval(kws, "{}_count".format(prefix), 0)
+        if mode in decr_modes:
+            step = -step
+        return FieldOp(name, offset, width, base=base, step=step, count=count,
+                       mask=mask, csums=csums)
+
+    def compile(self, pwa):
+        if pwa.length_mode != "fixed":
+            raise CompileError("unsupported length_mode = {}".format(pwa.length_mode))
+
+        pkt = pwa.pkt/pwa.padding if pwa.padding else pwa.pkt
+        data = bytearray(bytes(pkt))
+        kws = pwa.stream.kws
+        ops = []
+
+        def add(op):
+            if op: ops.append(op)
+
+        # upper layer checksums covering the L3 pseudo header
+        l4_csums, ip4_csums = [], []
+        ip_off = layer_offset(pkt, data, IP)
+        ip6_off = layer_offset(pkt, data, IPv6)
+        if ip_off >= 0:
+            ip4_csums.append((ip_off + 10, False))
+        for layer, coff, zero_ok in [(UDP, 6, True), (TCP, 16, False)]:
+            off = layer_offset(pkt, data, layer)
+            if off >= 0:
+                l4_csums.append((off + coff, zero_ok and ip_off >= 0))
+        if ip6_off >= 0 and not l4_csums:
+            nh = pkt[IPv6].payload
+            if nh and nh.name.startswith("ICMPv6"):
+                off = layer_offset(pkt, data, nh.__class__)
+                l4_csums.append((off + 2, False))
+
+        # Ethernet
+        add(self.step_op(kws, "mac_src", "mac_src", 6, 6, bytes2int(data[6:12]),
+                         "00:00:00:00:00:01", mac2int, list_key="mac_src"))
+        add(self.step_op(kws, "mac_dst", "mac_dst", 0, 6, bytes2int(data[0:6]),
+                         "00:00:00:00:00:01", mac2int, list_key="mac_dst"))
+
+        # ARP
+        arp_off = layer_offset(pkt, data, ARP)
+        if arp_off >= 0:
+            add(self.step_op(kws, "arp_src_hw", "arp_src_hw", arp_off + 8, 6,
+                             bytes2int(data[arp_off+8:arp_off+14]), "00:00:00:00:00:01", mac2int))
+            add(self.step_op(kws, "arp_dst_hw", "arp_dst_hw", arp_off + 18, 6,
+                             bytes2int(data[arp_off+18:arp_off+24]), "00:00:00:00:00:01", mac2int))
+
+        # VLAN
+        vlan_off = layer_offset(pkt, data, Dot1Q)
+        if vlan_off >= 0:
+            parse = lambda v: int(str(v))
+            add(self.step_op(kws, "vlan_id", "vlan_id", vlan_off, 2,
+                             pkt[Dot1Q].vlan, 1, parse, mask=0x0FFF))
+
+        # IPv4
+        if ip_off >= 0:
+            parse = ipv4_2int
+            add(self.step_op(kws, "ip_src", "ip_src", ip_off + 12, 4,
+                             bytes2int(data[ip_off+12:ip_off+16]), "0.0.0.1", parse,
+                             csums=ip4_csums + l4_csums))
+            add(self.step_op(kws, "ip_dst", "ip_dst", ip_off + 16, 4,
+                             bytes2int(data[ip_off+16:ip_off+20]), "0.0.0.1", parse,
+                             csums=ip4_csums + l4_csums))
+
+        # IPv6
+        if ip6_off >= 0:
+            parse = self.utils.ipv6_ip2long
+            add(self.step_op(kws, "ipv6_src", "ipv6_src", ip6_off + 8, 16,
+                             bytes2int(data[ip6_off+8:ip6_off+24]), "::1", parse,
+                             csums=l4_csums))
+            add(self.step_op(kws, "ipv6_dst", "ipv6_dst", ip6_off + 24, 16,
+                             bytes2int(data[ip6_off+24:ip6_off+40]), "::1", parse,
+                             csums=l4_csums))
+
+        # L4 ports
+        parse = lambda v: int(str(v))
+        for l4 in ["tcp", "udp"]:
+            layer = TCP if l4 == "tcp" else UDP
+            off = layer_offset(pkt, data, layer)
+            if off < 0:
+                continue
+            add(self.step_op(kws, "{}_src_port".format(l4), "{}_src_port".format(l4), off, 2,
+                             pkt[layer].sport, 1, parse, csums=l4_csums))
+            add(self.step_op(kws, "{}_dst_port".format(l4), "{}_dst_port".format(l4), off + 2, 2,
+                             pkt[layer].dport, 1, parse, csums=l4_csums))
+
+        # stream signature goes at the end of the padding
+        (sig_offset, stream) = (0, pwa.stream)
+        if getattr(stream, "track_port", None) and Padding in pkt:
+            if len(bytes(pkt[Padding])) >= SIG_LEN:
+                sig_offset = len(data) - SIG_LEN
+
+        return CompiledStream(data, ops, sig_offset, getattr(stream, "sig_id", 0))
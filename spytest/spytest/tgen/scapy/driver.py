@@ -35,6 +35,10 @@ class ScapyDriver(object):
         self.iface = port.iface
         self.packet = ScapyPacket(port.iface, dry=self.dry, dbg=self.dbg,
                                   logger=self.logger)
+        self.tx_window = self.utils.get_env_int("SPYTEST_SCAPY_TX_WINDOW_MS", 100) / 1000.0
+        self.tx_batch = self.utils.get_env_int("SPYTEST_SCAPY_TX_BATCH", 512)
+        self.tx_sig_batch = self.utils.get_env_int("SPYTEST_SCAPY_TX_SIG_BATCH", 16)
+        self.rx_settle = self.utils.get_env_int("SPYTEST_SCAPY_RX_SETTLE_MS", 100) / 1000.0
         self.rxInit()
         self.txInit()
         self.statState.set()
@@ -54,6 +58,8 @@ class ScapyDriver(object):
         self.packet.cleanup()
 
     def rxInit(self):
+        self.rxLock = threading.Lock()
+        self.rxLastTime = 0
         self.captureQueueInit()
         self.captureState = threading.Event()
         self.captureState.clear()
@@ -76,23 +82,42 @@ class ScapyDriver(object):
     def stopCapture(self):
         self.logger.debug("stop-cap: {}".format(self.iface))
         self.captureState.clear()
-        time.sleep(1)
+        self.rxBarrier()
         return len(self.pkts_captured)
 
     def clearCapture(self):
         self.logger.debug("clear-cap: {}".format(self.iface))
         self.captureState.clear()
-        time.sleep(3)
+        self.rxBarrier()
         self.pkts_captured = []
         return len(self.pkts_captured)
 
+    def rxBarrier(self):
+        # wait for the RX thread to finish the batch being processed
+        with self.rxLock:
+            pass
+
+    def waitForQuiesce(self, timeout=5):
+        """
+        wait until no packet is received for rx_settle seconds
+        returns False if the RX counters are still changing after timeout
+        """
+        end_time = time.time() + timeout
+        while True:
+            self.rxBarrier()
+            now = time.time()
+            idle = now - self.rxLastTime
+            if idle >= self.rx_settle:
+                return True
+            if now >= end_time:
+                return False
+            time.sleep(min(self.rx_settle - idle, end_time - now))
+
     def getCapture(self):
         self.logger.debug("get-cap: {}".format(self.iface))
         retval = []
         for pkt in self.pkts_captured:
-            (data, hex_bytes) = (str(pkt), [])
-            for index in range(len(data)):
-                hex_bytes.append("%02X"% ord(data[index]))
+            hex_bytes = ["%02X" % b for b in bytearray(pkt)]
             retval.append(hex_bytes)
         return retval
 
@@ -111,9 +136,12 @@ class ScapyDriver(object):
             # read packets
             while self.rx_any_enable():
                 try:
-                    packet = self.packet.readp(iface=self.iface)
-                    if packet:
-                        self.handle_recv(None, packet)
+                    packets = self.packet.readp_batch(iface=self.iface)
+                    if packets:
+                        with self.rxLock:
+                            for packet, ts in packets:
+                                self.handle_recv(ts, packet)
+                            self.rxLastTime = time.time()
                 except Exception as e:
                     if str(e) != "[Errno 100] Network is down":
                         self.logger.debug(e, traceback.format_exc())
@@ -121,7 +149,7 @@ class ScapyDriver(object):
                     while self.rx_any_enable() and isLinkUp(self.iface) == False:
                         time.sleep(1)
 
-    def handle_stats(self, packet):
+    def handle_stats(self, ts, packet):
         pktlen = 0 if not packet else len(packet)
         framesReceived = self.port.incrStat('framesReceived')
         self.port.incrStat('bytesReceived', pktlen)
@@ -129,17 +157,19 @@ class ScapyDriver(object):
             self.logger.debug("{} framesReceived: {}".format(self.iface, framesReceived))
         if pktlen > 1518:
             self.port.incrStat('oversizeFramesReceived')
-        for stream in self.port.track_streams:
-            if self.packet.match_stream(stream, packet):
-                stream.incrStat('framesReceived')
-                stream.incrStat('bytesReceived', pktlen)
+        (stream, sig) = self.packet.match_stream(self.port, packet)
+        if stream:
+            stream.incrStat('framesReceived')
+            stream.incrStat('bytesReceived', pktlen)
+            if sig:
+                stream.rx.update(sig[1], sig[2], ts)
 
     def handle_capture(self, packet):
         self.pkts_captured.append(packet)
 
-    def handle_recv(self, hdr, packet):
+    def handle_recv(self, ts, packet):
         if self.statState.is_set():
-            self.handle_stats(packet)
+            self.handle_stats(ts, packet)
         if self.captureState.is_set():
             self.handle_capture(packet)
 
@@ -148,6 +178,8 @@ class ScapyDriver(object):
         self.txState.clear()
         self.txStateAck = threading.Event()
         self.txStateAck.clear()
+        self.txIdle = threading.Event()
+        self.txIdle.set()
         self.txThread = threading.Thread(target=self.txThreadMain, args=())
         self.txThread.daemon = True
         self.txThread.start()
@@ -166,51 +198,53 @@ class ScapyDriver(object):
 
         for stream_id, stream in self.port.streams.items():
             stream.enable2 = bool(stream_id in handles)
-            if stream.kws.get("transmit_mode", "continuous") != "continuous":
-                non_continuous = True
+            if stream.enable and stream.enable2:
+                if stream.kws.get("transmit_mode", "continuous") != "continuous":
+                    non_continuous = True
 
-        # signal the start
+        # signal the start, restart the thread if it is already running
         self.logger.debug("signal-tx: {} {}".format(self.iface, kws))
+        if self.txState.is_set():
+            self.txState.clear()
+            self.txIdle.wait(10)
         self.txStateAck.clear()
+        self.txIdle.clear()
         self.txState.set()
 
-        # wait for first packet to be sent
+        # wait for first packets to be sent
         self.txStateAck.wait(10)
         self.logger.debug("start-tx-ack: {} {}".format(self.iface, kws))
 
         # wait for max 30 seconds to finish
         if non_continuous:
-            for check in range(30):
-                if not self.txState.is_set():
-                    break
+            self.txIdle.wait(30)
         elif duration > 0:
             self.logger.debug("waiting for duration: {}".format(duration))
-            time.sleep(duration)
-            self.txState.clear()
-        else:
-            self.logger.debug("waiting 3 sec")
-            time.sleep(3)
+            if not self.txIdle.wait(duration):
+                self.txState.clear()
+                self.txIdle.wait(10)
 
         self.logger.debug("start-tx-finished: {} {}".format(self.iface, kws))
 
     def stopTransmit(self, **kws):
 
-        # disable selected streams
+        # disable selected streams, the TX thread drops them
         handle = kws.get('handle', None)
         if handle:
+            handles = self.utils.make_list(handle)
             for stream_id, stream in self.port.streams.items():
-                if not handle or stream_id == handle:
+                if stream_id in handles:
                     stream.enable2 = False
-            return
+            for stream in self.port.streams.values():
+                if stream.enable and stream.enable2:
+                    return
 
         if not self.txState.is_set():
             return
         self.logger.debug("stop-tx: {}".format(self.iface))
         self.txState.clear()
-        for index in range(10):
-            time.sleep(1)
-            if not self.txState.is_set():
-                break
+        if not self.txIdle.wait(10):
+            self.logger.error("stop-tx: {} timeout".format(self.iface))
 
     def clear_stats(self):
         self.packet.clear_stats()
@@ -225,6 +259,8 @@ class ScapyDriver(object):
             except Exception as e:
                 self.logger.log_exception(e, traceback.format_exc())
             self.txState.clear()
+            self.txStateAck.set()
+            self.txIdle.set()
 
     def txThreadMainInner(self):
         self.logger.debug("txThreadMainInner {} start {}".format(self.iface, self.port.streams))
@@ -234,7 +270,8 @@ class ScapyDriver(object):
                 self.logger.debug(" start {} {}/{}".format(stream.stream_id, stream.enable, stream.enable2))
                 if stream.enable and stream.enable2:
                     pwa = self.packet.build_first(stream)
-                    pwa.tx_time = time.clock()
+                    pwa.tx_time = time.time()
+                    stream.rate_pps = pwa.rate_pps
                     pwa_list.append(pwa)
         except Exception as exp:
             self.logger.log_exception(exp, traceback.format_exc())
@@ -244,22 +281,23 @@ class ScapyDriver(object):
             self.txStateAck.set()
             return
 
-        # signal first packet ready
-        self.txStateAck.set()
-
         tx_count = 0
         while (self.txState.is_set()):
             pwa_list.sort(key=self.pwa_sort)
             pwa_next_list = []
             for pwa in pwa_list:
+                if not pwa.stream.enable2:
+                    continue
                 self.pwa_wait(pwa)
+                if pwa.compiled:
+                    if self.send_compiled(pwa):
+                        pwa_next_list.append(pwa)
+                    continue
                 try:
-                    send_start_time = time.clock()
+                    send_start_time = time.time()
                     pkt = self.send_packet(pwa)
-                    if pwa.stream.track_port:
-                        pwa.stream.track_pkts.append(pkt)
                     bytesSent = len(pkt)
-                    send_time = time.clock() - send_start_time
+                    send_time = time.time() - send_start_time
                     framesSent = self.port.incrStat('framesSent')
                     self.port.incrStat('bytesSent', bytesSent)
                     if self.dbg > 2:
@@ -272,21 +310,72 @@ class ScapyDriver(object):
                     pwa.stream.enable2 = False
                 else:
                     pps = pwa.rate_pps
-                    build_start_time = time.clock()
+                    build_start_time = time.time()
                     pwa = self.packet.build_next(pwa)
                     if not pwa: continue
-                    build_time = time.clock() - build_start_time
+                    build_time = time.time() - build_start_time
                     if pps > self.packet.max_rate_pps: pps = self.packet.max_rate_pps
-                    pwa.tx_time = time.clock() + 1.0/float(pps) - build_time - send_time
+                    pwa.tx_time = time.time() + 1.0/float(pps) - build_time - send_time
                     pwa_next_list.append(pwa)
             pwa_list = pwa_next_list
+            # signal first packets sent
+            self.txStateAck.set()
+            if not pwa_list:
+                break
         self.logger.debug("txThreadMainInner Completed {}".format(tx_count))
 
+    def send_compiled(self, pwa):
+        """
+        queue the packets of a compiled stream due in the next rate window
+        with bulk sends, returns False once the stream is done
+        """
+        now = time.time()
+        interval = 1.0/float(pwa.rate_pps)
+        # not more than the TX ring holds
+        max_count = max(1, min(int(pwa.rate_pps * self.tx_window), self.tx_batch))
+        count = int((now + self.tx_window - pwa.tx_time) / interval)
+        count = min(max(1, count), max_count)
+        (built, framesSent, bytesSent, pending) = (0, 0, 0, True)
+        # tracked frames get the TX timestamp when built, send them in small
+        # batches so that the stamp stays close to the time on the wire
+        chunk = max(1, self.tx_sig_batch) if pwa.compiled.sig_offset else count
+        try:
+            while pending and built < count:
+                frames = []
+                while len(frames) < min(chunk, count - built):
+                    frames.append(bytes(pwa.compiled.frame(pwa.stream.next_seq())))
+                    if not self.packet.build_next(pwa):
+                        pending = False
+                        break
+                built = built + len(frames)
+                if pwa.stream.track_port and not pwa.compiled.sig_offset:
+                    for frame in frames:
+                        self.packet.track_frame(pwa.stream, frame)
+                sent = self.packet.sendp_batch(frames, self.iface)
+                framesSent = framesSent + sent
+                bytesSent = bytesSent + sum([len(frame) for frame in frames[:sent]])
+        except Exception as e:
+            self.logger.log_exception(e, traceback.format_exc())
+            pwa.stream.enable2 = False
+            pending = False
+
+        if framesSent:
+            self.port.incrStat('framesSent', framesSent)
+            self.port.incrStat('bytesSent', bytesSent)
+            pwa.stream.incrStat('framesSent', framesSent)
+            pwa.stream.incrStat('bytesSent', bytesSent)
+
+        # schedule the next window, drop the backlog if we are too far behind
+        pwa.tx_time = pwa.tx_time + built * interval
+        if pwa.tx_time < now - self.tx_window:
+            pwa.tx_time = now
+        return pending
+
     def pwa_sort(self, pwa):
         return pwa.tx_time
 
     def pwa_wait(self, pwa):
-        delay = pwa.tx_time - time.clock()
+        delay = pwa.tx_time - time.time()
         if self.dbg > 1:
             self.logger.debug("stream: {} delay: {} pps: {}".format(pwa.stream.stream_id, delay, pwa.rate_pps))
         if delay <= 0:
@@ -306,6 +395,9 @@ class ScapyDriver(object):
     def send_packet(self, pwa):
         return self.packet.send_packet(pwa, self.iface)
 
+    def compileStream(self, stream):
+        return self.packet.compile_stream(stream)
+
     def createInterface(self, intf):
         return self.packet.if_create(intf)
 
@@ -12,8 +12,6 @@ import afpacket
 import traceback
 import ipaddress
 
-from binascii import hexlify
-
 this_dir = os.path.join(os.path.dirname(__file__))
 
 from scapy.all import hexdump, L2Socket
@@ -26,6 +24,8 @@ from scapy.config import Conf
 from dicts import SpyTestDict
 from utils import Utils
 from logger import Logger
+from compiled import StreamCompiler, CompileError
+from signature import SIG_LEN, sig_pack_into, sig_parse, flow_key
 
 #dbg > 1 --- recv/send packet
 #dbg > 2 --- recv/send packet summary
@@ -121,6 +121,14 @@ class ScapyPacket(object):
         except: self.logger.info("SCAPY VERSION = UNKNOWN")
         self.utils = Utils(self.dry, logger=self.logger)
         self.max_rate_pps = self.utils.get_env_int("SPYTEST_SCAPY_MAX_RATE_PPS", 100)
+        self.max_compiled_pps = self.utils.get_env_int("SPYTEST_SCAPY_MAX_COMPILED_RATE_PPS", 20000)
+        self.compiled_mode = self.utils.get_env_int("SPYTEST_SCAPY_COMPILED_STREAMS", 1)
+        self.compiler = StreamCompiler(self.utils)
+        self.tx_backend = os.getenv("SPYTEST_SCAPY_TX_BACKEND", "ring")
+        self.tx_bulk = None
+        self.rx_ring = None
+        self.rx_ring_mode = self.utils.get_env_int("SPYTEST_SCAPY_RX_RING", 1)
+        self.max_track_keys = self.utils.get_env_int("SPYTEST_SCAPY_MAX_TRACK_KEYS", 65536)
         self.dbg = dbg
         self.hex = hex
         self.iface = iface
@@ -194,8 +202,10 @@ class ScapyPacket(object):
         self.finished = True
         self.init_bridge(self.iface)
         self.finished = False
+        self.rx_ring = self.close_sock(getattr(self, "rx_ring", None))
         self.rx_sock = self.close_sock(self.rx_sock)
         self.tx_sock = self.close_sock(self.tx_sock)
+        self.tx_bulk = self.close_sock(getattr(self, "tx_bulk", None))
 
     def rx_open(self):
         if not self.iface or self.dry: return
@@ -204,33 +214,47 @@ class ScapyPacket(object):
         self.rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 12 * 1024)
         self.rx_sock.bind((self.iface+"-rx", 3))
         afpacket.enable_auxdata(self.rx_sock)
+        if self.rx_ring_mode:
+            try:
+                self.rx_ring = afpacket.RxRing(self.rx_sock)
+            except Exception as exp:
+                self.logger.info("RX ring not available on {}: {}".format(self.iface, exp))
+                self.rx_ring = None
 
-    def readp(self, iface):
+    def readp_batch(self, iface):
+        """
+        read the received frames without decoding them
+        returns list of (data, timestamp)
+        """
 
         if self.dry:
             time.sleep(2)
-            return None
+            return []
 
         if not self.iface:
-            return None
+            return []
 
         try:
-            data = afpacket.recv(self.rx_sock, 12 * 1024)
+            if self.rx_ring:
+                frames = self.rx_ring.recv()
+            else:
+                data = afpacket.recv(self.rx_sock, 12 * 1024)
+                frames = [(data, time.time())]
         except Exception as exp:
             if self.finished:
-                return None
+                return []
             raise exp
-        packet = Ether(data)
-        self.rx_count = self.rx_count + 1
-        self.trace_stats()
+
+        self.rx_count = self.rx_count + len(frames)
 
         if self.dbg > 1:
-            self.logger.debug("readp: {} len: {} count: {}".format(iface, len(data), self.rx_count))
+            self.logger.debug("readp_batch: {} frames: {} count: {}".format(iface, len(frames), self.rx_count))
 
         if self.dbg > 2:
-            self.trace_packet(packet, self.hex)
+            for data, _ in frames:
+                self.trace_packet(data, self.hex)
 
-        return packet
+        return frames
 
     def sendp(self, data, iface):
         self.tx_count = self.tx_count + 1
@@ -248,6 +272,30 @@ class ScapyPacket(object):
                 self.tx_sock = L2Socket(iface)
             self.tx_sock.send(data)
 
+    def sendp_batch(self, frames, iface):
+        self.tx_count = self.tx_count + len(frames)
+
+        if self.dbg > 1:
+            self.logger.debug("sendp_batch: {} frames: {} count: {}".format(iface, len(frames), self.tx_count))
+
+        if self.dry:
+            return len(frames)
+
+        if not self.tx_bulk and self.tx_backend != "scapy":
+            self.tx_bulk = afpacket.tx_batch_open(iface, self.tx_backend)
+            if not self.tx_bulk:
+                self.logger.info("bulk TX not available on {} using scapy".format(iface))
+                self.tx_backend = "scapy"
+
+        if not self.tx_bulk:
+            if not self.tx_sock:
+                self.tx_sock = L2Socket(iface)
+            for frame in frames:
+                self.tx_sock.send(frame)
+            return len(frames)
+
+        return self.tx_bulk.send(frames)
+
     def trace_stats(self):
         #self.logger.debug("Name: {} RX: {} TX: {}".format(self.iface, self.rx_count, self.tx_count))
         pass
@@ -261,15 +309,23 @@ class ScapyPacket(object):
 
     def trace_packet(self, pkt, hex=True, fields=True):
         if not fields and not hex: return
-        if isinstance(pkt, str): pkt = Ether(pkt)
+        if isinstance(pkt, (str, bytes, bytearray)): pkt = Ether(bytes(pkt))
         if fields: self.show_pkt(pkt)
         if hex: hexdump(pkt)
 
     def send_packet(self, pwa, iface):
+        if pwa.compiled:
+            # template already carries the patched fields and FCS
+            frame = pwa.compiled.frame(pwa.stream.next_seq())
+            self.sendp(frame, iface)
+            return frame
         if pwa.padding:
-            strpkt = str(pwa.pkt/pwa.padding)
+            pkt = pwa.pkt/pwa.padding
         else:
-            strpkt = str(pwa.pkt)
+            pkt = pwa.pkt
+        strpkt = str(pkt)
+        if pwa.stream.track_port:
+            strpkt = self.add_signature(pwa, pkt, strpkt)
         pkt_bytes = self.utils.tobytes(strpkt)
         try:
             crc1 = '{:08x}'.format(socket.htonl(zlib.crc32(pkt_bytes) & 0xFFFFFFFF))
@@ -281,6 +337,21 @@ class ScapyPacket(object):
         self.sendp(bstr, iface)
         return bstr
 
+    def add_signature(self, pwa, pkt, strpkt):
+        room = len(bytes(pkt[Padding])) if Padding in pkt else 0
+        if room < SIG_LEN:
+            self.track_frame(pwa.stream, strpkt)
+            return strpkt
+        buf = bytearray(strpkt)
+        sig_pack_into(buf, len(buf) - SIG_LEN, pwa.stream.sig_id, pwa.stream.next_seq())
+        return bytes(buf)
+
+    def track_frame(self, stream, frame):
+        # streams without signature are classified by invariant header fields
+        track_keys = stream.track_port.track_keys
+        if len(track_keys) < self.max_track_keys:
+            track_keys.setdefault(flow_key(bytes(frame)), stream)
+
     def check(self, pkt):
         pkt.do_build()
         if self.dbg > 3:
@@ -405,9 +476,16 @@ class ScapyPacket(object):
 
     def fill_emulation_params(self, stream):
 
+        # keep the handles so that every start reads the current addresses
+        handles = getattr(stream, "emulation_handles", None) or dict()
+        for key in ["emulation_src_handle", "emulation_dst_handle"]:
+            if key in stream.kws:
+                handles[key] = stream.kws.pop(key)
+        stream.emulation_handles = handles
+
          # read params from emulation interfaces
-        if "emulation_src_handle" in stream.kws:
-            emulation_src_handle = stream.kws.pop("emulation_src_handle")
+        emulation_src_handle = handles.get("emulation_src_handle")
+        if emulation_src_handle:
             intf_ip_addr = emulation_src_handle.kws.get("intf_ip_addr", "0.0.0.0")
             ipv6_intf_addr = emulation_src_handle.kws.get("ipv6_intf_addr", "")
             count = self.utils.intval(emulation_src_handle.kws, "count", 1)
@@ -432,8 +510,8 @@ class ScapyPacket(object):
                 self.logger.info(traceback.format_exc())
             self.logger.debug("updated stream.kws-1 = {}".format(stream.kws))
 
-        if "emulation_dst_handle" in stream.kws:
-            emulation_dst_handle = stream.kws.pop("emulation_dst_handle")
+        emulation_dst_handle = handles.get("emulation_dst_handle")
+        if emulation_dst_handle:
             intf_ip_addr = emulation_dst_handle.kws.get("intf_ip_addr", "")
             ipv6_intf_addr = emulation_dst_handle.kws.get("ipv6_intf_addr", "")
             count = self.utils.intval(emulation_dst_handle.kws, "count", 1)
@@ -451,8 +529,34 @@ class ScapyPacket(object):
                     stream.kws["ip_dst_mode"] = "increment"
             self.logger.debug("updated stream.kws-2 = {}".format(stream.kws))
 
+    def compile_stream(self, stream):
+        """
+        build and compile the stream at configuration time so that
+        the start of transmit only resets the compiled template
+        """
+        stream.pwa_cache = None
+        if not self.compiled_mode:
+            return None
+        for key in ["emulation_src_handle", "emulation_dst_handle"]:
+            # needs the resolved interface addresses, compile on first run
+            if key in stream.kws:
+                return None
+        try:
+            return self.build_first(stream)
+        except Exception as exp:
+            self.logger.info("compile {} failed: {}".format(stream.stream_id, exp))
+        return None
+
+    def restart(self, pwa):
+        pwa.left = pwa.max_loops
+        pwa.compiled.reset()
+        return pwa
+
     def build_first(self, stream):
 
+        if getattr(stream, "pwa_cache", None):
+            return self.restart(stream.pwa_cache)
+
         self.fill_emulation_params(stream)
 
         kws = copy.deepcopy(stream.kws)
@@ -645,10 +749,9 @@ class ScapyPacket(object):
         pwa = SpyTestDict()
         pwa.pkt = pkt
         pwa.left = max_loops
+        pwa.max_loops = max_loops
         pwa.transmit_mode = transmit_mode
-        if rate_pps > self.max_rate_pps:
-            self.logger.debug("drop the rate from {} to {}".format(rate_pps, self.max_rate_pps))
-            rate_pps = self.max_rate_pps
+        pwa.compiled = None
         pwa.rate_pps = rate_pps
         pwa.duration = duration
         pwa.stream = stream
@@ -675,6 +778,21 @@ class ScapyPacket(object):
         pwa.frame_size_step = frame_size_step
         self.add_padding(pwa, True)
 
+        # turn the stream into raw template when all options are supported
+        if self.compiled_mode:
+            try:
+                pwa.compiled = self.compiler.compile(pwa)
+                # resolved MAC/IP of the emulation handles may change
+                if not stream.emulation_handles:
+                    stream.pwa_cache = pwa
+            except CompileError as exp:
+                self.logger.debug("stream {} not compiled: {}".format(stream.stream_id, exp))
+
+        max_rate_pps = self.max_compiled_pps if pwa.compiled else self.max_rate_pps
+        if pwa.rate_pps > max_rate_pps:
+            self.logger.debug("drop the rate from {} to {}".format(pwa.rate_pps, max_rate_pps))
+            pwa.rate_pps = max_rate_pps
+
         return pwa
 
     def add_padding(self, pwa, first):
@@ -944,7 +1062,10 @@ class ScapyPacket(object):
             self.logger.debug("build_next transmit_mode={} left={}".format(pwa.transmit_mode, pwa.left))
 
         if pwa.transmit_mode in ["continuous", "continuous_burst"] or pwa.left > 1:
-            pwa = self.build_next_dma(pwa)
+            if pwa.compiled:
+                pwa.compiled.advance()
+            else:
+                pwa = self.build_next_dma(pwa)
             if not pwa: return None
 
         if pwa.transmit_mode in ["continuous", "continuous_burst"]:
@@ -958,33 +1079,20 @@ class ScapyPacket(object):
             self.logger.debug("TODO: transmit_mode = {}".format(pwa.transmit_mode))
         return None
 
-    def match_stream(self, stream, pkt):
-        rx_str = hexlify(bytes(str(pkt)))
-        #print("CMP: STREAM: {}".format(stream.kws))
-        #print("CMP: TRACK_RX: {}".format(rx_str))
-        for track_pkt in stream.track_pkts:
-            tx_str = hexlify(track_pkt)
-            #print("CMP: TRACK_TX: {}".format(tx_str))
-            if len(tx_str) <= len(rx_str):
-                if tx_str == rx_str[:len(tx_str)]:
-                    return True
-        return False
-        #if pkt.src != stream.kws.get("mac_src"): return False
-        #if pkt.dst != stream.kws.get("mac_dst"): return False
-
-        #if IPv6 in pkt and stream.kws.get("l3_protocol") != "ipv6": return False
-        #if IP in pkt and stream.kws.get("l3_protocol") != "ipv4": return False
-
-        #if IP in pkt:
-            #if pkt[IP].src != stream.kws.get("ip_src_addr"): return False
-            #if pkt[IP].dst != stream.kws.get("ip_dst_addr"): return False
-        #if TCP in pkt:
-            #if pkt[TCP].sport != self.get_int(stream.kws, "tcp_src_port", 0): return False
-            #if pkt[TCP].dport != self.get_int(stream.kws, "tcp_dst_port", 0): return False
-        #if UDP in pkt:
-            #if pkt[UDP].sport != self.get_int(stream.kws, "udp_src_port", 0): return False
-            #if pkt[UDP].dport != self.get_int(stream.kws, "udp_dst_port", 0): return False
-        #return True
+    def match_stream(self, port, data):
+        """
+        find the stream tracked on the port which has sent the frame
+        returns (stream, signature) where signature is (sig_id, seq, ts)
+        when the frame carries the stream signature
+        """
+        sig = sig_parse(data)
+        if sig:
+            stream = port.track_index.get(sig[0])
+            if stream:
+                return (stream, sig)
+        if port.track_keys:
+            return (port.track_keys.get(flow_key(data)), None)
+        return (None, None)
 
     def if_create_one(self, index, intf, ip4addr, ip4gw, ip6addr, ip6gw, smac, **kws):
         ns = "{}_{}".format(intf.name, index)
@@ -1,9 +1,12 @@
 import copy
+import time
+import itertools
 
 from dicts import SpyTestDict
 from driver import ScapyDriver
 from logger import Logger
 from utils import Utils
+from stats import RateMeter, RxStats
 
 def initStatistics(stats):
     stats.clear()
@@ -15,6 +18,26 @@ def initStatistics(stats):
     stats["userDefinedStat1"] = 0
     stats["userDefinedStat2"] = 0
     stats["captureFilter"] = 0
+    stats["framesSentRate"] = (0, 0, 0)
+    stats["framesReceivedRate"] = (0, 0, 0)
+
+def initLatencyStatistics(stats):
+    stats["minLatency"] = 0
+    stats["maxLatency"] = 0
+    stats["avgLatency"] = 0
+    stats["avgJitter"] = 0
+    stats["maxJitter"] = 0
+    stats["seqLoss"] = 0
+    stats["duplicateFrames"] = 0
+    stats["outOfOrderFrames"] = 0
+    stats["firstTimestamp"] = 0
+    stats["lastTimestamp"] = 0
+    stats["lossDuration"] = 0
+
+# stream signature identifiers, carried as 16 bit value in the frames
+sig_ids = itertools.count()
+def next_sig_id():
+    return next(sig_ids) % 0xFFFF + 1
 
 def incrStat(stats, name, val = 1):
     if name in stats:
@@ -32,22 +55,67 @@ class ScapyStream(object):
         self.enable = True
         self.enable2 = False
         self.stats = SpyTestDict()
-        initStatistics(self.stats)
+        self.tx_rate = RateMeter()
+        self.rx_rate = RateMeter()
+        self.rx = RxStats()
+        self.tx_seq = 0
+        self.rate_pps = 0
+        self.clear_stats()
         #print("ScapyStream: {} {} {}".format(self.port, self.stream_id, kws))
+        self.sig_id = next_sig_id()
         if track_port:
             track_port.track_streams.append(self)
-        self.track_pkts = []
+            track_port.track_index[self.sig_id] = self
+        self.pwa_cache = None
+        self.emulation_handles = dict()
 
     def __del__(self):
         print("ScapyStream {} exiting...".format(self.stream_id))
         if self.track_port:
             self.track_port.track_streams.remove(self)
+            self.track_port.track_index.pop(self.sig_id, None)
 
     def incrStat(self, name, val = 1):
+        if name == "framesSent":
+            self.tx_rate.add(val)
+        elif name == "framesReceived":
+            self.rx_rate.add(val)
         val = incrStat(self.stats, name, val)
         #print("incrStat: {} {} {} = {}".format(self.port, self.stream_id, name, val))
         return val
 
+    def next_seq(self):
+        seq = self.tx_seq
+        self.tx_seq = seq + 1
+        return seq
+
+    def clear_stats(self):
+        initStatistics(self.stats)
+        initLatencyStatistics(self.stats)
+        self.tx_rate.clear()
+        self.rx_rate.clear()
+        self.rx.clear()
+        self.tx_seq = 0
+
+    def getStats(self):
+        now = time.time()
+        (rx, stats) = (self.rx, self.stats)
+        stats["framesSentRate"] = self.tx_rate.get(now)
+        stats["framesReceivedRate"] = self.rx_rate.get(now)
+        stats["minLatency"] = rx.lat_min
+        stats["maxLatency"] = rx.lat_max
+        stats["avgLatency"] = rx.lat_avg()
+        stats["avgJitter"] = int(rx.jitter)
+        stats["maxJitter"] = int(rx.jitter_max)
+        stats["seqLoss"] = rx.loss
+        stats["duplicateFrames"] = rx.dup
+        stats["outOfOrderFrames"] = rx.ooo
+        stats["firstTimestamp"] = rx.first_ts
+        stats["lastTimestamp"] = rx.last_ts
+        if self.rate_pps:
+            stats["lossDuration"] = rx.loss * 1000.0 / self.rate_pps
+        return SpyTestDict(stats)
+
     def __str__(self):
         return ''.join([('%s=%s' % x) for x in self.kws.items()])
 
@@ -73,7 +141,7 @@ class ScapyInterface(object):
         return host_handle
 
 class ScapyPort(object):
-    def __init__(self, name, iface, dry=False, dbg=0, logger=None):
+    def __init__(self, name, iface, dry=False, dbg=0, logger=None, shared=None):
         self.name = name
         self.port_handle = "port-{}".format(name)
         self.iface = iface
@@ -83,8 +151,13 @@ class ScapyPort(object):
         self.utils = Utils(self.dry, logger=self.logger)
         self.streams = SpyTestDict()
         self.track_streams = []
+        self.track_index = dict()
+        self.track_keys = dict()
         self.interfaces = SpyTestDict()
         self.stats = SpyTestDict()
+        self.tx_rate = RateMeter()
+        self.rx_rate = RateMeter()
+        self.shared = shared
         initStatistics(self.stats)
         self.driver = ScapyDriver(self, self.dry, self.dbg, self.logger)
         self.admin_status = True
@@ -104,8 +177,9 @@ class ScapyPort(object):
         self.streams.clear()
         for stream in self.track_streams:
             stream.track_port = None
-            stream.track_pkts = []
         self.track_streams = []
+        self.track_index.clear()
+        self.track_keys.clear()
 
     def cleanup(self):
         self.logger.debug("ScapyPort {} cleanup...".format(self.name))
@@ -120,15 +194,27 @@ class ScapyPort(object):
         return self.admin_status
 
     def incrStat(self, name, val = 1):
+        if name == "framesSent":
+            self.tx_rate.add(val)
+        elif name == "framesReceived":
+            self.rx_rate.add(val)
+        if self.shared:
+            self.shared.incr(name, val)
         return incrStat(self.stats, name, val)
 
     def getStats(self):
-        return self.stats
+        now = time.time()
+        self.stats["framesSentRate"] = self.tx_rate.get(now)
+        self.stats["framesReceivedRate"] = self.rx_rate.get(now)
+        return SpyTestDict(self.stats)
+
+    def wait_for_quiesce(self, timeout=5):
+        return self.driver.waitForQuiesce(timeout)
 
     def getStreamStats(self):
         res = []
         for stream_id, stream in self.streams.items():
-            res.append([stream, stream.stats])
+            res.append([stream, stream.getStats()])
         return res
 
     def traffic_control(self, *args, **kws):
@@ -145,8 +231,12 @@ class ScapyPort(object):
             self.clean_streams()
         elif action == "clear_stats":
             initStatistics(self.stats)
+            if self.shared:
+                self.shared.clear()
+            self.tx_rate.clear()
+            self.rx_rate.clear()
             for stream in self.streams.values():
-                initStatistics(stream.stats)
+                stream.clear_stats()
             self.driver.clear_stats()
         else:
             self.error("unsupported", "traffic_control: action", action)
@@ -181,6 +271,7 @@ class ScapyPort(object):
             res.stream_id = self.stream_encode(index)
             stream = ScapyStream(self.name, res.stream_id, track_port, *args, **kws)
             self.streams[res.stream_id] = stream
+            self.driver.compileStream(stream)
         elif mode == "remove":
             stream_id = kws.get('stream_id', None)
             if stream_id not in self.streams:
@@ -201,6 +292,7 @@ class ScapyPort(object):
             if stream_id not in self.streams:
                 self.error("invalid", "stream_id", stream_id)
             self.streams[stream_id].kws.update(kws)
+            self.driver.compileStream(self.streams[stream_id])
         else:
             self.error("unsupported", "traffic_config: mode", mode)
         return res
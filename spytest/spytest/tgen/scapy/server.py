@@ -2,9 +2,12 @@ import os
 import sys
 import json
 import time
+import multiprocessing
 
 from dicts import SpyTestDict
 from port import ScapyPort
+from worker import PortWorker
+from worker import SIG_ID_RANGES
 from logger import Logger
 
 # create port map
@@ -29,6 +32,11 @@ class ScapyServer(object):
         self.mgrps = SpyTestDict()
         self.msrcs = SpyTestDict()
         self.logger = Logger()
+        self.workers = bool(int(os.getenv("SPYTEST_SCAPY_PORT_WORKERS", "0")))
+        self.worker_cpus = self.get_worker_cpus()
+        self.worker_index = 0
+        self.worker_free = []
+        self.stop_quiesce = float(os.getenv("SPYTEST_SCAPY_STOP_QUIESCE_SEC", "2"))
         os.system("ip -all netns del")
         os.system("sysctl -w net.bridge.bridge-nf-call-arptables=0")
         os.system("sysctl -w net.bridge.bridge-nf-call-ip6tables=0")
@@ -41,6 +49,33 @@ class ScapyServer(object):
         self.mgrps = SpyTestDict()
         self.msrcs = SpyTestDict()
 
+    def get_worker_cpus(self):
+        cpus = os.getenv("SPYTEST_SCAPY_WORKER_CPUS", "")
+        if cpus:
+            return [int(cpu) for cpu in cpus.split(",")]
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except Exception:
+            cpus = list(range(multiprocessing.cpu_count()))
+        # leave the first CPU to the RPC server when there are enough
+        return cpus[1:] if len(cpus) > 1 else cpus
+
+    def create_port(self, pname):
+        if not self.workers:
+            return ScapyPort(pname, portmap.get(pname), dry=self.dry,
+                             dbg=self.dbg, logger=self.logger)
+        # reuse the signature id range of the closed workers
+        if self.worker_free:
+            index = self.worker_free.pop(0)
+        else:
+            index = self.worker_index
+            self.worker_index = index + 1
+        if index >= SIG_ID_RANGES:
+            self.logger.error("signature id range {} overlaps with others".format(index))
+        cpu = self.worker_cpus[index % len(self.worker_cpus)]
+        return PortWorker(pname, portmap.get(pname), dry=self.dry, dbg=self.dbg,
+                          logger=self.logger, index=index, cpu=cpu, peers=self.ports)
+
     def cleanup_ports(self):
         for key in self.ports.keys():
             self.ports[key].cleanup()
@@ -73,12 +108,15 @@ class ScapyServer(object):
         retval = ""
         if req == "set-dbg-lvl":
             self.dbg = int(data)
+            self.worker_control(req, data)
         elif req == "set-dry-run":
             self.dry = data
         elif req == "set-max-pps":
             os.environ["SPYTEST_SCAPY_MAX_RATE_PPS"] = str(data)
+            self.worker_control(req, data)
         elif req == "init-log":
             self.logger.set_log_file(data)
+            self.worker_control(req, data)
         elif req == "read-log":
             retval = self.logger.get_log(data)
         elif req == "add-log":
@@ -93,6 +131,11 @@ class ScapyServer(object):
             self.error("Invalid", "server request", req)
         return retval
 
+    def worker_control(self, req, data):
+        for port in self.ports.values():
+            if isinstance(port, PortWorker):
+                port.server_control(req, data)
+
     def fix_port_name(self, pname):
         return pname.split("/")[-1].strip()
 
@@ -107,8 +150,10 @@ class ScapyServer(object):
             for pobj in self.ports.values():
                 if pobj.name == pname:
                     delete_ports.append(pobj)
-            pobj = ScapyPort(pname, portmap.get(pname), dry=self.dry,
-                             dbg=self.dbg, logger=self.logger)
+                    if isinstance(pobj, PortWorker):
+                        pobj.close()
+                        self.worker_free.append(pobj.index)
+            pobj = self.create_port(pname)
             self.ports[pobj.port_handle] = pobj
             res.port_handle[pname0] = pobj.port_handle
         for pobj in delete_ports:
@@ -145,7 +190,11 @@ class ScapyServer(object):
                 if not port.traffic_control(*args, **kws):
                     res = False
 
+        # let the frames in flight reach the RX counters
         action = kws.get('action', None)
+        if action == "stop":
+            self.wait_for_quiesce(self.stop_quiesce)
+
         if action in ["stop", "start"]:
             for port in self.ports.values():
                 stats = port.getStats()
@@ -415,7 +464,7 @@ class ScapyServer(object):
         port_handle = kws.get('port_handle', None)
         stream_id = kws.get('stream', None)
         mode = kws.get('mode', "aggregate")
-        time.sleep(5)
+        self.wait_for_quiesce(kws.get('wait_for_quiesce', 0))
         if mode == "aggregate" and stream_id:
             for port in self.ports.values():
                 for stream, stats in port.getStreamStats():
@@ -448,51 +497,97 @@ class ScapyServer(object):
         elif mode == "flow":
             if not port_handle or port_handle not in self.ports:
                 self.error("Invalid", "port_handle", port_handle)
-            stats = self.ports[port_handle].getStats()
-            tracking = SpyTestDict()
-            tracking["count"] = "2"
-            tracking["1"] = SpyTestDict()
-            tracking["1"]["tracking_name"] = "Traffic_Item"
-            tracking["1"]["tracking_value"] = "stream_id"
-            tracking["2"] = SpyTestDict()
-            tracking["2"]["tracking_name"] = "vlanId"
-            tracking["2"]["tracking_value"] = "100"
+            port_name = self.ports[port_handle].name
             res[mode] = SpyTestDict()
-            res[mode]["1"] = SpyTestDict()
-            res[mode]["1"]["rx"] = SpyTestDict()
-            res[mode]["1"]["pgid_value"] = 'N/A'
-            res[mode]["1"]["tracking"] = tracking
-            res[mode]["1"]["flow_name"] = 'stream id'
-            res[mode]["1"]["tx"] = SpyTestDict()
-            res[mode]["2"] = SpyTestDict()
-            res[mode]["2"]["rx"] = SpyTestDict()
-            res[mode]["2"]["pgid_value"] = 'N/A'
-            res[mode]["2"]["tracking"] = tracking
-            res[mode]["2"]["flow_name"] = 'stream id'
-            res[mode]["2"]["tx"] = SpyTestDict()
-            self.fill_stats(res[mode]["1"], stats, stats)
-            self.fill_stats(res[mode]["2"], stats, stats)
+            for port in self.ports.values():
+                for stream, stats in port.getStreamStats():
+                    track_port = stream.track_port
+                    if port.name != port_name and (not track_port or track_port.name != port_name):
+                        continue
+                    index = str(len(res[mode]) + 1)
+                    res[mode][index] = SpyTestDict()
+                    res[mode][index]["pgid_value"] = 'N/A'
+                    res[mode][index]["tracking"] = self.flow_tracking(stream)
+                    res[mode][index]["flow_name"] = stream.stream_id
+                    self.fill_stats(res[mode][index], stats, stats)
         else:
              self.logger.todo("unhandled", "mode", mode)
         return self.trace_result(res)
 
+    def wait_for_quiesce(self, timeout):
+        # wait at most timeout seconds for the RX counters to settle
+        timeout = float(timeout or 0)
+        if timeout <= 0:
+            return True
+        end_time = time.time() + timeout
+        retval = True
+        for port in self.ports.values():
+            if not port.wait_for_quiesce(max(end_time - time.time(), 0)):
+                self.logger.debug("{}: RX is not quiet".format(port.name))
+                retval = False
+        return retval
+
+    def flow_tracking(self, stream):
+        tracking = SpyTestDict()
+        tracking["count"] = "1"
+        tracking["1"] = SpyTestDict()
+        tracking["1"]["tracking_name"] = "Traffic_Item"
+        tracking["1"]["tracking_value"] = stream.stream_id
+        vlan_id = stream.kws.get("vlan_id", None)
+        if vlan_id is not None and stream.kws.get("vlan", "enable") == "enable":
+            tracking["count"] = "2"
+            tracking["2"] = SpyTestDict()
+            tracking["2"]["tracking_name"] = "vlanId"
+            tracking["2"]["tracking_value"] = str(vlan_id)
+        return tracking
+
     def stat_value(self, val, detailed=False):
+        # rates are reported as (avg, min, max) over the sliding window
+        if isinstance(val, tuple):
+            (avg, vmin, vmax) = (int(val[0]), int(val[1]), int(val[2]))
+        else:
+            (avg, vmin, vmax) = (val, val, val)
         if not detailed:
-            return val
-        return {"count":val, "max":0, "min":0, "sum":0, "avg":0}
+            return avg
+        return {"count":avg, "max":vmax, "min":vmin, "sum":avg, "avg":avg}
 
     def fill_stats(self, res, tx_stats, rx_stats, detailed=False):
         res["tx"] = SpyTestDict()
-        res["tx"]["total_pkt_rate"] = self.stat_value(1, detailed)
+        res["tx"]["total_pkt_rate"] = self.stat_value(tx_stats.framesSentRate, detailed)
         res["tx"]["raw_pkt_count"] = self.stat_value(tx_stats.framesSent, detailed)
         res["tx"]["pkt_byte_count"] = self.stat_value(tx_stats.bytesSent, detailed)
         res["tx"]["total_pkts"] = self.stat_value(tx_stats.framesSent, detailed)
         res["rx"] = SpyTestDict()
-        res["rx"]["raw_pkt_rate"] = self.stat_value(1, detailed)
+        res["rx"]["raw_pkt_rate"] = self.stat_value(rx_stats.framesReceivedRate, detailed)
+        res["rx"]["total_pkt_rate"] = self.stat_value(rx_stats.framesReceivedRate, detailed)
         res["rx"]["raw_pkt_count"] = self.stat_value(rx_stats.framesReceived, detailed)
         res["rx"]["pkt_byte_count"] = self.stat_value(rx_stats.bytesReceived, detailed)
         res["rx"]["total_pkts"] = self.stat_value(rx_stats.framesReceived, detailed)
         res["rx"]["oversize_count"] = self.stat_value(rx_stats.oversizeFramesReceived, detailed)
+        if "avgLatency" in rx_stats:
+            self.fill_latency_stats(res["rx"], tx_stats, rx_stats, detailed)
+
+    def fill_latency_stats(self, res, tx_stats, rx_stats, detailed=False):
+        # delays and jitter are reported in nano seconds
+        received = rx_stats.framesReceived - rx_stats.duplicateFrames
+        loss_pkts = max(tx_stats.framesSent - received, 0)
+        if tx_stats.framesSent:
+            loss_percent = "{:.3f}".format(loss_pkts * 100.0 / tx_stats.framesSent)
+        else:
+            loss_percent = "0.000"
+        res["min_delay"] = self.stat_value(rx_stats.minLatency * 1000, detailed)
+        res["max_delay"] = self.stat_value(rx_stats.maxLatency * 1000, detailed)
+        res["avg_delay"] = self.stat_value(rx_stats.avgLatency * 1000, detailed)
+        res["avg_jitter"] = self.stat_value(rx_stats.avgJitter * 1000, detailed)
+        res["max_jitter"] = self.stat_value(rx_stats.maxJitter * 1000, detailed)
+        res["loss_pkts"] = self.stat_value(loss_pkts, detailed)
+        res["loss_percent"] = loss_percent
+        res["sequence_gap_pkts"] = self.stat_value(rx_stats.seqLoss, detailed)
+        res["duplicate_pkts"] = self.stat_value(rx_stats.duplicateFrames, detailed)
+        res["out_of_order_pkts"] = self.stat_value(rx_stats.outOfOrderFrames, detailed)
+        res["pkt_loss_duration"] = "{:.3f}".format(rx_stats.lossDuration)
+        res["first_tstamp"] = rx_stats.firstTimestamp
+        res["last_tstamp"] = rx_stats.lastTimestamp
 
 if __name__ == '__main__':
     Logger.setup()
@@ -0,0 +1,85 @@
+"""
+Stream signature
+
+Frames of tracked streams carry a small trailer in their padding, right
+before the software FCS, with the stream id, the sequence number and the
+transmit timestamp (microseconds, 32 bits). The receiver classifies frames
+with a dict lookup on the signature stream id instead of comparing against
+transmitted frames.
+Streams without enough padding for the trailer fall back to a key built
+from the invariant L3/L4 header fields.
+"""
+
+import time
+import struct
+
+SIG_MAGIC = 0x5C7E
+SIG_FORMAT = "!HHII"
+SIG_LEN = struct.calcsize(SIG_FORMAT)
+
+# the trailer is followed by the 4 byte software FCS
+SIG_TAIL = 4
+
+# how far from the end of the frame to look for the trailer when the DUT
+# has changed the frame length (VLAN tag removal padding etc.)
+SIG_SEARCH = 64
+
+SIG_MAGIC_BYTES = struct.pack("!H", SIG_MAGIC)
+
+ETH_P_8021Q = 0x8100
+ETH_P_8021AD = 0x88A8
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+
+def time_us(now=None):
+    return int((now or time.time()) * 1000000) & 0xFFFFFFFF
+
+def sig_pack_into(buf, offset, sig_id, seq, ts=None):
+    if ts is None: ts = time_us()
+    struct.pack_into(SIG_FORMAT, buf, offset, SIG_MAGIC, sig_id, seq & 0xFFFFFFFF, ts)
+
+def sig_unpack(data, offset):
+    (magic, sig_id, seq, ts) = struct.unpack_from(SIG_FORMAT, data, offset)
+    if magic != SIG_MAGIC:
+        return None
+    return (sig_id, seq, ts)
+
+def sig_parse(data):
+    """
+    returns (sig_id, seq, ts) from the trailer or None
+    """
+    offset = len(data) - SIG_TAIL - SIG_LEN
+    if offset < 0:
+        return None
+    sig = sig_unpack(data, offset)
+    if sig:
+        return sig
+    start = max(0, len(data) - SIG_SEARCH)
+    offset = data.rfind(SIG_MAGIC_BYTES, start, len(data) - SIG_LEN + 2)
+    if offset < 0 or offset + SIG_LEN > len(data):
+        return None
+    return sig_unpack(data, offset)
+
+def flow_key(data):
+    """
+    key from the header fields which are not modified by routing
+    IPv4/IPv6: addresses, protocol and L4 ports
+    others: ethertype and MAC addresses
+    """
+    offset, etype = 12, 0
+    while offset + 2 <= len(data):
+        etype = struct.unpack_from("!H", data, offset)[0]
+        if etype not in [ETH_P_8021Q, ETH_P_8021AD]:
+            break
+        offset = offset + 4
+    offset = offset + 2
+    if etype == ETH_P_IP and len(data) >= offset + 20:
+        ihl = (bytearray(data[offset:offset+1])[0] & 0x0F) * 4
+        proto = data[offset+9:offset+10]
+        ports = data[offset+ihl:offset+ihl+4]
+        return (etype, data[offset+12:offset+20], proto, ports)
+    if etype == ETH_P_IPV6 and len(data) >= offset + 40:
+        nh = data[offset+6:offset+7]
+        ports = data[offset+40:offset+44]
+        return (etype, data[offset+8:offset+40], nh, ports)
+    return (etype, data[0:12])
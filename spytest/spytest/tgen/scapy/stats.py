@@ -0,0 +1,128 @@
+"""
+Per stream rate, latency and sequence counters
+
+The counters are updated for every received frame, so they only use
+preallocated fixed size storage and integer arithmetic.
+"""
+
+import time
+
+from signature import time_us
+
+class RateMeter(object):
+    """
+    sliding window packet rate
+    the window is split into buckets and the bucket being filled
+    is not used for the rate calculation
+    """
+    def __init__(self, window=1.0, buckets=10):
+        self.buckets = buckets
+        self.width = float(window) / buckets
+        self.slots = [0] * buckets
+        self.counts = [0] * buckets
+
+    def clear(self):
+        for i in range(self.buckets):
+            self.slots[i] = 0
+            self.counts[i] = 0
+
+    def add(self, count=1, now=None):
+        slot = int((now or time.time()) / self.width)
+        index = slot % self.buckets
+        if self.slots[index] != slot:
+            self.slots[index] = slot
+            self.counts[index] = 0
+        self.counts[index] += count
+
+    def get(self, now=None):
+        """
+        returns (avg, min, max) rate in packets per second
+        """
+        slot = int((now or time.time()) / self.width)
+        rates = []
+        for i in range(1, self.buckets):
+            index = (slot - i) % self.buckets
+            if self.slots[index] == slot - i:
+                rates.append(self.counts[index] / self.width)
+            else:
+                rates.append(0)
+        if not rates:
+            return (0, 0, 0)
+        return (sum(rates) / len(rates), min(rates), max(rates))
+
+    def rate(self, now=None):
+        return int(self.get(now)[0])
+
+class RxStats(object):
+    """
+    latency, jitter and sequence statistics of the frames received for
+    one stream, all latency values are in microseconds
+    @window number of recent sequence numbers remembered for duplicate
+            and out of order detection
+    """
+    def __init__(self, window=1024):
+        self.window = window
+        self.seen = bytearray(window)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.lat_min = 0
+        self.lat_max = 0
+        self.lat_sum = 0
+        self.lat_last = 0
+        self.jitter = 0.0
+        self.jitter_max = 0.0
+        self.expected = 0
+        self.loss = 0
+        self.dup = 0
+        self.ooo = 0
+        self.first_ts = 0
+        self.last_ts = 0
+        self.seen[:] = bytearray(self.window)
+
+    def update(self, seq, tx_us, rx_time):
+        # latency from the 32 bit microsecond timestamps
+        latency = (time_us(rx_time) - tx_us) & 0xFFFFFFFF
+        if latency >= 0x80000000:
+            latency = 0
+        if not self.count:
+            (self.lat_min, self.lat_max) = (latency, latency)
+            self.first_ts = rx_time
+        else:
+            if latency < self.lat_min: self.lat_min = latency
+            if latency > self.lat_max: self.lat_max = latency
+            # RFC 3550 inter arrival jitter
+            delta = abs(latency - self.lat_last)
+            self.jitter = self.jitter + (delta - self.jitter) / 16.0
+            if self.jitter > self.jitter_max: self.jitter_max = self.jitter
+        self.lat_last = latency
+        self.lat_sum = self.lat_sum + latency
+        self.last_ts = rx_time
+        self.count = self.count + 1
+
+        # sequence tracking
+        window = self.window
+        if seq >= self.expected:
+            gap = seq - self.expected
+            if gap >= window:
+                self.seen[:] = bytearray(window)
+            else:
+                for missing in range(self.expected, seq):
+                    self.seen[missing % window] = 0
+            self.loss = self.loss + gap
+            self.seen[seq % window] = 1
+            self.expected = seq + 1
+        elif self.expected - seq > window:
+            self.ooo = self.ooo + 1
+        elif self.seen[seq % window]:
+            self.dup = self.dup + 1
+        else:
+            # late arrival of a frame accounted as lost
+            self.seen[seq % window] = 1
+            self.ooo = self.ooo + 1
+            if self.loss > 0:
+                self.loss = self.loss - 1
+
+    def lat_avg(self):
+        return self.lat_sum // self.count if self.count else 0
@@ -0,0 +1,351 @@
+"""
+Port worker processes
+
+Each port runs its ScapyPort (driver TX/RX threads included) in its own
+process pinned to a CPU, so the ports do not compete for one GIL.
+The server talks to the workers through PortWorker proxies which keep the
+ScapyPort methods used by the server. Control calls go over a pipe and the
+port counters are published in shared memory, so reading the port stats
+does not need a round trip to the worker.
+
+Streams tracked on another port are registered in the receiving worker
+with the signature id allocated by the transmitting worker. Streams that
+have no room for the signature trailer are only counted in the port stats
+of the receiving port in this mode.
+"""
+
+import os
+import time
+import itertools
+import threading
+import multiprocessing
+from ctypes import c_double
+
+import port as port_module
+from dicts import SpyTestDict
+from port import ScapyPort, ScapyStream, initStatistics
+
+# port counters published by the worker
+COUNTERS = ["framesSent", "bytesSent", "framesReceived", "bytesReceived",
+            "oversizeFramesReceived", "userDefinedStat1", "userDefinedStat2",
+            "captureFilter"]
+RATES = ["framesSentRate", "framesReceivedRate"]
+
+# stream stats owned by the receiving port
+RX_STATS = ["framesReceived", "bytesReceived", "framesReceivedRate", "minLatency",
+            "maxLatency", "avgLatency", "avgJitter", "maxJitter", "seqLoss",
+            "duplicateFrames", "outOfOrderFrames", "firstTimestamp",
+            "lastTimestamp", "lossDuration"]
+
+# signature ids are allocated from a separate range in each worker
+SIG_ID_RANGE = 4096
+SIG_ID_RANGES = 0x10000 // SIG_ID_RANGE
+
+# how often the worker publishes the port rates
+PUBLISH_INTERVAL = 0.2
+
+class SharedStats(object):
+    """
+    port counters in shared memory, written by the worker only
+    """
+    def __init__(self):
+        self.index = dict()
+        for name in COUNTERS:
+            self.index[name] = len(self.index)
+        for name in RATES:
+            self.index[name] = len(self.index)
+            self.index[name + ".min"] = len(self.index)
+            self.index[name + ".max"] = len(self.index)
+        self.values = multiprocessing.RawArray(c_double, len(self.index))
+
+    def clear(self):
+        for i in range(len(self.values)):
+            self.values[i] = 0
+
+    def incr(self, name, val=1):
+        index = self.index.get(name, None)
+        if index is not None:
+            self.values[index] += val
+
+    def set_rate(self, name, rate):
+        index = self.index[name]
+        (self.values[index], self.values[index+1], self.values[index+2]) = rate
+
+    def get(self):
+        stats = SpyTestDict()
+        initStatistics(stats)
+        for name in COUNTERS:
+            stats[name] = int(self.values[self.index[name]])
+        for name in RATES:
+            index = self.index[name]
+            stats[name] = tuple(self.values[index:index+3])
+        return stats
+
+class TrackPeer(object):
+    """
+    stand-in for a track port which is served by another worker
+    """
+    def __init__(self, name):
+        self.name = name
+        self.track_streams = []
+        self.track_index = dict()
+        self.track_keys = dict()
+
+class TrackedStream(ScapyStream):
+    """
+    receive side of a stream transmitted by another worker
+    """
+    def __init__(self, port, stream_id, sig_id):
+        ScapyStream.__init__(self, port.name, stream_id, None)
+        self.sig_id = sig_id
+        self.track_port = port
+        port.track_streams.append(self)
+        port.track_index[sig_id] = self
+
+class StreamView(object):
+    """
+    server side copy of the stream attributes used for the stats
+    """
+    def __init__(self, stream_id, kws, track_port):
+        self.stream_id = stream_id
+        self.kws = kws
+        self.track_port = track_port
+
+class WorkerMain(object):
+    """
+    runs in the worker process and serves the requests from the pipe
+    """
+    def __init__(self, conn, shared, index, cpu, name, iface, dry, dbg, logger):
+        self.conn = conn
+        self.shared = shared
+        self.logger = logger
+        self.pin_cpu(cpu)
+        port_module.sig_ids = itertools.count(index * SIG_ID_RANGE)
+        self.port = ScapyPort(name, iface, dry=dry, dbg=dbg, logger=logger, shared=shared)
+
+    def pin_cpu(self, cpu):
+        if cpu is None:
+            return
+        try:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, [cpu])
+            else:
+                os.system("taskset -pc {} {} > /dev/null".format(cpu, os.getpid()))
+        except Exception as exp:
+            self.logger.error("failed to pin worker to CPU", cpu, exp)
+
+    def publish(self):
+        stats = self.port.getStats()
+        for name in RATES:
+            self.shared.set_rate(name, stats[name])
+
+    def run(self):
+        last = 0
+        while True:
+            if self.conn.poll(PUBLISH_INTERVAL):
+                try:
+                    (func, args, kws) = self.conn.recv()
+                except EOFError:
+                    break
+                if func is None:
+                    break
+                try:
+                    handler = getattr(self, "do_" + func, None)
+                    if handler:
+                        retval = handler(*args, **kws)
+                    else:
+                        retval = getattr(self.port, func)(*args, **kws)
+                    self.conn.send((True, retval))
+                except Exception as exp:
+                    self.logger.log_exception(exp, "worker {} {}".format(self.port.name, func))
+                    self.conn.send((False, str(exp)))
+            now = time.time()
+            if now - last >= PUBLISH_INTERVAL:
+                self.publish()
+                last = now
+        self.port.cleanup()
+
+    def do_server_control(self, req, data):
+        if req == "set-dbg-lvl":
+            self.port.dbg = int(data)
+        elif req == "set-max-pps":
+            os.environ["SPYTEST_SCAPY_MAX_RATE_PPS"] = str(data)
+        elif req == "init-log":
+            self.logger.set_log_file(data)
+
+    def do_traffic_config(self, track_name, *args, **kws):
+        track_port = TrackPeer(track_name) if track_name else None
+        res = self.port.traffic_config(track_port, *args, **kws)
+        stream = self.port.streams.get(res.get("stream_id", None), None)
+        return (res, stream.sig_id if stream else 0)
+
+    def do_track_add(self, stream_id, sig_id):
+        # stream ids are reused after the transmitting port is reset
+        for stream in list(self.port.track_streams):
+            if isinstance(stream, TrackedStream) and stream.stream_id == stream_id:
+                self.port.track_streams.remove(stream)
+                self.port.track_index.pop(stream.sig_id, None)
+                stream.track_port = None
+        TrackedStream(self.port, stream_id, sig_id)
+
+    def do_track_stats(self):
+        res = dict()
+        for stream in self.port.track_streams:
+            if not isinstance(stream, TrackedStream):
+                continue
+            stats = stream.getStats()
+            res[stream.stream_id] = dict([(name, stats[name]) for name in RX_STATS])
+        return res
+
+    def do_stream_stats(self):
+        res = []
+        for stream in self.port.streams.values():
+            track_name = stream.track_port.name if stream.track_port else None
+            res.append([stream.stream_id, stream.kws, track_name,
+                        stream.rate_pps, dict(stream.getStats())])
+        return res
+
+def worker_main(*args):
+    WorkerMain(*args).run()
+
+class PortWorker(object):
+    """
+    server side proxy of a ScapyPort running in a worker process
+    @peers port handle to ScapyPort/PortWorker map used to find track ports
+    """
+    def __init__(self, name, iface, dry=False, dbg=0, logger=None, index=0, cpu=None, peers=None):
+        self.name = name
+        self.port_handle = "port-{}".format(name)
+        self.iface = iface
+        self.logger = logger
+        self.index = index
+        self.peers = peers if peers is not None else dict()
+        self.lock = threading.Lock()
+        self.shared = SharedStats()
+        (self.conn, child) = multiprocessing.Pipe()
+        args = (child, self.shared, index, cpu, name, iface, dry, dbg, logger)
+        self.proc = multiprocessing.Process(target=worker_main, args=args,
+                                            name="scapy-{}".format(name))
+        self.proc.daemon = True
+        self.proc.start()
+        child.close()
+
+    def __del__(self):
+        self.close()
+
+    def call(self, func, *args, **kws):
+        with self.lock:
+            if not self.proc:
+                raise ValueError("worker {} is closed".format(self.name))
+            self.conn.send((func, args, kws))
+            (status, retval) = self.conn.recv()
+        if not status:
+            raise ValueError(retval)
+        return retval
+
+    def close(self):
+        if not getattr(self, "proc", None):
+            return
+        with self.lock:
+            try:
+                self.conn.send((None, None, None))
+            except Exception:
+                pass
+            self.proc.join(10)
+            if self.proc.is_alive():
+                self.proc.terminate()
+            self.proc = None
+
+    def find_peer(self, name):
+        for peer in self.peers.values():
+            if peer.name == name:
+                return peer
+        return None
+
+    def server_control(self, req, data):
+        return self.call("server_control", req, data)
+
+    def clean_interfaces(self):
+        return self.call("clean_interfaces")
+
+    def clean_streams(self):
+        return self.call("clean_streams")
+
+    def cleanup(self):
+        if self.proc:
+            self.call("cleanup")
+
+    def set_admin_status(self, val):
+        return self.call("set_admin_status", val)
+
+    def get_admin_status(self):
+        return self.call("get_admin_status")
+
+    def getStats(self):
+        return self.shared.get()
+
+    def getStreamStats(self):
+        (res, tracked) = ([], dict())
+        for stream_id, kws, track_name, rate_pps, stats in self.call("stream_stats"):
+            track_port = self.find_peer(track_name) if track_name else None
+            if track_port:
+                if track_name not in tracked:
+                    tracked[track_name] = track_port.call("track_stats")
+                stats.update(tracked[track_name].get(stream_id, {}))
+                if rate_pps:
+                    stats["lossDuration"] = stats["seqLoss"] * 1000.0 / rate_pps
+            stats = SpyTestDict(stats)
+            res.append([StreamView(stream_id, kws, track_port), stats])
+        return res
+
+    def wait_for_quiesce(self, timeout=5):
+        return self.call("wait_for_quiesce", timeout)
+
+    def traffic_control(self, *args, **kws):
+        return self.call("traffic_control", *args, **kws)
+
+    def packet_control(self, *args, **kws):
+        return self.call("packet_control", *args, **kws)
+
+    def packet_stats(self, *args, **kws):
+        return self.call("packet_stats", *args, **kws)
+
+    def stream_validate(self, handle):
+        return self.call("stream_validate", handle)
+
+    def traffic_config(self, track_port, *args, **kws):
+        track_name = track_port.name if track_port else None
+        (res, sig_id) = self.call("traffic_config", track_name, *args, **kws)
+        if track_port and sig_id and kws.get('mode', None) == "create":
+            track_port.call("track_add", res.stream_id, sig_id)
+        return res
+
+    def find_interface(self, handle):
+        return self.call("find_interface", handle)
+
+    def igmp_host_validate(self, handle):
+        return self.call("igmp_host_validate", handle)
+
+    def interface_validate(self, handle):
+        return self.call("interface_validate", handle)
+
+    def interface_config(self, *args, **kws):
+        return self.call("interface_config", *args, **kws)
+
+    def emulation_bgp_config(self, *args, **kws):
+        return self.call("emulation_bgp_config", *args, **kws)
+
+    def emulation_bgp_route_config(self, *args, **kws):
+        return self.call("emulation_bgp_route_config", *args, **kws)
+
+    def emulation_bgp_control(self, *args, **kws):
+        return self.call("emulation_bgp_control", *args, **kws)
+
+    def emulation_igmp_config(self, *args, **kws):
+        return self.call("emulation_igmp_config", *args, **kws)
+
+    def emulation_igmp_group_config(self, *args, **kws):
+        return self.call("emulation_igmp_group_config", *args, **kws)
+
+    def emulation_igmp_control(self, *args, **kws):
+        return self.call("emulation_igmp_control", *args, **kws)
@@ -8,6 +8,7 @@ import random
 import socket
 import string
 import struct
+import zlib
 import hashlib
 import textwrap
 import datetime
@@ -78,6 +79,224 @@ def make_list(arg):
         return arg
     return [arg]
 
+class ParsedRow(dict):
+    """
+    row of the ParsedTable, drops the indexes of the table when modified
+    """
+    __slots__ = ("_table",)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._table = None
+
+    def __reduce__(self):
+        # copies and pickles are plain rows not tied to the table
+        return (ParsedRow, (dict(self),))
+
+    def _changed(self):
+        table = getattr(self, "_table", None)
+        if table is not None:
+            table._invalidate()
+
+    def __setitem__(self, *args):
+        self._changed()
+        return dict.__setitem__(self, *args)
+
+    def __delitem__(self, *args):
+        self._changed()
+        return dict.__delitem__(self, *args)
+
+    def clear(self):
+        self._changed()
+        return dict.clear(self)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def setdefault(self, *args):
+        self._changed()
+        return dict.setdefault(self, *args)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        return dict.update(self, *args, **kwargs)
+
+class ParsedTable(list):
+    """
+    list of dicts returned for parsed show output
+
+    The rows are used exactly as a list of dicts. In addition the table
+    builds a hash index per column on the first lookup using that column,
+    which maps the string form of the column value to the row positions,
+    so that filter_and_select and the batched lookups need not scan and
+    convert every row for every match.
+
+    The indexes are dropped when the list or any of its rows is modified.
+    The rows given to the table are copied into ParsedRow objects, which
+    report the changes. Plain dicts added later can not report them, so
+    the table stops caching the indexes once it holds such a row.
+    """
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self._indexes = dict()
+        self._cache = True
+        for pos, row in enumerate(self):
+            if isinstance(row, dict):
+                row = ParsedRow(row)
+                row._table = self
+                list.__setitem__(self, pos, row)
+
+    def _adopt(self, rows):
+        for row in rows:
+            if isinstance(row, ParsedRow):
+                row._table = self
+            else:
+                self._cache = False
+
+    def reindex(self):
+        self._indexes = dict()
+
+    def _index(self, col):
+        indexes = getattr(self, "_indexes", None)
+        if indexes is None:
+            indexes = self._indexes = dict()
+        entry = indexes.get(col, None)
+        if entry is None:
+            (index, values) = (dict(), [])
+            for pos, ent in enumerate(self):
+                value = str(ent[col]) if col in ent else None
+                values.append(value)
+                if value is not None:
+                    index.setdefault(value, []).append(pos)
+            entry = (index, values)
+            if getattr(self, "_cache", True):
+                indexes[col] = entry
+        return entry
+
+    def _positions(self, match):
+        if isinstance(match, list):
+            # list of matches - select if any one is matched
+            positions = set()
+            for m in match:
+                if not m:
+                    return range(len(self))
+                positions.update(self._positions(m))
+            return sorted(positions)
+        # select if all conditions match, starting from the fewest rows
+        conds = []
+        for key, value in match.items():
+            (index, values) = self._index(key)
+            value = str(value)
+            positions = index.get(value, None)
+            if not positions:
+                return []
+            conds.append((len(positions), positions, values, value))
+        conds.sort(key=lambda cond: cond[0])
+        retval = conds[0][1]
+        for _, _, values, value in conds[1:]:
+            retval = [pos for pos in retval if values[pos] == value]
+        return retval
+
+    def find(self, match=None):
+        """
+        returns the rows matching the match expression of filter_and_select
+        """
+        if not match:
+            return list(self)
+        if not isinstance(match, (dict, list)):
+            return None
+        return [self[pos] for pos in self._positions(match)]
+
+    def find_each(self, matches):
+        """
+        returns the list of matched rows for each of the given matches
+        """
+        return [self.find(match) for match in matches]
+
+    def find_missing(self, matches):
+        """
+        returns the matches which do not match any row, for example all the
+        BGP neighbors not in Established state in one pass over the table
+        """
+        return [match for match in matches if match and not self._positions(match)]
+
+    def _invalidate(self):
+        if getattr(self, "_indexes", None):
+            self._indexes = dict()
+
+    def __setitem__(self, index, value):
+        self._invalidate()
+        if isinstance(index, slice):
+            value = list(value)
+            self._adopt(value)
+        else:
+            self._adopt([value])
+        return list.__setitem__(self, index, value)
+
+    def __delitem__(self, *args):
+        self._invalidate()
+        return list.__delitem__(self, *args)
+
+    def __iadd__(self, other):
+        self._invalidate()
+        other = list(other)
+        self._adopt(other)
+        return list.__iadd__(self, other)
+
+    def append(self, row):
+        self._invalidate()
+        self._adopt([row])
+        return list.append(self, row)
+
+    def extend(self, rows):
+        self._invalidate()
+        rows = list(rows)
+        self._adopt(rows)
+        return list.extend(self, rows)
+
+    def insert(self, index, row):
+        self._invalidate()
+        self._adopt([row])
+        return list.insert(self, index, row)
+
+    def pop(self, *args):
+        self._invalidate()
+        return list.pop(self, *args)
+
+    def remove(self, *args):
+        self._invalidate()
+        return list.remove(self, *args)
+
+    def sort(self, *args, **kwargs):
+        self._invalidate()
+        return list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._invalidate()
+        return list.reverse(self)
+
+    def clear(self):
+        self._invalidate()
+        del self[:]
+
+    def __imul__(self, other):
+        self._invalidate()
+        return list.__imul__(self, other)
+
+    def __setslice__(self, *args):
+        self._invalidate()
+        return list.__setslice__(self, *args)
+
+    def __delslice__(self, *args):
+        self._invalidate()
+        return list.__delslice__(self, *args)
+
 def filter_and_select(output, select=None, match=None):
     """
 
@@ -113,10 +332,14 @@ def filter_and_select(output, select=None, match=None):
         return newd
 
     # collect the matched/all entries
-    retval = []
-    for ent in output:
-        if not match or match_entry(ent, match):
-            retval.append(ent)
+    retval = None
+    if isinstance(output, ParsedTable):
+        retval = output.find(match)
+    if retval is None:
+        retval = []
+        for ent in output:
+            if not match or match_entry(ent, match):
+                retval.append(ent)
 
     # return all columns if select is not specified
     if not select:
@@ -242,6 +465,16 @@ def ipcheck(addr):
 def sprintf(fmt, *args):
     return fmt % args
 
+def shell_quote(value):
+    """
+    quote the value as one shell word which is passed to the command as is
+    """
+    if not value:
+        return "''"
+    if re.match(r"^[\w@%+=:,./-]+$", value):
+        return value
+    return "'" + value.replace("'", "'\"'\"'") + "'"
+
 def md5(fname):
     hash_md5 = hashlib.md5()
     with open(fname, "rb") as f:
@@ -249,6 +482,54 @@ def md5(fname):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+def sha256(fname):
+    hash_sha256 = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
+
+cksum_table = []
+def cksum(data):
+    """
+    returns the CRC printed by POSIX cksum for the given bytes
+    """
+    if not cksum_table:
+        for i in range(256):
+            crc = i << 24
+            for _ in range(8):
+                crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+            cksum_table.append(crc & 0xFFFFFFFF)
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ cksum_table[(crc >> 24) ^ byte]
+    length = len(data)
+    while length:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ cksum_table[(crc >> 24) ^ (length & 0xFF)]
+        length >>= 8
+    return ~crc & 0xFFFFFFFF
+
+def compress_data(data, method="gzip"):
+    """
+    compress the bytes with gzip or xz
+    returns the compressed data and the shell command to decompress it
+    """
+    if method == "xz":
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                lzma = None
+        if lzma:
+            return (lzma.compress(data), "xz -dc")
+        method = "gzip"
+    if method == "gzip":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return (compressor.compress(data) + compressor.flush(), "gzip -dc")
+    return (data, "cat")
+
 def b64encode(file_path):
     fh = open_file(file_path)
     text = fh.read()
@@ -437,6 +718,38 @@ def write_html_table(cols, rows, filepath=None):
 
     return write_file(filepath, html)
 
+def write_html_table3(cols, rows, filepath, offset=None):
+    """
+    Streams the rows into html table file. When the offset returned
+    by the previous call is given, the rows are appended to the table.
+    :return: offset to append the next rows
+    """
+    def encode(data):
+        if sys.version_info.major < 3:
+            return data
+        return data.encode("utf-8")
+
+    def escape(value):
+        value = "{}".format(value)
+        return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+    if offset is None or not os.path.exists(filepath):
+        fd = open(filepath, "wb")
+        fd.write(encode("<table border='1'>\n<thead>\n<tr>"))
+        fd.write(encode("".join(["<th>{}</th>".format(escape(col)) for col in cols])))
+        fd.write(encode("</tr>\n</thead>\n<tbody>\n"))
+    else:
+        fd = open(filepath, "r+b")
+        fd.seek(offset)
+        fd.truncate()
+    for row in rows:
+        cells = "".join(["<td>{}</td>".format(escape(cell)) for cell in row])
+        fd.write(encode("<tr>{}</tr>\n".format(cells)))
+    offset = fd.tell()
+    fd.write(encode("</tbody>\n</table>\n"))
+    fd.close()
+    return offset
+
 def write_html_table2(cols, rows, filepath=None, links=None):
     template = textwrap.dedent("""\
     <table border='1'>
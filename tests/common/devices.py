@@ -11,14 +11,103 @@ import json
 import logging
 import os
 import re
+import time
 import inspect
 import ipaddress
+import threading
 from multiprocessing.pool import ThreadPool
 from datetime import datetime
 
 from errors import RunAnsibleModuleFail
 from errors import UnsupportedAnsibleModule
 
+# Bounded thread pool shared by all hosts for running ansible modules asynchronously
+MODULE_POOL_SIZE = int(os.environ.get("ANSIBLE_MODULE_POOL_SIZE", 16))
+_module_pool = None
+_module_pool_lock = threading.Lock()
+
+# Modules running at the same time on one host, kept below the sshd MaxSessions default of 10 as the modules of a
+# host share one ssh ControlMaster connection
+MODULE_HOST_CONCURRENCY = int(os.environ.get("ANSIBLE_MODULE_HOST_CONCURRENCY", 8))
+_host_slots = {}
+
+# Ansible hosts created by ansible_adhoc keyed by host and connection, the ansible_adhoc object is kept with the host
+# to tell when a new ansible_adhoc is in use
+_adhoc_hosts = {}
+
+
+def get_module_pool():
+    """
+    @summary: Get the thread pool shared by all asynchronous ansible module calls.
+    """
+    global _module_pool
+    with _module_pool_lock:
+        if _module_pool is None:
+            _module_pool = ThreadPool(MODULE_POOL_SIZE)
+        return _module_pool
+
+
+def get_host_slots(hostname):
+    """
+    @summary: Get the semaphore bounding the number of modules running at the same time on the host.
+    """
+    with _module_pool_lock:
+        if hostname not in _host_slots:
+            _host_slots[hostname] = threading.BoundedSemaphore(MODULE_HOST_CONCURRENCY)
+        return _host_slots[hostname]
+
+
+def run_modules(calls, module_ignore_errors=False):
+    """
+    @summary: Run many ansible module calls across hosts at once.
+
+    The calls are submitted to the shared module pool, so the number of modules running in parallel is bounded
+    by MODULE_POOL_SIZE, and by MODULE_HOST_CONCURRENCY for each host.
+
+    @param calls: List of (host, module_name, module_args, complex_args) tuples, module_args and complex_args
+                  are optional. For example: [(duthost, "command", ["show version"]), (ptfhost, "shell", ["ls"])]
+    @param module_ignore_errors: Do not raise exception when any of the module calls failed
+    @return: List of the module results in the order of the calls
+    """
+    tasks = []
+    for call in calls:
+        host, module_name = call[0], call[1]
+        module_args = call[2] if len(call) > 2 else []
+        complex_args = dict(call[3]) if len(call) > 3 else {}
+        complex_args.setdefault("module_ignore_errors", True)
+        tasks.append(host.submit(module_name, *module_args, **complex_args))
+
+    results = [task.get() for task in tasks]
+    if not module_ignore_errors:
+        for call, res in zip(calls, results):
+            if res.is_failed:
+                raise RunAnsibleModuleFail("run module {} failed on {}".format(call[1], call[0].hostname), res)
+    return results
+
+
+class AsyncModuleTask(object):
+    """
+    @summary: Handle of an ansible module running asynchronously.
+
+    Returned together with the result by module calls with module_async=True. The module runs in a pool of its own,
+    outside the shared module pool and the host slots, so a module that never returns (a reboot) does not hold the
+    resources needed by the later module calls on the host. The thread of the module can not be stopped, terminating
+    the task only stops waiting for it, the daemon thread goes away when the module returns or at exit.
+    """
+    def __init__(self, hostname, module_name, pool, result):
+        self.hostname = hostname
+        self.module_name = module_name
+        self.pool = pool
+        self.result = result
+
+    def is_alive(self):
+        return not self.result.ready()
+
+    def terminate(self):
+        if not self.result.ready():
+            logging.warning("[{}] AnsibleModule::{} can not be terminated, abandon it".format(self.hostname,
+                                                                                             self.module_name))
+
 
 class AnsibleHostBase(object):
     """
@@ -30,53 +119,75 @@ class AnsibleHostBase(object):
     """
 
     def __init__(self, ansible_adhoc, hostname, connection=None):
-        if hostname == 'localhost':
-            self.host = ansible_adhoc(connection='local', host_pattern=hostname)[hostname]
-        else:
-            if connection is None:
-                self.host = ansible_adhoc(become=True)[hostname]
+        key = (hostname, connection)
+        if key not in _adhoc_hosts or _adhoc_hosts[key][0] is not ansible_adhoc:
+            if hostname == 'localhost':
+                host = ansible_adhoc(connection='local', host_pattern=hostname)[hostname]
+            elif connection is None:
+                host = ansible_adhoc(become=True)[hostname]
             else:
                 logging.debug("connection {} for {}".format(connection, hostname))
-                self.host = ansible_adhoc(become=True, connection=connection)[hostname]
+                host = ansible_adhoc(become=True, connection=connection)[hostname]
+            _adhoc_hosts[key] = (ansible_adhoc, host)
+        self.host = _adhoc_hosts[key][1]
         self.hostname = hostname
 
     def __getattr__(self, item):
         if self.host.has_module(item):
-            self.module_name = item
-            self.module = getattr(self.host, item)
-
-            return self._run
+            def run(*module_args, **complex_args):
+                caller = inspect.getframeinfo(inspect.currentframe().f_back)[:3]
+                return self._run(item, caller, *module_args, **complex_args)
+            return run
         else:
             raise UnsupportedAnsibleModule("Unsupported module")
 
-    def _run(self, *module_args, **complex_args):
+    def submit(self, module_name, *module_args, **complex_args):
+        """
+        @summary: Run ansible module in the shared module pool.
+
+        @return: AsyncResult of the module, get() returns the module result
+        """
+        if not self.host.has_module(module_name):
+            raise UnsupportedAnsibleModule("Unsupported module")
+        caller = inspect.getframeinfo(inspect.currentframe().f_back)[:3]
+        return get_module_pool().apply_async(self._run, (module_name, caller) + module_args, complex_args)
+
+    def _run(self, module_name, caller, *module_args, **complex_args):
 
-        previous_frame = inspect.currentframe().f_back
-        filename, line_number, function_name, lines, index = inspect.getframeinfo(previous_frame)
+        filename, line_number, function_name = caller
 
         logging.debug("{}::{}#{}: [{}] AnsibleModule::{}, args={}, kwargs={}"\
             .format(filename, function_name, line_number, self.hostname,
-                    self.module_name, json.dumps(module_args), json.dumps(complex_args)))
+                    module_name, json.dumps(module_args), json.dumps(complex_args)))
 
         module_ignore_errors = complex_args.pop('module_ignore_errors', False)
         module_async = complex_args.pop('module_async', False)
 
         if module_async:
-            def run_module(module_args, complex_args):
-                return self.module(*module_args, **complex_args)[self.hostname]
-            pool = ThreadPool()
-            result = pool.apply_async(run_module, (module_args, complex_args))
-            return pool, result
+            pool = ThreadPool(1)
+            result = pool.apply_async(self._call, (module_name, module_args, complex_args))
+            pool.close()
+            return AsyncModuleTask(self.hostname, module_name, pool, result), result
 
-        res = self.module(*module_args, **complex_args)[self.hostname]
+        start = time.time()
+        res = self._exec(module_name, module_args, complex_args)
         logging.debug("{}::{}#{}: [{}] AnsibleModule::{} Result => {}"\
-            .format(filename, function_name, line_number, self.hostname, self.module_name, json.dumps(res)))
+            .format(filename, function_name, line_number, self.hostname, module_name, json.dumps(res)))
+        logging.debug("[{}] AnsibleModule::{} took {:.3f} seconds".format(self.hostname, module_name,
+                                                                         time.time() - start))
 
         if res.is_failed and not module_ignore_errors:
-            raise RunAnsibleModuleFail("run module {} failed".format(self.module_name), res)
+            raise RunAnsibleModuleFail("run module {} failed".format(module_name), res)
 
         return res
 
+    def _exec(self, module_name, module_args, complex_args):
+        with get_host_slots(self.hostname):
+            return self._call(module_name, module_args, complex_args)
+
+    def _call(self, module_name, module_args, complex_args):
+        return getattr(self.host, module_name)(*module_args, **complex_args)[self.hostname]
+
 
 class Localhost(AnsibleHostBase):
     """
@@ -258,11 +369,28 @@ class SonicHost(AnsibleHostBase):
         except:
             return False
 
+    def get_health_snapshot(self, services=None, processes=True, interfaces=True, dbmemory=True, crm=False):
+        """
+        @summary: Collect the health state of the DUT with one run of the health_snapshot module.
+
+        @param services: Names of the services to check, default is the critical services
+        @param processes: Collect the critical process status of the services
+        @param interfaces: Collect the oper status of the admin up interfaces in persistent configuration
+        @param dbmemory: Collect the redis client output buffer memory
+        @param crm: Collect and parse the output of "crm show resources all"
+        @return: dictionary with keys "uptime", "networking_uptime", "services" and the optional
+                 "processes", "interfaces", "down_ports", "dbmemory" and "crm_resources"
+        """
+        services = self.CRITICAL_SERVICES if services is None else services
+        snapshot = self.health_snapshot(services=services, processes=processes, interfaces=interfaces,
+                                        dbmemory=dbmemory, crm=crm)["ansible_facts"]["health_snapshot"]
+        if crm:
+            snapshot["crm_resources"] = self.parse_crm_resources(snapshot.pop("crm"))
+        return snapshot
+
     def critical_services_status(self):
-        result = {}
-        for service in self.CRITICAL_SERVICES:
-            result[service] = self.is_service_fully_started(service)
-        return result
+        snapshot = self.get_health_snapshot(processes=False, interfaces=False, dbmemory=False)
+        return snapshot["services"]
 
     def critical_services_fully_started(self):
         """
@@ -278,55 +406,28 @@ class SonicHost(AnsibleHostBase):
 
         @param service: Name of the SONiC service
         """
-        result = {'status': True}
-        result['exited_critical_process'] = []
-        result['running_critical_process'] = []
-        critical_process_list = []
-
-        # return false if the service is not started
-        service_status = self.is_service_fully_started(service)
-        if service_status == False:
-            result['status'] = False
-            return result
-
-        # get critical process list for the service
-        output = self.command("docker exec {} bash -c '[ -f /etc/supervisor/critical_processes ] && cat /etc/supervisor/critical_processes'".format(service), module_ignore_errors=True)
-        for l in output['stdout'].split():
-            critical_process_list.append(l.rstrip())
-        if len(critical_process_list) == 0:
-            return result
-
-        # get process status for the service
-        output = self.command("docker exec {} supervisorctl status".format(service))
-        logging.info("====== supervisor process status for service {} ======".format(service))
-
-        for l in output['stdout_lines']:
-            (pname, status, info) = re.split("\s+", l, 2)
-            if status != "RUNNING":
-                if pname in critical_process_list:
-                    result['exited_critical_process'].append(pname)
-                    result['status'] = False
-            else:
-                if pname in critical_process_list:
-                    result['running_critical_process'].append(pname)
-
-        return result
+        snapshot = self.get_health_snapshot(services=[service], interfaces=False, dbmemory=False)
+        return snapshot["processes"][service]
 
     def all_critical_process_status(self):
         """
         @summary: Check whether all critical processes status for all critical services
         """
-        result = {}
-        for service in self.CRITICAL_SERVICES:
-            result[service] = self.critical_process_status(service)
-        return result
+        snapshot = self.get_health_snapshot(interfaces=False, dbmemory=False)
+        return snapshot["processes"]
 
     def get_crm_resources(self):
         """
         @summary: Run the "crm show resources all" command and parse its output
         """
+        return self.parse_crm_resources(self.command("crm show resources all")["stdout_lines"])
+
+    @staticmethod
+    def parse_crm_resources(output):
+        """
+        @summary: Parse the output lines of the "crm show resources all" command
+        """
         result = {"main_resources": {}, "acl_resources": [], "table_resources": []}
-        output = self.command("crm show resources all")["stdout_lines"]
         current_table = 0   # Totally 3 tables in the command output
         for line in output:
             if len(line.strip()) == 0:
@@ -1,94 +1,154 @@
 import argparse
-import time
+import json
 import os
+import sys
+import time
+
 
-from  datetime import datetime
+MEASURE_INTERVAL = 1
+TOP_CONSUMERS = 10
+HDD_PATH = "/"
+CMDLINE_LEN = 256
 
 
-FETCH_CPU_CMD = "ps -eo pcpu,args | sort -k 1 -r | tail -n +2"
-FETCH_HDD_CMD = "df -hm /"
-MEASURE_DELAY = 2
+def read_cpu_times():
+    """
+    @summary: Read the aggregated CPU times from '/proc/stat'.
+    @return: Tuple of (busy, total) jiffies of all CPUs.
+    """
+    with open("/proc/stat") as stream:
+        fields = [int(value) for value in stream.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return total - idle, total
 
 
-def process_cpu(log_file):
+def read_process_times():
     """
-    @summary: Fetch CPU utilization. Write to the file total and top 10 process CPU utilization.
-    @param log_file: Opened file object to store fetched CPU utilization.
+    @summary: Read the CPU times of all processes from '/proc/<pid>/stat'.
+    @return: Dictionary of {(pid, start time): (utime + stime, comm)}.
     """
-    buff = []
-    general_template = """
-"{timestamp}":
-    total: {total}
-    top_consumer:
-"""
-    per_process_template = "        {cpu_utilization}: \"{process}\""
-    top_consumer_list = []
-    total = 0
-    top_consumer_counter = 10
-
-    for line in os.popen(FETCH_CPU_CMD).readlines():
-        process_consumed = float(line.split()[0])
-        total += process_consumed
-        if top_consumer_counter:
-            top_consumer_list.append(per_process_template.format(cpu_utilization=process_consumed,
-                                     process=" ".join(line.split()[1:])))
-            top_consumer_counter -= 1
-
-    result = general_template.format(timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), total=total) \
-                + "\n".join(top_consumer_list)
-    log_file.write(result)
-
-
-def process_ram(log_file):
+    result = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pid)) as stream:
+                data = stream.read()
+        except (IOError, OSError):
+            continue
+        # 'comm' may contain spaces and parentheses, the other fields follow the last ')'
+        comm = data[data.find("(") + 1:data.rfind(")")]
+        fields = data[data.rfind(")") + 2:].split()
+        result[(int(pid), fields[19])] = (int(fields[11]) + int(fields[12]), comm)
+    return result
+
+
+def read_cmdline(pid, default):
+    try:
+        with open("/proc/{}/cmdline".format(pid)) as stream:
+            cmdline = stream.read().replace("\0", " ").strip()
+    except (IOError, OSError):
+        cmdline = ""
+    return cmdline[:CMDLINE_LEN] or "[{}]".format(default)
+
+
+def read_ram():
     """
-    @summary: Fetch RAM utilization and write it to the file.
+    @summary: Fetch RAM utilization.
               Use 'MemTotal' and 'MemAvailable' from '/proc/meminfo' to obtain used RAM amount.
-    @param log_file: Opened file object to store fetched RAM utilization.
+    @return: Used RAM in percent.
     """
-    with open('/proc/meminfo') as stream:
+    meminfo = {}
+    with open("/proc/meminfo") as stream:
         for line in stream:
-            if 'MemAvailable' in line:
-                available_mem_in_kb = int(line.split()[1])
-            if 'MemTotal' in line:
-                total_mem_in_kb = int(line.split()[1])
+            name, value = line.split(":", 1)
+            if name in ("MemTotal", "MemAvailable"):
+                meminfo[name] = int(value.split()[0])
+                if len(meminfo) == 2:
+                    break
+    used = meminfo["MemTotal"] - meminfo["MemAvailable"]
+    return used * 100.0 / meminfo["MemTotal"]
 
-    used = total_mem_in_kb - available_mem_in_kb
-    used_percent = used * 100 / total_mem_in_kb
-    log_file.write("\"{date}\": {used_ram}\n".format(date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                   used_ram=used_percent))
 
-
-def process_hdd(log_file):
+def read_hdd(path=HDD_PATH):
     """
-    @summary: Fetch used amount of HDD and write it to the file. Execute command defined in FETCH_HDD_CMD.
-    @param log_file: Opened file object to store fetched HDD utilization.
+    @summary: Fetch used amount of HDD the same way as 'df' does.
+    @return: Used HDD in percent.
     """
-    output_line_id = 1
-    use_value_id = 4
-    hdd_usage = os.popen(FETCH_HDD_CMD).read().split("\n")[output_line_id].split()[use_value_id].rstrip("%")
-    log_file.write("\"{date}\": {used_ram}\n".format(date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                   used_ram=hdd_usage))
-
+    stat = os.statvfs(path)
+    used = stat.f_blocks - stat.f_bfree
+    return int(round(used * 100.0 / (used + stat.f_bavail))) if used + stat.f_bavail else 0
 
-def main():
-    cpu_log = open("/tmp/cpu.log", "w")
-    ram_log = open("/tmp/ram.log", "w")
-    hdd_log = open("/tmp/hdd.log", "w")
 
-    print "Started resources monitoring ..."
+class Sampler(object):
+    """
+    Samples CPU, RAM and HDD utilization of the DUT. CPU utilization is computed from the delta
+    of the CPU times between two samples, so it is the utilization during the last interval.
+    """
+    def __init__(self, top=TOP_CONSUMERS):
+        self.top = top
+        self.ticks = float(os.sysconf(os.sysconf_names["SC_CLK_TCK"]))
+        self.cmdlines = {}
+        self.last_time = time.time()
+        self.last_cpu = read_cpu_times()
+        self.last_procs = read_process_times()
+
+    def sample(self):
+        now = time.time()
+        cpu = read_cpu_times()
+        procs = read_process_times()
+
+        busy, total = cpu[0] - self.last_cpu[0], cpu[1] - self.last_cpu[1]
+        elapsed = (now - self.last_time) * self.ticks
+        consumers = []
+        for key, (times, comm) in procs.items():
+            delta = times - self.last_procs.get(key, (times, comm))[0]
+            if delta > 0:
+                consumers.append((delta, key, comm))
+        consumers.sort(reverse=True)
+
+        top_consumer = []
+        for delta, key, comm in consumers[:self.top]:
+            if key not in self.cmdlines:
+                self.cmdlines[key] = read_cmdline(key[0], comm)
+            # Per process utilization is relative to one CPU, the same as 'ps' and 'top' report it
+            top_consumer.append([round(delta * 100.0 / elapsed, 1) if elapsed else 0.0, self.cmdlines[key]])
+        for key in list(self.cmdlines):
+            if key not in procs:
+                del self.cmdlines[key]
+
+        sample = {"timestamp": now,
+                  "cpu": round(busy * 100.0 / total, 1) if total else 0.0,
+                  "top_consumer": top_consumer,
+                  "ram": round(read_ram(), 1),
+                  "hdd": read_hdd()}
+        self.last_time, self.last_cpu, self.last_procs = now, cpu, procs
+        return sample
+
+
+def main(interval, top):
+    sampler = Sampler(top=top)
+    sys.stdout.write("Started resources monitoring ...\n")
+    sys.stdout.flush()
     while True:
-        process_cpu(cpu_log)
-        process_ram(ram_log)
-        process_hdd(hdd_log)
-        time.sleep(MEASURE_DELAY)
-        cpu_log.flush()
-        ram_log.flush()
-        hdd_log.flush()
+        time.sleep(max(interval - (time.time() - sampler.last_time), 0))
+        sample = sampler.sample()
+        # One sample per line, streamed back to the test over the SSH channel
+        sys.stdout.write(json.dumps(sample, separators=(",", ":")) + "\n")
+        sys.stdout.flush()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--start", help="device file", action="store_true", default=False)
+    parser.add_argument("--interval", help="sampling interval in seconds", type=float, default=MEASURE_INTERVAL)
+    parser.add_argument("--top", help="number of top CPU consumers to report", type=int, default=TOP_CONSUMERS)
     args = parser.parse_args()
 
     if args.start:
-        main()
+        try:
+            main(args.interval, args.top)
+        except (IOError, KeyboardInterrupt):
+            # SSH channel is closed
+            pass
@@ -4,18 +4,20 @@ import threading
 import logging
 import time
 import os
+import json
+import socket
 import yaml
 
-from collections import OrderedDict
+from collections import deque
 from  datetime import datetime
 from errors import HDDThresholdExceeded, RAMThresholdExceeded, CPUThresholdExceeded
 
 
 logger = logging.getLogger(__name__)
 DUT_MONITOR = "/tmp/dut_monitor.py"
-DUT_CPU_LOG = "/tmp/cpu.log"
-DUT_RAM_LOG = "/tmp/ram.log"
-DUT_HDD_LOG = "/tmp/hdd.log"
+MEASURE_INTERVAL = 1
+# Number of the last measurements kept by the client
+RING_SIZE = 300
 
 
 class DUTMonitorPlugin(object):
@@ -41,9 +43,6 @@ class DUTMonitorPlugin(object):
         For each test item starts monitoring of hardware resources consumption on the DUT
         """
         dut_thresholds = {}
-        monitor_exceptions = []
-        # Start monitoring on DUT
-        dut_ssh.start()
 
         # Read file with defined thresholds
         with open(self.thresholds) as stream:
@@ -57,173 +56,161 @@ class DUTMonitorPlugin(object):
             if dut_hwsku in general_thresholds[dut_platform]["hwsku"]:
                 dut_thresholds.update(general_thresholds[dut_platform]["hwsku"][dut_hwsku])
 
+        # Start monitoring on DUT, measurements are verified while they are streamed from the DUT
+        dut_ssh.start(dut_thresholds)
+
         yield dut_thresholds
 
         # Stop monitoring on DUT
         dut_ssh.stop()
-        # Download log files with CPU, RAM and HDD measurements data
-        measurements = dut_ssh.get_log_files()
         # Verify hardware resources consumption does not exceed defined threshold
-        if measurements["hdd"]:
-            try:
-                self.assert_hhd(hdd_meas=measurements["hdd"], thresholds=dut_thresholds)
-            except HDDThresholdExceeded as err:
-                monitor_exceptions.append(err)
-
-        if measurements["ram"]:
-            try:
-                self.assert_ram(ram_meas=measurements["ram"], thresholds=dut_thresholds)
-            except RAMThresholdExceeded as err:
-                monitor_exceptions.append(err)
-
-        if measurements["cpu"]:
-            try:
-                self.assert_cpu(cpu_meas=measurements["cpu"], thresholds=dut_thresholds)
-            except CPUThresholdExceeded as err:
-                monitor_exceptions.append(err)
-
+        monitor_exceptions = dut_ssh.checker.finalize()
         if monitor_exceptions:
             raise Exception("\n".join(item.message for item in monitor_exceptions))
 
-    def assert_hhd(self, hdd_meas, thresholds):
-        """
-        Verify that free disk space on the DUT is not overutilized
-        """
-        overused = []
-        fail_msg = "Used HDD threshold - {}\nHDD overuse:\n".format(thresholds["hdd_used"])
-
-        for timestamp, used_hdd in hdd_meas.items():
-            if used_hdd > thresholds["hdd_used"]:
-                overused.append((timestamp, used_hdd))
 
-        if overused:
-            raise HDDThresholdExceeded(fail_msg + "\n".join(str(item) for item in overused))
+class ThresholdChecker(object):
+    """
+    Verify the measurements against the thresholds as soon as they are received from the DUT.
+    Only the state needed to evaluate the thresholds is kept, not the measurements themselves.
+    """
+    t_format = "%Y-%m-%d %H:%M:%S"
 
-    def assert_ram(self, ram_meas, thresholds):
+    def __init__(self, thresholds):
+        self.thresholds = thresholds
+        self.violations = []
+        self.count = 0
+        self.hdd_overused = []
+        self.ram_overused = []
+        self.ram_first = []
+        self.ram_last = deque(maxlen=2)
+        self.cpu_sum = 0
+        self.cpu_fail_msg = ""
+        self.total_overused = []
+        # {process name: [first timestamp, last timestamp, CPU utilization sum, measurements, last sample id]}
+        self.process_overused = {}
+
+    def _violation(self, msg):
+        if msg not in self.violations:
+            logger.error("DUT monitor: {}".format(msg))
+            self.violations.append(msg)
+
+    def add(self, sample):
+        """
+        @summary: Evaluate one sample streamed from the DUT.
+        """
+        thresholds = self.thresholds
+        timestamp = datetime.fromtimestamp(sample["timestamp"])
+        t_stamp = timestamp.strftime(self.t_format)
+        self.count += 1
+
+        if sample["hdd"] > thresholds["hdd_used"]:
+            self.hdd_overused.append((t_stamp, sample["hdd"]))
+            self._violation("Used HDD threshold - {} exceeded".format(thresholds["hdd_used"]))
+
+        if sample["ram"] > thresholds["ram_peak"]:
+            self.ram_overused.append((t_stamp, sample["ram"]))
+            self._violation("RAM peak threshold - {} exceeded".format(thresholds["ram_peak"]))
+        if len(self.ram_first) < 2:
+            self.ram_first.append(sample["ram"])
+        self.ram_last.append(sample["ram"])
+
+        # Total CPU utilization, fail if it exceeds threshold during 'cpu_measure_duration' interval
+        self.cpu_sum += sample["cpu"]
+        if sample["cpu"] > thresholds["cpu_total"]:
+            self.total_overused.append((timestamp, sample["cpu"]))
+            if self._duration(self.total_overused[0][0], timestamp) >= thresholds["cpu_measure_duration"]:
+                self._violation("Total CPU threshold - {} exceeded".format(thresholds["cpu_total"]))
+        elif self.total_overused:
+            self._close_total()
+
+        # CPU utilization per process, fail if it exceeds threshold during 'cpu_measure_duration' interval
+        for process_consumption, process_name in sample["top_consumer"]:
+            if process_consumption < thresholds["cpu_process"]:
+                continue
+            run = self.process_overused.get(process_name)
+            if run and run[4] != self.count - 1:
+                self._close_process(process_name)
+                run = None
+            if not run:
+                run = self.process_overused[process_name] = [timestamp, timestamp, 0, 0, 0]
+            run[1] = timestamp
+            run[2] += process_consumption
+            run[3] += 1
+            run[4] = self.count
+            if self._duration(run[0], run[1]) >= thresholds["cpu_measure_duration"]:
+                self._violation("Process '{}' CPU threshold - {} exceeded".format(process_name,
+                                                                                thresholds["cpu_process"]))
+        for process_name in [name for name, run in self.process_overused.items() if run[4] != self.count]:
+            self._close_process(process_name)
+
+    def _duration(self, first, last):
+        return (last - first).total_seconds()
+
+    def _close_total(self):
+        """Compose fail message if CPU utilization exceeds threshold during 'duration' interval."""
+        duration = self._duration(self.total_overused[0][0], self.total_overused[-1][0])
+        if duration >= self.thresholds["cpu_measure_duration"]:
+            self.cpu_fail_msg += "Total CPU overuse during {} seconds.\n{}\n\n".format(duration,
+                "\n".join([str((t.strftime(self.t_format), value)) for t, value in self.total_overused]))
+        self.total_overused = []
+
+    def _close_process(self, process_name):
+        """Compose fail message if process overuse CPU during 'cpu_measure_duration' interval."""
+        t_first, t_last, p_sum, p_count, _ = self.process_overused.pop(process_name)
+        duration = self._duration(t_first, t_last)
+        if duration >= self.thresholds["cpu_measure_duration"]:
+            self.cpu_fail_msg += "> Process '{}'\nAverage CPU overuse {} during {} seconds\n{} - {}\n".format(
+                process_name, p_sum / p_count, duration, t_first.strftime(self.t_format),
+                t_last.strftime(self.t_format))
+
+    def finalize(self):
         """
-        Verify that RAM resources on the DUT are not overutilized
+        @summary: Evaluate the thresholds which depend on all the measurements.
+        @return: List of HDDThresholdExceeded, RAMThresholdExceeded and CPUThresholdExceeded errors.
         """
+        thresholds = self.thresholds
+        errors = []
+        if not self.count:
+            return errors
+
+        if self.hdd_overused:
+            fail_msg = "Used HDD threshold - {}\nHDD overuse:\n".format(thresholds["hdd_used"])
+            errors.append(HDDThresholdExceeded(fail_msg + "\n".join(str(item) for item in self.hdd_overused)))
+
         failed = False
-        peak_overused = []
         fail_msg = "\nRAM thresholds: peak - {}; before/after test difference - {}%\n".format(thresholds["ram_peak"],
                                                                                             thresholds["ram_delta"])
-
-        for timestamp, used_ram in ram_meas.items():
-            if used_ram > thresholds["ram_peak"]:
-                peak_overused.append((timestamp, used_ram))
-        if peak_overused:
-            fail_msg = fail_msg + "RAM overuse:\n{}\n".format("\n".join(str(item) for item in peak_overused))
+        if self.ram_overused:
+            fail_msg = fail_msg + "RAM overuse:\n{}\n".format("\n".join(str(item) for item in self.ram_overused))
             failed = True
-
         # Take first and last RAM measurements
-        if len(ram_meas) >= 4:
-            before = sum(ram_meas.values()[0:2]) / 2
-            after = sum(ram_meas.values()[2:4]) / 2
+        if self.count >= 4:
+            before = sum(self.ram_first) / 2
+            after = sum(self.ram_last) / 2
         else:
-            before = ram_meas.values()[0]
-            after = ram_meas.values()[-1]
-
+            before = self.ram_first[0]
+            after = self.ram_last[-1]
         delta = thresholds["ram_delta"] / 100. * before
         if after >= before + delta:
             fail_msg = fail_msg + "RAM was not restored\nRAM before test {}; RAM after test {}\n".format(before, after)
             failed = True
-
         if failed:
-            raise RAMThresholdExceeded(fail_msg)
+            errors.append(RAMThresholdExceeded(fail_msg))
 
-    def assert_cpu(self, cpu_meas, thresholds):
-        """
-        Verify that CPU resources on the DUT are not overutilized
-        """
-        failed = False
-        total_overused = []
-        process_overused = {}
-        cpu_thresholds = "CPU thresholds: total - {}; per process - {}; average - {}\n".format(thresholds["cpu_total"],
-                                                            thresholds["cpu_process"],
-                                                            thresholds["cpu_total_average"])
-        average_cpu = "\n> Average CPU consumption during test run {}; Threshold - {}\n"
-        fail_msg = ""
-        total_sum = 0
-        t_format = "%Y-%m-%d %H:%M:%S"
-
-        def handle_process_measurements(p_name, t_first, t_last, p_average):
-            """Compose fail message if process overuse CPU durig 'cpu_measure_duration' interval."""
-            msg_template = "> Process '{}'\nAverage CPU overuse {} during {} seconds\n{}"
-            duration = (t_last - t_first).total_seconds()
-
-            if duration >= thresholds["cpu_measure_duration"]:
-                return msg_template.format(process_name,
-                                           p_average,
-                                           duration,
-                                           "{} - {}\n".format(t_first.strftime(t_format),
-                                                              t_last.strftime(t_format)))
-            return ""
-
-        def handle_total_measurements(overused_list):
-            """Compose fail message if CPU utilization exceeds threshold during 'duration' interval."""
-            fail_msg = ""
-            start = datetime.strptime(overused_list[0][0], t_format)
-            end = datetime.strptime(overused_list[-1][0], t_format)
-
-            if (end - start).total_seconds() >= thresholds["cpu_measure_duration"]:
-                fail_msg = "Total CPU overuse during {} seconds.\n{}\n\n".format((end - start).total_seconds(),
-                "\n".join([str(item) for item in overused_list])
-                )
-            del overused_list[0:]
-            return fail_msg
-
-        # Calculate total CPU utilization
-        for m_id, timestamp in enumerate(cpu_meas):
-            # Collect total CPU utilization to calculate total average
-            total_sum += cpu_meas[timestamp]["total"]
-            if cpu_meas[timestamp]["total"] > thresholds["cpu_total"]:
-                total_overused.append((timestamp, cpu_meas[timestamp]["total"]))
-                if m_id == (len(cpu_meas) - 1):
-                    fail_msg += handle_total_measurements(total_overused)
-                    total_overused = []
-            elif total_overused:
-                fail_msg += handle_total_measurements(total_overused)
-                total_overused = []
-
-            for process_consumption, process_name in cpu_meas[timestamp]["top_consumer"].items():
-                if process_consumption >= thresholds["cpu_process"]:
-                    if process_name not in process_overused:
-                        process_overused[process_name] = []
-                    # Collect list of CPU utilization for specific process if CPU utilization exceeds threshold
-                    process_overused[process_name].append((timestamp, process_consumption))
-
-        # Handle measurements per process
-        if process_overused:
-            for process_name, process_consumption in process_overused.items():
-                timestamps = []
-                process_sum = 0
-                for m_id, m_value in enumerate(process_consumption):
-                    t_stamp = datetime.strptime(m_value[0], t_format)
-                    process_sum += m_value[1]
-                    if not timestamps:
-                        timestamps.append(t_stamp)
-                        continue
-                    if (2 <= (t_stamp - timestamps[-1]).total_seconds() <= 3):
-                            timestamps.append(t_stamp)
-                            if m_id == (len(process_consumption) - 1):
-                                fail_msg += handle_process_measurements(p_name=process_name,
-                                                                        t_first=timestamps[0],
-                                                                        t_last=timestamps[-1],
-                                                                        p_average=process_sum / len(timestamps))
-                    else:
-                        fail_msg += handle_process_measurements(p_name=process_name,
-                                                                t_first=timestamps[0],
-                                                                t_last=timestamps[-1],
-                                                                p_average=process_sum / len(timestamps))
-                        timestamps = []
-                        process_sum = 0
-
-        # Calculate average CPU utilization
-        if (total_sum / len(cpu_meas)) > thresholds["cpu_total_average"]:
-            fail_msg += average_cpu.format(total_sum / len(cpu_meas), thresholds["cpu_total_average"])
-
-        if fail_msg:
-            raise CPUThresholdExceeded(cpu_thresholds + fail_msg)
+        if self.total_overused:
+            self._close_total()
+        for process_name in list(self.process_overused):
+            self._close_process(process_name)
+        if (self.cpu_sum / self.count) > thresholds["cpu_total_average"]:
+            self.cpu_fail_msg += "\n> Average CPU consumption during test run {}; Threshold - {}\n".format(
+                self.cpu_sum / self.count, thresholds["cpu_total_average"])
+        if self.cpu_fail_msg:
+            cpu_thresholds = "CPU thresholds: total - {}; per process - {}; average - {}\n".format(
+                thresholds["cpu_total"], thresholds["cpu_process"], thresholds["cpu_total_average"])
+            errors.append(CPUThresholdExceeded(cpu_thresholds + self.cpu_fail_msg))
+
+        return errors
 
 
 class DUTMonitorClient(object):
@@ -261,7 +248,7 @@ class DUTMonitorClient(object):
                     logger.debug(repr(err))
                 else:
                     if self.running:
-                        self.start()
+                        self._start_monitor()
             else:
                 time.sleep(5)
 
@@ -301,12 +288,18 @@ class DUTMonitorClient(object):
             logger.warning("Skip command {}".format(cmd))
             return (None, None, None)
 
-    def start(self):
+    def start(self, thresholds):
         """
         @summary: Start HW resources monitoring on the DUT.
-                  Write obtained values to the following files on the DUT: DUT_CPU_LOG, DUT_RAM_LOG, DUT_HDD_LOG
+                  Measurements are streamed back over the SSH channel and verified against the thresholds
+                  as soon as they are received.
         """
         self.running = True
+        self.samples = deque(maxlen=RING_SIZE)
+        self.checker = ThresholdChecker(thresholds)
+        self._start_monitor()
+
+    def _start_monitor(self):
         self._upload_to_dut()
         logger.debug("Start HW resources monitoring on the DUT...")
 
@@ -314,47 +307,60 @@ class DUTMonitorClient(object):
         self.run_channel.get_pty()
         self.run_channel.settimeout(5)
         # Start monitoring on DUT
-        self.run_channel.exec_command("python {} --start".format(DUT_MONITOR))
+        self.run_channel.exec_command("python {} --start --interval {}".format(DUT_MONITOR, MEASURE_INTERVAL))
         # Ensure monitoring started
         output = self.run_channel.recv(1024)
         if not "Started resources monitoring ..." in output:
             raise Exception("Failed to start monitoring on DUT: {}".format(output))
 
+        self._reader = threading.Thread(name="DUT monitor reader", target=self._read_samples,
+                                        args=(self.run_channel, output.split("Started resources monitoring ...", 1)[1]))
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def _read_samples(self, channel, buff):
+        """
+        @summary: Receive the measurements streamed by the DUT, one JSON object per line.
+        """
+        while True:
+            lines = buff.split("\n")
+            buff = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if not line.startswith("{"):
+                    continue
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    logger.debug("Skip malformed measurement: {}".format(line))
+                    continue
+                self.samples.append(sample)
+                self.checker.add(sample)
+            try:
+                data = channel.recv(4096)
+            except socket.timeout:
+                continue
+            except Exception as err:
+                logger.debug("Stop reading measurements: {}".format(repr(err)))
+                break
+            if not data:
+                break
+            buff += data
+
+    def check(self):
+        """
+        @summary: Fail the test as soon as any threshold is exceeded, the thresholds are verified while the
+                  measurements are streamed from the DUT. Can be called by the tests doing long operations.
+        """
+        if self.checker.violations:
+            raise Exception("\n".join(self.checker.violations))
+
     def stop(self):
         """
-        @summary: Close this SSHClient and its underlying Transport
+        @summary: Stop HW resources monitoring on the DUT
         """
         self.running = False
         logger.debug("Stop resources monitoring on the DUT...")
         if not self.run_channel.closed:
             self.run_channel.close()
-
-    def read_yml(self, file_pointer):
-        """
-        @summary: Read yaml file content. Convert it to the ordered data.
-        @return: OrderedDict with sorted keys by timestamp, or empty dict for empty file.
-        """
-        with file_pointer as fp:
-            measurements = yaml.safe_load("".join(fp))
-        if measurements is None:
-            return {}
-        # Sort json data to process logs chronologically
-        keys = measurements.keys()
-        keys.sort()
-        key_value_pairs = [(item, measurements[item]) for item in keys]
-        return OrderedDict(key_value_pairs)
-
-    def get_log_files(self):
-        """
-        @summary: Fetch monitoring logs from device, parse, convert to dictionary with sorted order.
-        @return: Dictionary with keys "cpu", "ram", "hdd", values contains appropriate measurements made on DUT.
-        """
-        logger.debug("Downloading file from the DUT...")
-        cpu_log_fp = self.ssh.open_sftp().file(DUT_CPU_LOG)
-        ram_log_fp = self.ssh.open_sftp().file(DUT_RAM_LOG)
-        hdd_log_fp = self.ssh.open_sftp().file(DUT_HDD_LOG)
-
-        cpu_meas = self.read_yml(cpu_log_fp)
-        ram_meas = self.read_yml(ram_log_fp)
-        hdd_meas = self.read_yml(hdd_log_fp)
-        return {"cpu": cpu_meas, "ram": ram_meas, "hdd": hdd_meas}
+        self._reader.join(10)
@@ -5,22 +5,156 @@ import requests
 import pytest
 import logging
 import ipaddr as ipaddress
+from multiprocessing.pool import ThreadPool
+from common.devices import run_modules
 logger = logging.getLogger(__name__)
 
+# Number of commands posted to exabgp in one HTTP request
+ANNOUNCE_CHUNK_SIZE = 1000
+ANNOUNCE_TIMEOUT = 60
 
-def announce_routes(ptfip, port, routes):
-    messages = []
+# Number of exabgp instances set up on the PTF at the same time, below the sshd MaxSessions of 10
+EXABGP_START_PARALLEL = 4
+
+# Time to wait for the DUT to install the announced routes
+CONVERGENCE_TIMEOUT = 300
+CONVERGENCE_INTERVAL = 2
+
+# The tor subnets are allocated from 192.168.0.0 upwards
+SUBNET_BASE_V4 = (192 << 24) + (168 << 16)
+
+# Decimal and hexadecimal strings of the octets, used to format the prefixes in bulk
+DEC_OCTETS = [str(octet) for octet in range(256)]
+HEX_OCTETS = ["%02X" % octet for octet in range(256)]
+
+# Count the routes installed by BGP in the kernel of the DUT, zebra installs them with protocol
+# 186 (FRR) or zebra (Quagga). Lines starting with a blank are the nexthops of ECMP routes.
+BGP_ROUTE_COUNT_CMD = "for family in -4 -6; do " \
+                      "(ip $family route show proto 186; ip $family route show proto zebra) | " \
+                      "awk '!/^[ \\t]/ {n++} END {print n+0}'; done"
+
+
+def route_commands(routes):
     for prefix, nexthop, aspath in routes:
         if aspath:
-            messages.append("announce route {} next-hop {} as-path [ {} ]".format(prefix, nexthop, aspath))
+            yield "announce route {} next-hop {} as-path [ {} ]".format(prefix, nexthop, aspath)
         else:
-            messages.append("announce route {} next-hop {}".format(prefix, nexthop))
+            yield "announce route {} next-hop {}".format(prefix, nexthop)
+
+
+def post_commands(session, url, commands):
+    r = session.post(url, data={"commands": ";".join(commands)}, timeout=ANNOUNCE_TIMEOUT)
+    assert r.status_code == 200, "Failed to post {} commands to {}, status {}".format(len(commands), url, r.status_code)
+
 
+def announce_routes(ptfip, port, routes, chunk_size=ANNOUNCE_CHUNK_SIZE, session=None):
+    """
+    @summary: Announce the routes through the HTTP API of the exabgp instance listening on the port.
+              The commands are posted in chunks of chunk_size over one persistent HTTP connection.
+    @param session: requests.Session to reuse, a new one is used if None
+    """
     url = "http://%s:%d" % (ptfip, port)
-    data = { "commands": ";".join(messages) }
-    r = requests.post(url, data=data)
-    print r
-    assert r.status_code == 200
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    try:
+        chunk = []
+        for command in route_commands(routes):
+            chunk.append(command)
+            if len(chunk) >= chunk_size:
+                post_commands(session, url, chunk)
+                chunk = []
+        if chunk:
+            post_commands(session, url, chunk)
+    finally:
+        if own_session:
+            session.close()
+
+
+def announce_routes_parallel(ptfip, announcements, chunk_size=ANNOUNCE_CHUNK_SIZE):
+    """
+    @summary: Announce the routes to all exabgp instances concurrently, one thread and one
+              persistent HTTP connection for each instance.
+    @param announcements: List of (port, routes), the routes for the same port are announced in order.
+    """
+    routes_by_port = {}
+    for port, routes in announcements:
+        routes_by_port.setdefault(port, []).append(routes)
+
+    def announce(item):
+        port, route_lists = item
+        session = requests.Session()
+        try:
+            for routes in route_lists:
+                announce_routes(ptfip, port, routes, chunk_size=chunk_size, session=session)
+        finally:
+            session.close()
+
+    start = time.time()
+    pool = ThreadPool(max(len(routes_by_port), 1))
+    try:
+        pool.map(announce, routes_by_port.items())
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("Announced {} routes to {} exabgp instances in {:.1f} seconds".format(
+                sum([len(routes) for _, routes in announcements]), len(routes_by_port), time.time() - start))
+
+
+def get_bgp_route_count(duthost):
+    """
+    @summary: Get the number of IPv4 and IPv6 routes installed by BGP in the kernel of the DUT
+    """
+    counts = duthost.shell(BGP_ROUTE_COUNT_CMD)["stdout_lines"]
+    return int(counts[0]), int(counts[1])
+
+
+def wait_for_convergence(duthost, routes_v4, routes_v6, start, timeout=CONVERGENCE_TIMEOUT):
+    """
+    @summary: Wait until the DUT has installed at least as many BGP routes as distinct prefixes were
+              announced and report the time since the start of the announcement.
+    @return: Time to convergence in seconds, None if the DUT did not converge within the timeout.
+    """
+    expected_v4 = len(set([prefix for prefix, _, _ in routes_v4]))
+    expected_v6 = len(set([prefix for prefix, _, _ in routes_v6]))
+    while True:
+        count_v4, count_v6 = get_bgp_route_count(duthost)
+        elapsed = time.time() - start
+        if count_v4 >= expected_v4 and count_v6 >= expected_v6:
+            logger.info("DUT converged to {} IPv4 and {} IPv6 BGP routes in {:.1f} seconds".format(
+                        count_v4, count_v6, elapsed))
+            return elapsed
+        if elapsed > timeout:
+            logger.warning("DUT did not converge in {} seconds, {}/{} IPv4 and {}/{} IPv6 BGP routes installed".format(
+                           timeout, count_v4, expected_v4, count_v6, expected_v6))
+            return None
+        time.sleep(CONVERGENCE_INTERVAL)
+
+
+def subnet_prefixes(family, offsets, prefixlen_v4):
+    """
+    @summary: Build the prefixes of the tor subnets at the address offsets from 192.168.0.0 in bulk.
+              The IPv6 prefix is made of the octets of the IPv4 address. The strings of the first
+              two octets are built once for each /16, the other two octets are looked up.
+    @return: Tuple of (IPv4 prefixes, IPv6 prefixes), the prefixes of the family not asked for are None
+    """
+    prefixes_v4 = [] if family in ["v4", "both"] else None
+    prefixes_v6 = [] if family in ["v6", "both"] else None
+    tail_v4 = "/{}".format(prefixlen_v4)
+    heads = {}
+    for offset in offsets:
+        address = SUBNET_BASE_V4 + offset
+        high = address >> 16
+        if high not in heads:
+            octet1, octet2 = high >> 8, high & 0xff
+            heads[high] = ("{}.{}.".format(octet1, octet2), "20%02X:%02X" % (octet1, octet2))
+        head_v4, head_v6 = heads[high]
+        octet3, octet4 = (address >> 8) & 0xff, address & 0xff
+        if prefixes_v4 is not None:
+            prefixes_v4.append(head_v4 + DEC_OCTETS[octet3] + "." + DEC_OCTETS[octet4] + tail_v4)
+        if prefixes_v6 is not None:
+            prefixes_v6.append(head_v6 + HEX_OCTETS[octet3] + ":0:" + HEX_OCTETS[octet4] + "::/64")
+    return prefixes_v4, prefixes_v6
 
 
 def generate_routes(family, podset_number, tor_number, tor_subnet_number,
@@ -44,56 +178,87 @@ def generate_routes(family, podset_number, tor_number, tor_subnet_number,
     # NOTE: Using large enough values (e.g., podset_number = 200,
     # us to overflow the 192.168.0.0/16 private address space here.
     # This should be fine for internal use, but may pose an issue if used otherwise
+    offsets = []
+    aspaths = []
     for podset in range(0, podset_number):
+        if router_type == "spine" and podset == 0:
+            # Skip podset 0 for T2
+            continue
+        if router_type == "tor" and podset != 0:
+            # Skip non podset 0 for T0
+            continue
         for tor in range(0, tor_number):
-            for subnet in range(0, tor_subnet_number):
-                if router_type == "spine":
-                    # Skip podset 0 for T2
-                    if podset == 0:
-                        continue
-                elif router_type == "leaf":
-                    # Skip tor 0 podset 0 for T1
-                    if podset == 0 and tor == 0:
-                        continue
-                elif router_type == "tor":
-                    # Skip non podset 0 for T0
-                    if podset != 0:
-                        continue
-
-                suffix = ( (podset * tor_number * max_tor_subnet_number * tor_subnet_size) + \
-                      (tor * max_tor_subnet_number * tor_subnet_size) + \
-                      (subnet * tor_subnet_size) )
-                octet2 = (168 + (suffix / (256 ** 2)))
-                octet1 = (192 + (octet2 / 256))
-                octet2 = (octet2 % 256)
-                octet3 = ((suffix / 256) % 256)
-                octet4 = (suffix % 256)
-                prefixlen_v4 = (32 - int(math.log(tor_subnet_size, 2)))
-
-                prefix = "{}.{}.{}.{}/{}".format(octet1, octet2, octet3, octet4, prefixlen_v4)
-                prefix_v6 = "20%02X:%02X%02X:0:%02X::/64" % (octet1, octet2, octet3, octet4)
-
-                leaf_asn = leaf_asn_start + podset
-                tor_asn  = tor_asn_start + tor
-
-                aspath = None
-                if router_type == "spine":
-                    aspath = "{} {}".format(leaf_asn, tor_asn)
-                elif router_type == "leaf":
-                    if podset == 0:
-                        aspath = "{}".format(tor_asn)
-                    else:
-                        aspath = "{} {} {}".format(spine_asn, leaf_asn, tor_asn)
-
-                if family in ["v4", "both"]:
-                    routes.append((prefix, nexthop, aspath))
-                if family in ["v6", "both"]:
-                    routes.append((prefix_v6, nexthop_v6, aspath))
+            if router_type == "leaf" and podset == 0 and tor == 0:
+                # Skip tor 0 podset 0 for T1
+                continue
+
+            leaf_asn = leaf_asn_start + podset
+            tor_asn  = tor_asn_start + tor
+
+            aspath = None
+            if router_type == "spine":
+                aspath = "{} {}".format(leaf_asn, tor_asn)
+            elif router_type == "leaf":
+                if podset == 0:
+                    aspath = "{}".format(tor_asn)
+                else:
+                    aspath = "{} {} {}".format(spine_asn, leaf_asn, tor_asn)
+
+            # All subnets of a tor have the same AS path
+            start = (podset * tor_number + tor) * max_tor_subnet_number * tor_subnet_size
+            offsets.extend(range(start, start + tor_subnet_number * tor_subnet_size, tor_subnet_size))
+            aspaths.extend([aspath] * tor_subnet_number)
+
+    prefixlen_v4 = (32 - int(math.log(tor_subnet_size, 2)))
+    prefixes_v4, prefixes_v6 = subnet_prefixes(family, offsets, prefixlen_v4)
+
+    if family == "v4":
+        routes.extend(zip(prefixes_v4, [nexthop] * len(aspaths), aspaths))
+    elif family == "v6":
+        routes.extend(zip(prefixes_v6, [nexthop_v6] * len(aspaths), aspaths))
+    elif family == "both":
+        for prefix, prefix_v6, aspath in zip(prefixes_v4, prefixes_v6, aspaths):
+            routes.append((prefix, nexthop, aspath))
+            routes.append((prefix_v6, nexthop_v6, aspath))
 
     return routes
 
 
-def fib_t0(ptfhost, testbed):
+def start_exabgp(ptfhost, testbed, local_ip, local_ipv6):
+    """
+    @summary: Start the IPv4 and IPv6 exabgp instances of all VMs on the PTF, EXABGP_START_PARALLEL at a time
+    """
+    calls = []
+    for k, v in testbed['topo']['properties']['configuration'].items():
+        vm_offset = testbed['topo']['properties']['topology']['VMs'][k]['vm_offset']
+        peer_ip = ipaddress.IPNetwork(v['bp_interface']['ipv4'])
+        peer_ipv6 = ipaddress.IPNetwork(v['bp_interface']['ipv6'])
+        asn = int(v['bgp']['asn'])
+        port = 5000 + vm_offset
+        port6 = 6000 + vm_offset
+
+        calls.append((ptfhost, "exabgp", [], dict(name=k,
+                                                  state="started",
+                                                  router_id=str(local_ip),
+                                                  local_ip=str(local_ip),
+                                                  peer_ip=str(peer_ip.ip),
+                                                  local_asn=asn,
+                                                  peer_asn=asn,
+                                                  port=port)))
+
+        calls.append((ptfhost, "exabgp", [], dict(name="%s-v6" % k,
+                                                  state="started",
+                                                  router_id=str(local_ip),
+                                                  local_ip=str(local_ipv6),
+                                                  peer_ip=str(peer_ipv6.ip),
+                                                  local_asn=asn,
+                                                  peer_asn=asn,
+                                                  port=port6)))
+    for i in range(0, len(calls), EXABGP_START_PARALLEL):
+        run_modules(calls[i:i + EXABGP_START_PARALLEL])
+
+
+def fib_t0(ptfhost, testbed, duthost):
     logger.info("use fib_t0 to setup routes for topo {}".format(testbed['topo']['name']))
 
     podset_number = 200
@@ -112,49 +277,31 @@ def fib_t0(ptfhost, testbed):
 
     local_ip = ipaddress.IPAddress("10.10.246.254")
     local_ipv6 = ipaddress.IPAddress("fc0a::ff")
-    for k, v in testbed['topo']['properties']['configuration'].items():
-        vm_offset = testbed['topo']['properties']['topology']['VMs'][k]['vm_offset']
-        peer_ip = ipaddress.IPNetwork(v['bp_interface']['ipv4'])
-        peer_ipv6 = ipaddress.IPNetwork(v['bp_interface']['ipv6'])
-        asn = int(v['bgp']['asn'])
-        port = 5000 + vm_offset
-        port6 = 6000 + vm_offset
+    start_exabgp(ptfhost, testbed, local_ip, local_ipv6)
 
-        ptfhost.exabgp(name=k,
-                       state="started", \
-                       router_id = str(local_ip), \
-                       local_ip  = str(local_ip), \
-                       peer_ip   = str(peer_ip.ip), \
-                       local_asn = asn, \
-                       peer_asn  = asn, \
-                       port = port)
-
-        ptfhost.exabgp(name="%s-v6" % k,
-                       state="started", \
-                       router_id = str(local_ip), \
-                       local_ip  = str(local_ipv6), \
-                       peer_ip   = str(peer_ipv6.ip), \
-                       local_asn = asn, \
-                       peer_asn  = asn, \
-                       port = port6)
+    # All VMs announce the same routes
+    routes_v4 = generate_routes("v4", podset_number, tor_number, tor_subnet_number,
+                                spine_asn, leaf_asn_start, tor_asn_start,
+                                local_ip, local_ipv6)
+    routes_v6 = generate_routes("v6", podset_number, tor_number, tor_subnet_number,
+                                spine_asn, leaf_asn_start, tor_asn_start,
+                                local_ip, local_ipv6)
 
+    announcements = []
     for k, v in testbed['topo']['properties']['configuration'].items():
         vm_offset = testbed['topo']['properties']['topology']['VMs'][k]['vm_offset']
         port = 5000 + vm_offset
         port6 = 6000 + vm_offset
 
-        routes_v4 = generate_routes("v4", podset_number, tor_number, tor_subnet_number,
-                                    spine_asn, leaf_asn_start, tor_asn_start,
-                                    local_ip, local_ipv6)
-        routes_v6 = generate_routes("v6", podset_number, tor_number, tor_subnet_number,
-                                    spine_asn, leaf_asn_start, tor_asn_start,
-                                    local_ip, local_ipv6)
+        announcements.append((port, routes_v4))
+        announcements.append((port6, routes_v6))
 
-        announce_routes(ptfip, port, routes_v4)
-        announce_routes(ptfip, port6, routes_v6)
+    start = time.time()
+    announce_routes_parallel(ptfip, announcements)
+    wait_for_convergence(duthost, routes_v4, routes_v6, start)
 
 
-def fib_t1_lag(ptfhost, testbed):
+def fib_t1_lag(ptfhost, testbed, duthost):
     logger.info("use fib_t1_lag to setup routes for topo {}".format(testbed['topo']['name']))
 
     podset_number = 200
@@ -172,33 +319,20 @@ def fib_t1_lag(ptfhost, testbed):
 
     local_ip = ipaddress.IPAddress("10.10.246.254")
     local_ipv6 = ipaddress.IPAddress("fc0a::ff")
-
-    for k, v in testbed['topo']['properties']['configuration'].items():
-        vm_offset = testbed['topo']['properties']['topology']['VMs'][k]['vm_offset']
-        peer_ip = ipaddress.IPNetwork(v['bp_interface']['ipv4'])
-        peer_ipv6 = ipaddress.IPNetwork(v['bp_interface']['ipv6'])
-        asn = int(v['bgp']['asn'])
-        port = 5000 + vm_offset
-        port6 = 6000 + vm_offset
-
-        ptfhost.exabgp(name=k,
-                       state="started", \
-                       router_id = str(local_ip), \
-                       local_ip  = str(local_ip), \
-                       peer_ip   = str(peer_ip.ip), \
-                       local_asn = asn, \
-                       peer_asn  = asn, \
-                       port = port)
-
-        ptfhost.exabgp(name="%s-v6" % k,
-                       state="started", \
-                       router_id = str(local_ip), \
-                       local_ip  = str(local_ipv6), \
-                       peer_ip   = str(peer_ipv6.ip), \
-                       local_asn = asn, \
-                       peer_asn  = asn, \
-                       port = port6)
-
+    start_exabgp(ptfhost, testbed, local_ip, local_ipv6)
+
+    # The routes are the same for all VMs of the same role, generate them once
+    routes = {}
+    def get_routes(family, router_type):
+        if (family, router_type) not in routes:
+            routes[(family, router_type)] = generate_routes(family, podset_number, tor_number, tor_subnet_number,
+                                                            None, leaf_asn_start, tor_asn_start,
+                                                            local_ip, local_ipv6, router_type=router_type)
+        return routes[(family, router_type)]
+
+    announcements = []
+    all_routes_v4 = []
+    all_routes_v6 = []
     for k, v in testbed['topo']['properties']['configuration'].items():
 
         vm_offset = testbed['topo']['properties']['topology']['VMs'][k]['vm_offset']
@@ -206,34 +340,33 @@ def fib_t1_lag(ptfhost, testbed):
         port6 = 6000 + vm_offset
 
         if 'spine' in v['properties']:
-            routes_v4 = generate_routes("v4", podset_number, tor_number, tor_subnet_number,
-                                        None, leaf_asn_start, tor_asn_start,
-                                        local_ip, local_ipv6, router_type="spine")
-            routes_v6 = generate_routes("v6", podset_number, tor_number, tor_subnet_number,
-                                        None, leaf_asn_start, tor_asn_start,
-                                        local_ip, local_ipv6, router_type="spine")
-            announce_routes(ptfip, port, routes_v4)
-            announce_routes(ptfip, port6, routes_v6)
+            announcements.append((port, get_routes("v4", "spine")))
+            announcements.append((port6, get_routes("v6", "spine")))
+            all_routes_v4.extend(get_routes("v4", "spine"))
+            all_routes_v6.extend(get_routes("v6", "spine"))
 
         elif 'tor' in v['properties']:
-            routes_v4 = generate_routes("v4", podset_number, tor_number, tor_subnet_number,
-                                        None, leaf_asn_start, tor_asn_start,
-                                        local_ip, local_ipv6, router_type="tor")
-            announce_routes(ptfip, port, routes_v4)
+            announcements.append((port, get_routes("v4", "tor")))
+            all_routes_v4.extend(get_routes("v4", "tor"))
 
         if 'vips' in v:
             routes_vips = []
             for prefix in v["vips"]["ipv4"]["prefixes"]:
                 routes_vips.append((prefix, local_ip, v["vips"]["ipv4"]["asn"]))
-            announce_routes(ptfip, port, routes_vips)
+            announcements.append((port, routes_vips))
+            all_routes_v4.extend(routes_vips)
+
+    start = time.time()
+    announce_routes_parallel(ptfip, announcements)
+    wait_for_convergence(duthost, all_routes_v4, all_routes_v6, start)
 
 
 @pytest.fixture(scope='module')
-def fib(ptfhost, testbed):
+def fib(ptfhost, testbed, duthost):
     logger.info("setup fib to topo {}".format(testbed['topo']['name']))
     if testbed['topo']['name'] == "t0":
-        fib_t0(ptfhost, testbed)
+        fib_t0(ptfhost, testbed, duthost)
     elif testbed['topo']['name'] == "t1-lag":
-        fib_t1_lag(ptfhost, testbed)
+        fib_t1_lag(ptfhost, testbed, duthost)
     else:
         logger.error("unknonw topology {}".format(testbed['topo']['name']))
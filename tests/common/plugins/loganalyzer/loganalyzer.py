@@ -144,28 +144,10 @@ class LogAnalyzer:
         self.ansible_host.command(cmd)
         return start_marker
 
-    def analyze(self, marker, fail=True):
+    def _extract_rotated_log(self, marker):
         """
-        @summary: Extract syslog logs based on the start/stop markers and compose one file. Download composed file, analyze file based on defined regular expressions.
-
-        @param marker: Marker obtained from "init" method.
-        @param fail: Flag to enable/disable raising exception when loganalyzer find error messages.
-
-        @return: If "fail" is False - return dictionary of parsed syslog summary, if dictionary can't be parsed - return empty dictionary. If "fail" is True and if found match messages - raise exception.
+        @summary: Extract the syslog from all rotated syslog files starting from the start marker.
         """
-        logging.debug("Loganalyzer analyze")
-        analyzer_summary = {"total": {"match": 0, "expected_match": 0, "expected_missing_match": 0},
-                            "match_files": {},
-                            "match_messages": {},
-                            "expect_messages": {},
-                            "unused_expected_regexp": []
-                            }
-        tmp_folder = ".".join((SYSLOG_TMP_FOLDER, time.strftime("%Y-%m-%d-%H:%M:%S", time.gmtime())))
-        self.ansible_loganalyzer.run_id = marker
-
-        # Add end marker into DUT syslog
-        self._add_end_marker(marker)
-
         try:
             # Disable logrotate cron task
             self.ansible_host.command("sed -i 's/^/#/g' /etc/cron.d/logrotate")
@@ -191,6 +173,37 @@ class LogAnalyzer:
             # Enable logrotate cron task back
             self.ansible_host.command("sed -i 's/^#//g' /etc/cron.d/logrotate")
 
+    def analyze(self, marker, fail=True):
+        """
+        @summary: Extract syslog logs based on the start/stop markers and compose one file. Download composed file, analyze file based on defined regular expressions.
+
+        @param marker: Marker obtained from "init" method.
+        @param fail: Flag to enable/disable raising exception when loganalyzer find error messages.
+
+        @return: If "fail" is False - return dictionary of parsed syslog summary, if dictionary can't be parsed - return empty dictionary. If "fail" is True and if found match messages - raise exception.
+        """
+        logging.debug("Loganalyzer analyze")
+        analyzer_summary = {"total": {"match": 0, "expected_match": 0, "expected_missing_match": 0},
+                            "match_files": {},
+                            "match_messages": {},
+                            "expect_messages": {},
+                            "unused_expected_regexp": []
+                            }
+        tmp_folder = ".".join((SYSLOG_TMP_FOLDER, time.strftime("%Y-%m-%d-%H:%M:%S", time.gmtime())))
+        self.ansible_loganalyzer.run_id = marker
+
+        # Add end marker into DUT syslog
+        self._add_end_marker(marker)
+
+        # On DUT copy the syslog written since the offset recorded by init to /tmp/syslog
+        cmd = "python {run_dir}/loganalyzer.py --action extract --run_id {marker} --target_file {target}".format(
+            run_dir=self.dut_run_dir, marker=marker, target=self.extracted_syslog)
+        try:
+            self.ansible_host.command(cmd)
+        except Exception as err:
+            logging.debug("Syslog offset of '{}' is not usable, extracting rotated logs: {}".format(marker, err))
+            self._extract_rotated_log(marker)
+
         # Download extracted logs from the DUT to the temporal folder defined in SYSLOG_TMP_FOLDER
         self.save_extracted_log(dest=tmp_folder)
 
@@ -200,8 +213,9 @@ class LogAnalyzer:
 
         analyzer_parse_result = self.ansible_loganalyzer.analyze_file_list([tmp_folder], match_messages_regex, ignore_messages_regex, expect_messages_regex)
         # Print syslog file content and remove the file
-        with open(tmp_folder) as fo:
-            logging.debug("Syslog content:\n\n{}".format(fo.read()))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            with open(tmp_folder) as fo:
+                logging.debug("Syslog content:\n\n{}".format(fo.read()))
         os.remove(tmp_folder)
 
         total_match_cnt = 0
@@ -220,8 +234,9 @@ class LogAnalyzer:
 
         # Find unused regex matches
         for regex in self.expect_regex:
+            regex_compiled = re.compile(regex)
             for line in expected_lines_total:
-                if re.search(regex, line):
+                if regex_compiled.search(line):
                     break
             else:
                 unused_regex_messages.append(regex)
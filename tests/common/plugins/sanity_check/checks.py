@@ -1,4 +1,3 @@
-import re
 import json
 import logging
 import time
@@ -8,11 +7,23 @@ from common.utilities import wait
 logger = logging.getLogger(__name__)
 SYSTEM_STABILIZE_MAX_TIME = 300
 OMEM_THRESHOLD_BYTES=10485760 # 10MB
+SNAPSHOT_MAX_AGE = 10
 
-def check_services(dut):
+def _networking_uptime(snapshot):
+    # Unknown networking start time is treated as stabilized system, check without retry.
+    uptime = snapshot.get("networking_uptime")
+    return int(uptime) if uptime is not None else SYSTEM_STABILIZE_MAX_TIME
+
+def _snapshot(dut, snapshot=None):
+    if snapshot is None:
+        snapshot = dut.get_health_snapshot()
+    return snapshot
+
+def check_services(dut, snapshot=None):
     logger.info("Checking services status...")
 
-    networking_uptime = dut.get_networking_uptime().seconds
+    snapshot = _snapshot(dut, snapshot)
+    networking_uptime = _networking_uptime(snapshot)
     timeout = max((SYSTEM_STABILIZE_MAX_TIME - networking_uptime), 0)
     interval = 20
     logger.info("networking_uptime=%d seconds, timeout=%d seconds, interval=%d seconds" % \
@@ -20,14 +31,14 @@ def check_services(dut):
 
     check_result = {"failed": True, "check_item": "services"}
     if timeout == 0:    # Check services status, do not retry.
-        services_status = dut.critical_services_status()
+        services_status = snapshot["services"]
         check_result["failed"] = False if all(services_status.values()) else True
         check_result["services_status"] = services_status
     else:               # Retry checking service status
         start = time.time()
         elapsed = 0
         while elapsed < timeout:
-            services_status = dut.critical_services_status()
+            services_status = snapshot["services"]
             check_result["failed"] = False if all(services_status.values()) else True
             check_result["services_status"] = services_status
 
@@ -35,6 +46,7 @@ def check_services(dut):
                 wait(interval, msg="Not all services are started, wait %d seconds to retry. Remaining time: %d %s" % \
                      (interval, int(timeout - elapsed), str(check_result["services_status"])))
                 elapsed = time.time() - start
+                snapshot = dut.get_health_snapshot()
             else:
                 break
 
@@ -42,47 +54,29 @@ def check_services(dut):
     return check_result
 
 
-def _find_down_ports(dut, interfaces):
-    down_ports = []
-    intf_facts = dut.interface_facts()['ansible_facts']
-    for intf in interfaces:
-        try:
-            port = intf_facts["ansible_interface_facts"][intf]
-            if not port["link"] or not port["active"]:
-                down_ports.append(intf)
-        except KeyError:
-            down_ports.append(intf)
-    return down_ports
-
-
-def check_interfaces(dut):
+def check_interfaces(dut, snapshot=None):
     logger.info("Checking interfaces status...")
 
-    networking_uptime = dut.get_networking_uptime().seconds
+    snapshot = _snapshot(dut, snapshot)
+    networking_uptime = _networking_uptime(snapshot)
     timeout = max((SYSTEM_STABILIZE_MAX_TIME - networking_uptime), 0)
     interval = 20
     logger.info("networking_uptime=%d seconds, timeout=%d seconds, interval=%d seconds" % \
                 (networking_uptime, timeout, interval))
 
-    cfg_facts = dut.config_facts(host=dut.hostname, source="persistent")['ansible_facts']
-    interfaces = [k for k,v in cfg_facts["PORT"].items() if "admin_status" in v and v["admin_status"] == "up"]
-    if "PORTCHANNEL_INTERFACE" in cfg_facts:
-        interfaces += cfg_facts["PORTCHANNEL_INTERFACE"].keys()
-    if "VLAN_INTERFACE" in cfg_facts:
-        interfaces += cfg_facts["VLAN_INTERFACE"].keys()
-
-    logger.info(json.dumps(interfaces, indent=4))
+    # The snapshot covers the admin up ports, port channel and vlan interfaces in persistent configuration
+    logger.info(json.dumps(sorted(snapshot["interfaces"].keys()), indent=4))
 
     check_result = {"failed": True, "check_item": "interfaces"}
     if timeout == 0:    # Check interfaces status, do not retry.
-        down_ports = _find_down_ports(dut, interfaces)
+        down_ports = snapshot["down_ports"]
         check_result["failed"] = True if len(down_ports) > 0 else False
         check_result["down_ports"] = down_ports
     else:               # Retry checking interface status
         start = time.time()
         elapsed = 0
         while elapsed < timeout:
-            down_ports = _find_down_ports(dut, interfaces)
+            down_ports = snapshot["down_ports"]
             check_result["failed"] = True if len(down_ports) > 0 else False
             check_result["down_ports"] = down_ports
 
@@ -90,25 +84,20 @@ def check_interfaces(dut):
                 wait(interval, msg="Found down ports, wait %d seconds to retry. Remaining time: %d, down_ports=%s" % \
                      (interval, int(timeout - elapsed), str(check_result["down_ports"])))
                 elapsed = time.time() - start
+                snapshot = dut.get_health_snapshot()
             else:
                 break
 
     logger.info("Done checking interfaces status.")
     return check_result
 
-def check_dbmemory(dut):
+def check_dbmemory(dut, snapshot=None):
     logger.info("Checking database memory...")
 
-    total_omem = 0
-    re_omem = re.compile("omem=(\d+)")
-    res = dut.command("/usr/bin/redis-cli client list")
-    for l in res['stdout_lines']:
-        m = re_omem.search(l)
-        if m:
-            omem = int(m.group(1))
-            total_omem += omem
+    snapshot = _snapshot(dut, snapshot)
+    total_omem = snapshot["dbmemory"]["total_omem"]
 
-    logger.info(json.dumps(res['stdout_lines'], indent=4))
+    logger.info(json.dumps(snapshot["dbmemory"]["client_list"], indent=4))
     check_result = {"failed": False, "check_item": "dbmemory"}
     if total_omem > OMEM_THRESHOLD_BYTES:
         check_result["failed"] = True
@@ -117,10 +106,11 @@ def check_dbmemory(dut):
     logger.info("Done checking database memory")
     return check_result
 
-def check_processes(dut):
+def check_processes(dut, snapshot=None):
     logger.info("Checking process status...")
 
-    networking_uptime = dut.get_networking_uptime().seconds
+    snapshot = _snapshot(dut, snapshot)
+    networking_uptime = _networking_uptime(snapshot)
     timeout = max((SYSTEM_STABILIZE_MAX_TIME - networking_uptime), 0)
     interval = 20
     logger.info("networking_uptime=%d seconds, timeout=%d seconds, interval=%d seconds" % \
@@ -128,7 +118,7 @@ def check_processes(dut):
 
     check_result = {"failed": False, "check_item": "processes"}
     if timeout == 0:    # Check processes status, do not retry.
-        processes_status = dut.all_critical_process_status()
+        processes_status = snapshot["processes"]
         check_result["processes_status"] = processes_status
         check_result["services_status"] = {}
         for k, v in processes_status.items():
@@ -139,7 +129,7 @@ def check_processes(dut):
         start = time.time()
         elapsed = 0
         while elapsed < timeout:
-            processes_status = dut.all_critical_process_status()
+            processes_status = snapshot["processes"]
             check_result["processes_status"] = processes_status
             check_result["services_status"] = {}
             for k, v in processes_status.items():
@@ -151,6 +141,7 @@ def check_processes(dut):
                 wait(interval, msg="Not all processes are started, wait %d seconds to retry. Remaining time: %d %s" % \
                      (interval, int(timeout - elapsed), str(check_result["processes_status"])))
                 elapsed = time.time() - start
+                snapshot = dut.get_health_snapshot()
             else:
                 break
 
@@ -158,16 +149,17 @@ def check_processes(dut):
     return check_result
 
 def do_checks(dut, check_items):
+    checks = {"services": check_services, "interfaces": check_interfaces,
+              "dbmemory": check_dbmemory, "processes": check_processes}
     results = []
+    snapshot, taken = None, 0
     for item in check_items:
-        if item == "services":
-            results.append(check_services(dut))
-        elif item == "interfaces":
-            results.append(check_interfaces(dut))
-        elif item == "dbmemory":
-            results.append(check_dbmemory(dut))
-        elif item == "processes":
-            results.append(check_processes(dut))
+        if item not in checks:
+            continue
+        # All checks share one snapshot of the DUT, unless a check spent time retrying
+        if snapshot is None or time.time() - taken > SNAPSHOT_MAX_AGE:
+            snapshot, taken = dut.get_health_snapshot(), time.time()
+        results.append(checks[item](dut, snapshot))
 
     return results
 
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Benchmark of the table walks of the snmp_facts module against a local SNMP agent.
+
+The agent is a stand-in for snmpsim: it serves a synthetic MIB of a switch with the
+given number of ports from memory. Requests go through a UDP relay which delays every
+packet by half of the round trip time to emulate the network between the sonic-mgmt
+container and the DUT, and counts the requests.
+
+Usage:
+    python snmp_facts_benchmark.py --ports 64 --rtt 0.002 --max-repetitions 25
+"""
+import argparse
+import bisect
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from pysnmp.carrier.asyncore.dgram import udp
+from pysnmp.entity import config, engine
+from pysnmp.entity.rfc3413 import cmdrsp, context
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto.api import v2c
+from pysnmp.smi import instrum
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "ansible", "library"))
+from snmp_facts import DefineOid, walk_tables
+
+COMMUNITY = "public"
+
+
+def build_mib(ports):
+    """
+    @summary: Build the MIB of a switch with the ports, it has the tables walked by snmp_facts
+    @return: Dictionary of {OID tuple: value}
+    """
+    v = DefineOid(dotprefix=False)
+    mib = {}
+
+    def add(column, index, value):
+        oid = tuple(int(sub_id) for sub_id in column.split(".")) + tuple(index)
+        mib[oid] = value
+
+    for port in range(1, ports + 1):
+        add(v.ifIndex, [port], v2c.Integer(port))
+        add(v.ifDescr, [port], v2c.OctetString("Ethernet%d" % ((port - 1) * 4)))
+        add(v.ifMtu, [port], v2c.Integer(9100))
+        add(v.ifSpeed, [port], v2c.Gauge32(4294967295))
+        add(v.ifPhysAddress, [port], v2c.OctetString(hexValue="0025900e%04x" % port))
+        add(v.ifAdminStatus, [port], v2c.Integer(1))
+        add(v.ifOperStatus, [port], v2c.Integer(1 if port % 2 else 2))
+        add(v.ifAlias, [port], v2c.OctetString("ARISTA%02dT0:Ethernet1" % port))
+        for column in [v.ifInDiscards, v.ifOutDiscards, v.ifInErrors, v.ifOutErrors,
+                       v.ifInUcastPkts, v.ifOutUcastPkts]:
+            add(column, [port], v2c.Counter32(port * 1000))
+        for column in [v.ifHCInOctets, v.ifHCOutOctets]:
+            add(column, [port], v2c.Counter64(port * 1000000))
+        ip = [10, 0, port // 256, port % 256]
+        add(v.ipAdEntAddr, ip, v2c.IpAddress(".".join(str(x) for x in ip)))
+        add(v.ipAdEntIfIndex, ip, v2c.Integer(port))
+        add(v.ipAdEntNetMask, ip, v2c.IpAddress("255.255.255.254"))
+        add(v.lldpLocPortIdSubtype, [port], v2c.Integer(7))
+        add(v.lldpLocPortId, [port], v2c.OctetString("Ethernet%d" % ((port - 1) * 4)))
+        add(v.lldpLocPortDesc, [port], v2c.OctetString("ARISTA%02dT0:Ethernet1" % port))
+        index = [0, port, 1]
+        add(v.lldpRemChassisIdSubtype, index, v2c.Integer(4))
+        add(v.lldpRemChassisId, index, v2c.OctetString(hexValue="5254000012%02x" % (port % 256)))
+        add(v.lldpRemPortIdSubtype, index, v2c.Integer(5))
+        add(v.lldpRemPortId, index, v2c.OctetString("Ethernet1"))
+        add(v.lldpRemPortDesc, index, v2c.OctetString("Ethernet1"))
+        add(v.lldpRemSysName, index, v2c.OctetString("ARISTA%02dT0" % port))
+        add(v.lldpRemSysDesc, index, v2c.OctetString("Arista Networks EOS version 4.20.15M"))
+        add(v.lldpRemSysCapSupported, index, v2c.OctetString(hexValue="2800"))
+        add(v.lldpRemSysCapEnabled, index, v2c.OctetString(hexValue="2800"))
+        for column in [v.lldpRemManAddrIfSubtype, v.lldpRemManAddrIfId, v.lldpRemManAddrOID]:
+            add(column, index + [1, 4, 10, 250, 0, port % 256], v2c.Integer(2))
+        add(v.cpfcIfRequests, [port], v2c.Counter32(0))
+        add(v.cpfcIfIndications, [port], v2c.Counter32(0))
+        for prio in range(1, 9):
+            add(v.requestsPerPriority, [port, prio], v2c.Counter64(0))
+            add(v.indicationsPerPriority, [port, prio], v2c.Counter64(0))
+        for queue in range(1, 9):
+            for counter in range(1, 5):
+                add(v.csqIfQosGroupStats, [port, 1, queue, counter], v2c.Counter64(0))
+
+    for entity in range(1, 32):
+        add(v.entPhysDescr, [entity], v2c.OctetString("Entity %d" % entity))
+        add(v.entPhysClass, [entity], v2c.Integer(10))
+        for column in [v.entPhysName, v.entPhysHwVer, v.entPhysFwVer, v.entPhysSwVer,
+                       v.entPhysSerialNum, v.entPhysMfgName, v.entPhysModelName]:
+            add(column, [entity], v2c.OctetString(""))
+        add(v.entPhySensorType, [entity], v2c.Integer(8))
+        add(v.entPhySensorScale, [entity], v2c.Integer(9))
+        add(v.entPhySensorPrecision, [entity], v2c.Integer(3))
+        add(v.entPhySensorValue, [entity], v2c.Integer(25000))
+        add(v.entPhySensorOperStatus, [entity], v2c.Integer(1))
+
+    for psu in range(1, 3):
+        add(v.cefcFRUPowerOperStatus, [psu], v2c.Integer(2))
+
+    add(v.sysDescr, [], v2c.OctetString("SONiC Software Version: SONiC.master"))
+    add(v.sysObjectId, [], v2c.ObjectIdentifier("1.3.6.1.4.1.8072.3.2.10"))
+    add(v.sysUpTime, [], v2c.TimeTicks(123456))
+    add(v.sysContact, [], v2c.OctetString("admin"))
+    add(v.sysName, [], v2c.OctetString("sonic"))
+    add(v.sysLocation, [], v2c.OctetString("lab"))
+    add(v.lldpLocChassisIdSubtype, [], v2c.Integer(4))
+    add(v.lldpLocChassisId, [], v2c.OctetString(hexValue="0025900e0000"))
+    add(v.lldpLocSysName, [], v2c.OctetString("sonic"))
+    add(v.lldpLocSysDesc, [], v2c.OctetString("SONiC Software Version: SONiC.master"))
+    for address, length in [(1, 4), (2, 16)]:
+        index = [address, length] + [10] * length
+        add(v.lldpLocManAddrLen, index, v2c.Integer(length + 1))
+        add(v.lldpLocManAddrIfSubtype, index, v2c.Integer(2))
+        add(v.lldpLocManAddrIfId, index, v2c.Integer(1))
+        add(v.lldpLocManAddrOID, index, v2c.ObjectIdentifier("0.0"))
+    add(v.sysTotalMemery, [], v2c.Integer(8000000))
+    add(v.sysTotalFreeMemery, [], v2c.Integer(4000000))
+
+    # Some objects after the walked tables, as the agent of the DUT has
+    add("1.3.6.1.6.3.1.1.6.1", [0], v2c.Integer(1))
+    return mib
+
+
+class MibInstrum(instrum.AbstractMibInstrumController):
+    """
+    MIB instrumentation serving the objects of a dictionary, the same way as snmpsim
+    serves the objects of a snapshot file.
+    """
+    def __init__(self, mib):
+        self.oids = sorted(mib)
+        self.values = dict(mib)
+
+    def readVars(self, varBinds, acInfo=(None, None)):
+        return [(oid, self.values.get(tuple(oid), v2c.NoSuchInstance())) for oid, _ in varBinds]
+
+    def readNextVars(self, varBinds, acInfo=(None, None)):
+        result = []
+        for oid, _ in varBinds:
+            position = bisect.bisect_right(self.oids, tuple(oid))
+            if position < len(self.oids):
+                next_oid = self.oids[position]
+                result.append((v2c.ObjectIdentifier(next_oid), self.values[next_oid]))
+            else:
+                result.append((oid, v2c.EndOfMibView()))
+        return result
+
+
+def start_agent(mib):
+    """
+    @summary: Start the SNMP agent serving the MIB on a random port of the loopback interface
+    @return: The port of the agent
+    """
+    snmp_engine = engine.SnmpEngine()
+    config.addTransport(snmp_engine, udp.domainName, udp.UdpTransport().openServerMode(("127.0.0.1", 0)))
+    config.addV1System(snmp_engine, "agent", COMMUNITY)
+    config.addVacmUser(snmp_engine, 2, "agent", "noAuthNoPriv", (1,))
+    snmp_context = context.SnmpContext(snmp_engine)
+    snmp_context.unregisterContextName(v2c.OctetString(""))
+    snmp_context.registerContextName(v2c.OctetString(""), MibInstrum(mib))
+    cmdrsp.GetCommandResponder(snmp_engine, snmp_context)
+    cmdrsp.NextCommandResponder(snmp_engine, snmp_context)
+    cmdrsp.BulkCommandResponder(snmp_engine, snmp_context)
+
+    transport = snmp_engine.transportDispatcher.getTransport(udp.domainName)
+    port = transport.socket.getsockname()[1]
+    snmp_engine.transportDispatcher.jobStarted(1)
+    thread = threading.Thread(target=snmp_engine.transportDispatcher.runDispatcher)
+    thread.daemon = True
+    thread.start()
+    return port
+
+
+class LatencyRelay(object):
+    """
+    UDP relay between the manager and the agent, delays every packet by half of the
+    round trip time in each direction and counts the requests in a shared counter.
+    """
+    def __init__(self, agent_port, rtt, requests):
+        self.agent = ("127.0.0.1", agent_port)
+        self.delay = rtt / 2.0
+        self.requests = requests
+        self.clients = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, sock, data, address):
+        if self.delay:
+            timer = threading.Timer(self.delay, sock.sendto, (data, address))
+            timer.daemon = True
+            timer.start()
+        else:
+            sock.sendto(data, address)
+
+    def upstream(self, client):
+        # One socket to the agent for each manager socket, to relay the responses back
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+
+        def run():
+            while True:
+                data = sock.recv(65535)
+                self.send(self.sock, data, client)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return sock
+
+    def run(self):
+        while True:
+            data, client = self.sock.recvfrom(65535)
+            if client not in self.clients:
+                self.clients[client] = self.upstream(client)
+            with self.requests.get_lock():
+                self.requests.value += 1
+            self.send(self.clients[client], data, self.agent)
+
+
+def serve(ports, rtt, requests, ready):
+    """
+    @summary: Run the agent and the relay, in a separate process to not share the GIL
+              with the walks under measurement
+    """
+    relay = LatencyRelay(start_agent(build_mib(ports)), rtt, requests)
+    ready.put(relay.port)
+    while True:
+        time.sleep(1)
+
+
+def benchmark(ports, rtt, max_repetitions, count):
+    mib = build_mib(ports)
+    requests = multiprocessing.Value("i", 0)
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(ports, rtt, requests, ready))
+    server.daemon = True
+    server.start()
+    relay_port = ready.get()
+    v = DefineOid(dotprefix=False)
+    tables = [
+        [v.ifIndex, v.ifDescr, v.ifMtu, v.ifSpeed, v.ifPhysAddress, v.ifAdminStatus, v.ifOperStatus],
+        [v.ipAdEntAddr, v.ipAdEntIfIndex, v.ipAdEntNetMask],
+        [v.ifAlias],
+        [v.ifInDiscards, v.ifOutDiscards, v.ifInErrors, v.ifOutErrors, v.ifInUcastPkts, v.ifOutUcastPkts],
+        [v.ifHCInOctets, v.ifHCOutOctets],
+        [v.entPhysDescr, v.entPhysClass, v.entPhysName, v.entPhysHwVer, v.entPhysFwVer,
+         v.entPhysSwVer, v.entPhysMfgName, v.entPhysModelName],
+        [v.entPhySensorType, v.entPhySensorScale, v.entPhySensorPrecision, v.entPhySensorValue,
+         v.entPhySensorOperStatus],
+        [v.lldpLocPortIdSubtype, v.lldpLocPortId, v.lldpLocPortDesc],
+        [v.lldpRemChassisIdSubtype, v.lldpRemChassisId, v.lldpRemPortIdSubtype, v.lldpRemPortId,
+         v.lldpRemPortDesc, v.lldpRemSysName, v.lldpRemSysDesc, v.lldpRemSysCapSupported,
+         v.lldpRemSysCapEnabled],
+        [v.lldpRemManAddrIfSubtype, v.lldpRemManAddrIfId, v.lldpRemManAddrOID],
+        [v.cpfcIfRequests, v.cpfcIfIndications],
+        [v.requestsPerPriority, v.indicationsPerPriority],
+        [v.csqIfQosGroupStats],
+        [v.cefcFRUPowerOperStatus],
+    ]
+    prefixes = [tuple(int(sub_id) for sub_id in column.split(".")) for table in tables for column in table]
+    expected = len([oid for oid in mib if any(oid[:len(prefix)] == prefix for prefix in prefixes)])
+    snmp_auth = cmdgen.CommunityData(COMMUNITY)
+
+    modes = [("GETNEXT sequential", 0, False),
+             ("GETNEXT parallel", 0, True),
+             ("GETBULK sequential", max_repetitions, False),
+             ("GETBULK parallel", max_repetitions, True)]
+    baseline = None
+    print("{} ports, {} objects, rtt {} ms, max-repetitions {}".format(
+          ports, expected, rtt * 1000, max_repetitions))
+    for name, repetitions, parallel in modes:
+        requests.value = 0
+        start = time.time()
+        for _ in range(count):
+            walked = walk_tables(snmp_auth, cmdgen.UdpTransportTarget(("127.0.0.1", relay_port)), tables,
+                                 max_repetitions=repetitions, parallel=parallel)
+        elapsed = (time.time() - start) / count
+        errors = [str(error) for error, _ in walked if error]
+        objects = sum(len(rows) for _, rows in walked)
+        baseline = baseline or elapsed
+        print("{:20s}: {:8.3f} sec {:6.1f}x {:6d} requests {:6d} objects{}".format(
+              name, elapsed, baseline / elapsed, requests.value // count, objects,
+              " errors: {}".format(errors) if errors else ""))
+        if objects != expected:
+            print("{:20s}: expected {} objects".format(name, expected))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the table walks of snmp_facts")
+    parser.add_argument("--ports", help="number of ports of the simulated switch", type=int, default=64)
+    parser.add_argument("--rtt", help="round trip time to the agent in seconds", type=float, default=0.002)
+    parser.add_argument("--max-repetitions", help="rows of each GETBULK request", type=int, default=25)
+    parser.add_argument("--count", help="number of walks to average", type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark(args.ports, args.rtt, args.max_repetitions, args.count)